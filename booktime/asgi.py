@@ -14,3 +14,8 @@ from channels.routing import get_default_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "booktime.settings")
 django.setup()
 application = get_default_application()
+
+# daphne не отправляет события lifespan: общие ресурсы закрываются
+# перед остановкой его реактора (main/shutdown.py)
+from main import shutdown  # noqa: E402
+shutdown.install()
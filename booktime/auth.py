@@ -1,24 +1,83 @@
+from collections import OrderedDict
+from functools import partial
+import logging
+import time
 from urllib.parse import parse_qs
+from django.conf import settings
 from channels.auth import AuthMiddlewareStack
 from rest_framework.authtoken.models import Token
+from main.metrics import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+# Пользователи, найденные по токену, хранятся в памяти процесса
+# TOKEN_CACHE_TIMEOUT секунд (последние TOKEN_CACHE_SIZE токенов).
+# Неизвестные токены тоже кешируются, как None. При удалении токена
+# и изменении пользователя записи удаляются сигналами (main/signals.py).
+_token_cache = OrderedDict()
+
+
+def _load_token_user(key):
+    try:
+        user = Token.objects.select_related('user').get(key=key).user
+    except Token.DoesNotExist:
+        return None
+    return user if user.is_active else None
+
+
+async def get_token_user(key):
+    """
+    Пользователь по ключу токена или None. База данных запрашивается
+    одним запросом вне цикла событий и только при промахе кеша.
+    """
+    now = time.monotonic()
+    cached = _token_cache.get(key)
+    if cached is not None and cached[0] > now:
+        _token_cache.move_to_end(key)
+        return cached[1]
+    user = await database_sync_to_async(_load_token_user)(key)
+    _token_cache[key] = (now + settings.TOKEN_CACHE_TIMEOUT, user)
+    _token_cache.move_to_end(key)
+    while len(_token_cache) > settings.TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return user
+
+
+def invalidate_token(key=None, user_id=None):
+    """
+    Удаляет из кеша токен по ключу или все токены пользователя.
+    """
+    if key is not None:
+        _token_cache.pop(key, None)
+    if user_id is not None:
+        for cached_key, (_, user) in list(_token_cache.items()):
+            if user is not None and user.pk == user_id:
+                _token_cache.pop(cached_key, None)
 
 
 class TokenGetAuthMiddleware:
+    """
+    Аутентифицирует соединение по токену из параметра token строки запроса.
+    Токен проверяется в корутине соединения, поэтому запрос к базе данных
+    не блокирует цикл событий; внутреннее приложение создается после этого.
+    """
     def __init__(self, inner):
         self.inner = inner
 
     def __call__(self, scope):
-        params = parse_qs(scope["query_string"])
+        return partial(self.coroutine_call, scope)
+
+    async def coroutine_call(self, scope, receive, send):
+        scope = dict(scope)
+        params = parse_qs(scope.get("query_string", b""))
         if b"token" in params:
-            try:
-                token_key = params[b"token"][0].decode()
-                token = Token.objects.get(key=token_key)
-                scope["user"] = token.user
-            except Token.DoesNotExist:
-                pass
-        return self.inner(scope)
+            user = await get_token_user(params[b"token"][0].decode())
+            if user is not None:
+                scope["user"] = user
+        inner_instance = self.inner(scope)
+        return await inner_instance(receive, send)
 
 
 TokenGetAuthMiddlewareStack = lambda inner: TokenGetAuthMiddleware(
     AuthMiddlewareStack(inner)
-)
\ No newline at end of file
+)
@@ -24,11 +24,67 @@ CHANNEL_LAYERS = {
         "CONFIG": {"hosts": [REDIS_URL]},
     }
 }
+# Общий для всех потребителей процесса пул соединений с Redis (main/redis_pool.py)
+REDIS_POOL_MINSIZE = env.int('REDIS_POOL_MINSIZE', default=1)
+REDIS_POOL_MAXSIZE = env.int('REDIS_POOL_MAXSIZE', default=20)
+# Сообщения чата записываются пачками (main/chatlog.py): по количеству или по времени.
+# Оба значения ограничивают и потерю сообщений при аварийном завершении процесса
+CHAT_FLUSH_MAX_MESSAGES = env.int('CHAT_FLUSH_MAX_MESSAGES', default=50)
+CHAT_FLUSH_INTERVAL_MS = env.int('CHAT_FLUSH_INTERVAL_MS', default=250)
+# Сколько последних сообщений показывается на странице чата
+CHAT_HISTORY_SIZE = 50
+# Поток последних событий комнаты чата для переподключений (примерная длина)
+# и сколько событий из него досылается клиенту за одно переподключение
+CHAT_STREAM_MAXLEN = env.int('CHAT_STREAM_MAXLEN', default=1000)
+CHAT_REPLAY_LIMIT = env.int('CHAT_REPLAY_LIMIT', default=200)
+# Сколько секунд кешируется доступ пользователя к чату заказа и как часто
+# обновляется последний сотрудник, говоривший с клиентом
+CHAT_AUTH_CACHE_TIMEOUT = env.int('CHAT_AUTH_CACHE_TIMEOUT', default=30)
+CHAT_LAST_SPOKEN_THROTTLE = env.int('CHAT_LAST_SPOKEN_THROTTLE', default=60)
+# Исходящие события соединения чата: окно объединения в один кадр, сколько
+# кадров может ждать подтверждения клиента (если он их присылает), размер
+# очереди и что делать с клиентом, который не успевает читать (drop или
+# disconnect)
+CHAT_BATCH_WINDOW_MS = env.int('CHAT_BATCH_WINDOW_MS', default=50)
+CHAT_ACK_WINDOW = env.int('CHAT_ACK_WINDOW', default=32)
+CHAT_OUTBOX_SIZE = env.int('CHAT_OUTBOX_SIZE', default=100)
+CHAT_SLOW_CLIENT_POLICY = env('CHAT_SLOW_CLIENT_POLICY', default='drop')
+# Кеш пользователей по токенам для потребителей Channels (booktime/auth.py)
+TOKEN_CACHE_TIMEOUT = env.int('TOKEN_CACHE_TIMEOUT', default=60)
+TOKEN_CACHE_SIZE = env.int('TOKEN_CACHE_SIZE', default=10000)
+# Сколько секунд REST API хранит в кеше Django права пользователей
+API_AUTH_CACHE_TIMEOUT = env.int('API_AUTH_CACHE_TIMEOUT', default=300)
+# Удаленный сервис отслеживания заказов (main/tracking.py); в адресе можно
+# использовать {order_id}. Ответы по заказу кешируются на несколько секунд.
+ORDER_TRACKER_URL = env('ORDER_TRACKER_URL', default='https://pastebin.com/raw/Zu8MBGW3')
+ORDER_TRACKER_TIMEOUT = env.float('ORDER_TRACKER_TIMEOUT', default=5.0)
+ORDER_TRACKER_CONNECTIONS = env.int('ORDER_TRACKER_CONNECTIONS', default=20)
+ORDER_TRACKER_CACHE_TIMEOUT = env.int('ORDER_TRACKER_CACHE_TIMEOUT', default=30)
+ORDER_TRACKER_CACHE_SIZE = 10000
+# Пакетное отслеживание: сколько заказов в запросе и сколько запросов к сервису одновременно
+ORDER_TRACKER_BATCH_SIZE = 50
+ORDER_TRACKER_CONCURRENCY = env.int('ORDER_TRACKER_CONCURRENCY', default=5)
+# Поток статусов заказов мобильного приложения: сколько пропущенных событий
+# досылается при переподключении и сколько дней они хранятся (prune_order_events)
+ORDER_EVENTS_REPLAY_LIMIT = env.int('ORDER_EVENTS_REPLAY_LIMIT', default=100)
+ORDER_EVENTS_RETENTION_DAYS = env.int('ORDER_EVENTS_RETENTION_DAYS', default=7)
+# Метрики потребителей (main/metrics.py): токен, который сборщик передает в
+# заголовке "Authorization: Bearer ..." (без него metrics/ недоступен),
+# и как часто (в секундах) замеряется задержка цикла событий
+METRICS_TOKEN = env.str('METRICS_TOKEN', default='')
+METRICS_LOOP_LAG_INTERVAL = env.float('METRICS_LOOP_LAG_INTERVAL', default=0.5)
 
 DATABASES = {
  "default": env.db()
 }
 
+# Кеш Django общий для всех процессов сервера: сигналы удаляют из него
+# права пользователей REST API (main/authentication.py), и это должны
+# увидеть все процессы. locmemcache:// годится только для разработки.
+CACHES = {
+    "default": env.cache('CACHE_URL', default='locmemcache://')
+}
+
 if DEBUG:
     ALLOWED_HOSTS = ['*']
 else:
@@ -136,6 +192,18 @@ if not DEBUG:
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Отрендеренные PDF счетов хранятся в кеше Django INVOICE_CACHE_TIMEOUT секунд,
+# последние INVOICE_MEMORY_CACHE_SIZE из них - еще и в памяти процесса
+INVOICE_CACHE_TIMEOUT = env.int('INVOICE_CACHE_TIMEOUT', default=24 * 60 * 60)
+INVOICE_MEMORY_CACHE_SIZE = env.int('INVOICE_MEMORY_CACHE_SIZE', default=32)
+# Количество процессов команды export_invoices (None - по числу ядер)
+INVOICE_EXPORT_WORKERS = env.int('INVOICE_EXPORT_WORKERS', default=None)
+
+# Куб продаж для отчетов админки (каталог), перестраивается командой
+# build_sales_cube; в него попадают последние REPORTING_CUBE_DAYS дней
+REPORTING_CUBE_PATH = env('REPORTING_CUBE_PATH', default=os.path.join(BASE_DIR, 'var', 'sales_cube'))
+REPORTING_CUBE_DAYS = env.int('REPORTING_CUBE_DAYS', default=730)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -174,6 +242,7 @@ DJANGO_TABLES2_TEMPLATE = 'django_tables2/bootstrap.html'
 REST_FRAMEWORK = {
     # Классы аутентификации используются для проверки соответствия
     # комбинаций пользователя и пароля тому, что хранится в базе данных.
+    # Права пользователей кешируются (main/authentication.py).
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework.authentication.SessionAuthentication",
         "rest_framework.authentication.TokenAuthentication",
@@ -181,7 +250,7 @@ REST_FRAMEWORK = {
     ),
     # Классы разрешений используются для понимания того, что пользователь может или не может делать в системе.
     "DEFAULT_PERMISSION_CLASSES": (
-        "rest_framework.permissions.DjangoModelPermissions",
+        "main.authentication.CachedDjangoModelPermissions",
     ),
     # В дополнение к этому мы устанавливаем django-filter в качестве нашего бэкэнда фильтрации и
     "DEFAULT_FILTER_BACKENDS": (
@@ -1,24 +1,33 @@
-from datetime import datetime, timedelta
+from datetime import date, timedelta
 import logging
 from django.contrib import admin
 from django.contrib.auth.admin import (UserAdmin as DjangoUserAdmin)
 from django.utils.html import format_html
-from django.db.models.functions import TruncDay
+from django.db.models.functions import TruncDate
 from django.db.models import Avg, Count, Min, Sum
-from django.http import HttpResponse
-from django.urls import path
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.urls import path, reverse
 from django.template.response import TemplateResponse
-from django.template.loader import render_to_string
 from  django.shortcuts import get_object_or_404, render
 from django import forms
-from weasyprint import HTML
-import tempfile
 
+from . import invoices
 from . import models
+from .paginators import ApproximateCountPaginator
+from .reporting import SalesCube, downsample, get_sales_cube
 
 logger = logging.getLogger(__name__)
 
 
+def period_start(days):
+    """
+    Первый день периода из days последних дней, включая сегодняшний,
+    как в графике orders_per_day.
+    """
+    return date.today() - timedelta(days=days - 1)
+
+
 def make_active(self, request, queryset):
     queryset.update(active=True)
 
@@ -33,6 +42,22 @@ def make_inactive(self, request, queryset):
 make_inactive.short_description = 'Отметить выбранные элементы как неактивные'
 
 
+# Счета выбранных заказов отдаются одним ZIP-архивом по мере готовности.
+# Рендеринг идет в процессе сервера: пул процессов есть только у команды
+# export_invoices, для больших выгрузок нужно использовать ее.
+def export_invoices(self, request, queryset):
+    response = StreamingHttpResponse(
+        invoices.iter_invoices_zip(invoices.invoice_order_ids(queryset),
+                                   base_url=request.build_absolute_uri('/')),
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = 'attachment; filename=invoices.zip'
+    return response
+
+
+export_invoices.short_description = 'Скачать счета выбранных заказов (ZIP)'
+
+
 class ProductAdmin(admin.ModelAdmin):
     list_display = ('name', 'slug', 'in_stock', 'price')
     list_filter = ('active', 'in_stock', 'date_updated')
@@ -86,6 +111,7 @@ class ProductTagAdmin(admin.ModelAdmin):
 
 class ProductImageAdmin(admin.ModelAdmin):
     list_display = ('thumbnail_tag', 'product_name')
+    list_select_related = ('product',)
     readonly_fields = ('thumbnail',)
     search_fields = ('product__name',)
 
@@ -118,28 +144,58 @@ class UserAdmin(DjangoUserAdmin):
 
 class AddressAdmin(admin.ModelAdmin):
     list_display = ('user', 'name', 'address1', 'address2', 'city', 'country',)
+    list_select_related = ('user',)
     readonly_fields = ('user',)
 
 
+# Большие списки изменений (заказы, корзины) не должны выполнять
+# COUNT(*) по всей таблице на каждой странице
+class ApproximateCountMixin:
+    paginator = ApproximateCountPaginator
+    # выше этого числа строк используется оценка планировщика
+    approximate_count_threshold = 10000
+    # сколько секунд кэшируется подсчет
+    count_cache_timeout = 60
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        return self.paginator(queryset, per_page, orphans, allow_empty_first_page,
+                              threshold=self.approximate_count_threshold,
+                              cache_timeout=self.count_cache_timeout)
+
+
 class BasketLineInline(admin.TabularInline):
     model = models.BasketLine
     raw_id_fields = ('product',)
 
 
-class BasketAdmin(admin.ModelAdmin):
+class BasketAdmin(ApproximateCountMixin, admin.ModelAdmin):
     list_display = ('id', 'user', 'status', 'count')
     list_editable = ('status',)
     list_filter = ('status',)
+    list_select_related = ('user',)
     inlines = (BasketLineInline,)
 
+    # количество товаров считается одним запросом для всей страницы,
+    # а не вызовом Basket.count() для каждой строки
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        return qs.annotate(items_count=Sum('basketline__quantity'))
+
+    def count(self, obj):
+        return obj.items_count or 0
+
 
 class OrderLineInline(admin.TabularInline):
     model = models.OrderLine
     raw_id_fields = ('product',)
 
 
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(ApproximateCountMixin, admin.ModelAdmin):
+    # таблица заказов большая: общее количество строк без фильтров не считается
+    show_full_result_count = False
     list_display = ('id', 'user', 'status')
+    list_select_related = ('user',)
+    actions = [export_invoices]
     list_editable = ('status',)
     list_filter = ('status', 'shipping_country', 'date_added')
     inlines = (OrderLineInline,)
@@ -166,8 +222,12 @@ class CentralOfficeOrderLineInline(admin.TabularInline):
     readonly_fields = ('product',)
 
 
-class CentralOfficeOrderAdmin(admin.ModelAdmin):
+class CentralOfficeOrderAdmin(ApproximateCountMixin, admin.ModelAdmin):
+    # таблица заказов большая: общее количество строк без фильтров не считается
+    show_full_result_count = False
     list_display = ('id', 'user', 'status')
+    list_select_related = ('user',)
+    actions = [export_invoices]
     list_editable = ('status',)
     readonly_fields = ('user',)
     list_filter = ('status', 'shipping_country', 'date_added')
@@ -187,7 +247,9 @@ class CentralOfficeOrderAdmin(admin.ModelAdmin):
 
 
 # Диспетчерам не нужно видеть платежный адрес в полях
-class DispatchersOrderAdmin(admin.ModelAdmin):
+class DispatchersOrderAdmin(ApproximateCountMixin, admin.ModelAdmin):
+    # таблица заказов большая: общее количество строк без фильтров не считается
+    show_full_result_count = False
     list_display = ('id', 'shipping_name', 'date_added', 'status',)
     list_filter = ('status', 'shipping_country', 'date_added')
     inlines = (CentralOfficeOrderLineInline,)
@@ -220,58 +282,184 @@ class PeriodSelectForm(forms.Form):
     period = forms.TypedChoiceField(choices=PERIODS, coerce=int, required=True)
 
 
+class SalesRankingForm(PeriodSelectForm):
+    RANKINGS = (("units", "Units sold"), ("revenue", "Revenue"))
+    rank_by = forms.ChoiceField(choices=RANKINGS, required=False)
+
+    def clean_rank_by(self):
+        return self.cleaned_data["rank_by"] or "units"
+
+
+class SalesCubeForm(forms.Form):
+    MEASURES = (("revenue", "Revenue"), ("units", "Units sold"))
+    PERIODS = PeriodSelectForm.PERIODS + ((180, "180 days"), (365, "365 days"))
+    GROUPINGS = (("week", "Week"),
+                 ("day", "Day"),
+                 ("month", "Month"),
+                 ("country", "Country"),
+                 ("tag", "Tag"),
+                 ("product", "Product"))
+    measure = forms.ChoiceField(choices=MEASURES)
+    period = forms.TypedChoiceField(choices=PERIODS, coerce=int)
+    group_by = forms.MultipleChoiceField(choices=GROUPINGS, required=False, widget=forms.CheckboxSelectMultiple)
+    countries = forms.MultipleChoiceField(choices=models.Address.SUPPORTED_COUNTRIES, required=False)
+    tags = forms.ModelMultipleChoiceField(queryset=models.ProductTag.objects.all(), required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        group_by = cleaned_data.get("group_by") or []
+        if len([dim for dim in group_by if dim in SalesCube.PERIODS]) > 1:
+            raise forms.ValidationError("Choose only one of day, week or month")
+        if "product" in group_by and "tag" in group_by:
+            raise forms.ValidationError("Choose either product or tag")
+        return cleaned_data
+
+
+class ChartDataForm(forms.Form):
+    MODES = (("lttb", "Largest triangle three buckets"), ("sum", "Bucket sums"))
+    days = forms.IntegerField(min_value=1, max_value=3650, required=False)
+    points = forms.IntegerField(min_value=3, max_value=2000, required=False)
+    mode = forms.ChoiceField(choices=MODES, required=False)
+    rank_by = forms.ChoiceField(choices=SalesRankingForm.RANKINGS, required=False)
+
+
 # Следующее добавит представления отчетов в список
 # доступных URL-адресов и перечислит их со страницы индекса
 class ReportingColoredAdminSite(ColoredAdminSite):
+    most_bought_products_limit = 20
+
+    chart_default_days = 180
+    chart_default_points = 300
+    chart_cache_max_age = 300
+
     def get_urls(self):
         urls = super().get_urls()
-        my_urls = [path('orders_per_day/', self.admin_view(self.orders_per_day),),
-                   path("most_bought_products/", self.admin_view(self.most_bought_products), name="most_bought_products",),]
+        my_urls = [path('orders_per_day/', self.admin_view(self.orders_per_day), name="orders_per_day",),
+                   path('orders_per_day.json', self.admin_view(self.orders_per_day_data), name="orders_per_day_data",),
+                   path("most_bought_products/", self.admin_view(self.most_bought_products), name="most_bought_products",),
+                   path("most_bought_products.json", self.admin_view(self.most_bought_products_data), name="most_bought_products_data",),
+                   path("sales_cube/", self.admin_view(self.sales_cube), name="sales_cube",),]
         return my_urls + urls
 
     def orders_per_day(self, request):
-        starting_day = datetime.now() - timedelta(days=180)
-        order_data = (models.Order.objects.filter(date_added__gt=starting_day)
-                      .annotate(day=TruncDay('date_added'))
-                      .values('day')
-                      .annotate(c=Count('id')))
-        labels = [x['day'].strftime('%Y-%m-%d') for x in order_data]
-        values = [x['c'] for x in order_data]
-
+        # Данные графика загружаются отдельно из orders_per_day.json,
+        # уже уменьшенными до ширины графика
         context = dict(self.each_context(request),
                        title='Orders per day',
-                       labels='labels',
-                       values=values)
-        return TemplateResponse(request, 'order_per_day.html', context)
+                       data_url=reverse('%s:orders_per_day_data' % self.name))
+        return TemplateResponse(request, 'orders_per_day.html', context)
+
+    def chart_response(self, data):
+        response = JsonResponse(data)
+        patch_cache_control(response, private=True, max_age=self.chart_cache_max_age)
+        return response
+
+    def orders_per_day_data(self, request):
+        form = ChartDataForm(request.GET)
+        if not form.is_valid():
+            return JsonResponse({"errors": form.errors}, status=400)
+        days = form.cleaned_data["days"] or self.chart_default_days
+        points = form.cleaned_data["points"] or self.chart_default_points
+        starting_day = date.today() - timedelta(days=days)
+        order_data = (models.Order.objects.filter(date_added__date__gt=starting_day)
+                      .annotate(day=TruncDate('date_added'))
+                      .values_list('day')
+                      .annotate(c=Count('id'))
+                      .order_by())
+        # дни без заказов тоже точки ряда, иначе форма графика искажается
+        values = [0] * days
+        for day, c in order_data:
+            offset = (day - starting_day).days - 1
+            if 0 <= offset < days:
+                values[offset] = c
+        labels = [(starting_day + timedelta(days=i + 1)).strftime('%Y-%m-%d') for i in range(days)]
+        labels, values = downsample(labels, values, points, form.cleaned_data["mode"] or "lttb")
+        return self.chart_response({"labels": labels, "values": values})
+
+    def most_bought_products_data(self, request):
+        form = ChartDataForm(request.GET)
+        if not form.is_valid():
+            return JsonResponse({"errors": form.errors}, status=400)
+        days = form.cleaned_data["days"] or PeriodSelectForm.PERIODS[0][0]
+        points = form.cleaned_data["points"] or self.most_bought_products_limit
+        rank_by = form.cleaned_data["rank_by"] or "units"
+        data = list(models.ProductSalesDay.objects.top(period_start(days), by=rank_by))
+        labels = [x['product__name'] for x in data[:points]]
+        values = [float(x[rank_by]) for x in data[:points]]
+        # остаток длинного хвоста складывается в одну корзину
+        if len(data) > points:
+            labels[-1] = 'Other'
+            values[-1] = float(sum(x[rank_by] for x in data[points - 1:]))
+        return self.chart_response({"labels": labels, "values": values})
 
     def most_bought_products(self, request):
+        labels = None
+        values = None
+        dataset_label = 'No of purchases'
         if request.method == "POST":
-            form = PeriodSelectForm(request.POST)
+            form = SalesRankingForm(request.POST)
             if form.is_valid():
                 days = form.cleaned_data["period"]
-                starting_day = datetime.now() - timedelta(days=days)
-                data = (models.OrderLine.objects.filter(order__date_added__gt=starting_day)
-                        .values('product__name').annotate(c=Count('id')))
+                rank_by = form.cleaned_data["rank_by"]
+                starting_day = period_start(days)
+                # Суммируем дневную таблицу продаж по id продукта, а не по имени,
+                # поэтому разные продукты с одинаковым именем не сливаются
+                data = models.ProductSalesDay.objects.top(starting_day, by=rank_by, limit=self.most_bought_products_limit)
                 logger.info('most_bought_products query: %s', data.query)
                 labels = [x['product__name'] for x in data]
-                values = [x['c'] for x in data]
+                values = [float(x[rank_by]) for x in data]
+                if rank_by == "revenue":
+                    dataset_label = 'Revenue'
         else:
-            form = PeriodSelectForm()
-            labels = None
-            values = None
+            form = SalesRankingForm()
 
         context = dict(self.each_context(request),
                        title='Most bought products',
                        form=form,
+                       dataset_label=dataset_label,
                        labels=labels,
                        values=values,)
         return TemplateResponse(request, 'most_bought_products.html', context)
 
+    def sales_cube(self, request):
+        """
+        Произвольные срезы продаж (страна x тег x неделя и т.д.),
+        которые отвечаются из куба в памяти, а не отдельным ORM-запросом.
+        """
+        rows = None
+        columns = None
+        cube = get_sales_cube()
+        if "measure" in request.GET:
+            form = SalesCubeForm(request.GET)
+            if form.is_valid() and cube is not None:
+                measure = form.cleaned_data["measure"]
+                group_by = [dim for dim, _ in SalesCubeForm.GROUPINGS if dim in form.cleaned_data["group_by"]]
+                tags = form.cleaned_data["tags"]
+                rows = cube.query(measure=measure,
+                                  by=group_by,
+                                  since=period_start(form.cleaned_data["period"]),
+                                  countries=form.cleaned_data["countries"] or None,
+                                  tags=[tag.id for tag in tags] or None,)
+                columns = group_by + [measure]
+                rows = [[row[column] for column in columns] for row in rows]
+        else:
+            form = SalesCubeForm(initial={"measure": "revenue", "period": 90, "group_by": ["week"]})
+
+        context = dict(self.each_context(request),
+                       title='Sales cube',
+                       form=form,
+                       not_built=cube is None,
+                       columns=columns,
+                       rows=rows,)
+        return TemplateResponse(request, 'sales_cube.html', context)
+
     def index(self, request, extra_context=None):
         reporting_pages = [{"name": "Orders per day",
                             "link": "orders_per_day/",},
                            {"name": "Most bought products",
-                            "link": "most_bought_products/",},]
+                            "link": "most_bought_products/",},
+                           {"name": "Sales cube",
+                            "link": "sales_cube/",},]
         if not extra_context:
             extra_context = {}
         extra_context = {'reporting_pages': reporting_pages}
@@ -292,22 +480,15 @@ class InvoiceMixin:
         order = get_object_or_404(models.Order, pk=order_id)
 
         if request.GET.get("format") == "pdf":
-            html_string = render_to_string("invoice.html", {"order": order})
-            html = HTML(string=html_string, base_url=request.build_absolute_uri(),)
-            result = html.write_pdf()
-
-            response = HttpResponse(content_type="application/pdf")
+            # готовый PDF текущей версии заказа берется из кэша,
+            # WeasyPrint запускается только после изменения заказа
+            pdf = invoices.get_invoice_pdf(order, base_url=request.build_absolute_uri())
+            response = HttpResponse(pdf, content_type="application/pdf")
             response["Content-Disposition"] = "inline; filename=invoice.pdf"
             response["Content-Transfer-Encoding"] = "binary"
-            with tempfile.NamedTemporaryFile(delete=True) as output:
-                output.write(result)
-                output.flush()
-                output = open(output.name, "rb")
-                binary_pdf = output.read()
-                response.write(binary_pdf)
             return response
 
-        return render(request, "invoice.html", {"order": order})
+        return render(request, "invoice.html", {"order": order, "lines": invoices.invoice_lines(order)})
 
 
 # Наконец, мы определяем 3 экземпляра AdminSite, каждый со своим
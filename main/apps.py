@@ -5,4 +5,4 @@ class MainConfig(AppConfig):
     name = 'main'
 
     def ready(self):
-        from . import signals
\ No newline at end of file
+        from . import checks, signals
\ No newline at end of file
@@ -0,0 +1,64 @@
+import logging
+import uuid
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from rest_framework.permissions import DjangoModelPermissions
+
+logger = logging.getLogger(__name__)
+
+# В кеше Django хранятся наборы прав пользователей по ключу
+# api:perms:<версия>:<id>. Набор удаляется из кеша сигналом при изменении
+# пользователя (main/signals.py). Любое изменение групп или прав меняет
+# версию, и все наборы прав загружаются заново. Сигналы
+# чистят кеш только там, где он общий для всех процессов, поэтому
+# в CACHES должен быть общий кеш (проверка main.checks.check_shared_cache).
+PERMISSIONS_KEY = 'api:perms:%s:%s'
+PERMISSIONS_VERSION_KEY = 'api:perms-version'
+
+
+class CachedDjangoModelPermissions(DjangoModelPermissions):
+    """
+    DjangoModelPermissions, которые берут права пользователя из кеша,
+    а не загружают их из групп при каждом запросе. Права загружаются
+    только для запросов, которым они нужны.
+    """
+    def has_permission(self, request, view):
+        # Workaround to ensure DjangoModelPermissions are not applied
+        # to the root view when using DefaultRouter.
+        if getattr(view, '_ignore_model_permissions', False):
+            return True
+
+        if not request.user or (
+           not request.user.is_authenticated and self.authenticated_users_only):
+            return False
+
+        queryset = self._queryset(view)
+        perms = self.get_required_permissions(request.method, queryset.model)
+        if perms and request.user.is_authenticated:
+            load_permissions(request.user)
+
+        return request.user.has_perms(perms)
+
+
+def load_permissions(user):
+    """
+    Кладет набор прав из кеша туда, где его ищет ModelBackend,
+    поэтому has_perms() не обращается к базе данных.
+    """
+    if hasattr(user, '_perm_cache'):
+        return
+    key = PERMISSIONS_KEY % (cache.get_or_set(PERMISSIONS_VERSION_KEY, uuid.uuid4().hex, None), user.pk)
+    perms = cache.get(key)
+    if perms is None:
+        perms = ModelBackend().get_all_permissions(user)
+        cache.set(key, perms, settings.API_AUTH_CACHE_TIMEOUT)
+    user._perm_cache = perms
+
+
+def invalidate_user(user_id):
+    cache.delete(PERMISSIONS_KEY % (cache.get(PERMISSIONS_VERSION_KEY), user_id))
+
+
+def invalidate_permissions():
+    cache.set(PERMISSIONS_VERSION_KEY, uuid.uuid4().hex, None)
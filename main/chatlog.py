@@ -0,0 +1,172 @@
+import asyncio
+import atexit
+import json
+import logging
+import weakref
+from django.conf import settings
+from django.utils import timezone
+
+from . import models
+from .metrics import database_sync_to_async
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Последние события каждой комнаты чата хранятся в потоке Redis, ограниченном
+# примерно CHAT_STREAM_MAXLEN записями. По ним переподключившийся клиент
+# получает пропущенные события. Поток удаляется через сутки без событий.
+CHAT_STREAM_KEY = 'chat:stream:%s'
+CHAT_STREAM_TTL = 24 * 60 * 60
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+class MessageBuffer:
+    """
+    Буфер отложенной записи сообщений чата. Потребители только добавляют
+    сообщения в память; накопленные сообщения записываются одним bulk_create
+    в отдельном потоке, когда их становится CHAT_FLUSH_MAX_MESSAGES или
+    через CHAT_FLUSH_INTERVAL_MS миллисекунд после первого из них.
+
+    При остановке daphne буфер дописывается (main/shutdown.py), а при
+    выходе интерпретатора - write_pending(). Теряются сообщения только при
+    аварийном завершении процесса (SIGKILL, OOM): не больше
+    CHAT_FLUSH_MAX_MESSAGES сообщений или CHAT_FLUSH_INTERVAL_MS миллисекунд
+    переписки, плюс пачки, которые в этот момент записывались.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = []
+        self.timer = None
+        self.writes = set()
+
+    def add(self, message):
+        self.pending.append(message)
+        if len(self.pending) >= settings.CHAT_FLUSH_MAX_MESSAGES:
+            self.flush_soon()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(settings.CHAT_FLUSH_INTERVAL_MS / 1000, self.flush_soon)
+
+    def flush_soon(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = self.loop.create_task(self.write(batch))
+            self.writes.add(task)
+            task.add_done_callback(self.writes.discard)
+
+    async def write(self, batch):
+        try:
+            await database_sync_to_async(models.ChatMessage.objects.bulk_create)(batch)
+        except Exception:
+            logger.exception('Could not save %d chat messages', len(batch))
+        else:
+            logger.debug('Saved %d chat messages', len(batch))
+
+    async def flush(self):
+        self.flush_soon()
+        if self.writes:
+            await asyncio.wait(list(self.writes))
+
+
+def get_buffer():
+    loop = asyncio.get_event_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        buffer = _buffers[loop] = MessageBuffer(loop)
+    return buffer
+
+
+def save_message(order_id, user, message):
+    """
+    Ставит сообщение в очередь на запись, не обращаясь к базе данных.
+    """
+    get_buffer().add(models.ChatMessage(order_id=order_id,
+                                        user_id=user.pk,
+                                        username=user.get_full_name(),
+                                        message=message,
+                                        date_added=timezone.now()))
+
+
+async def flush_messages():
+    """
+    Дописывает все накопленные сообщения. Вызывается при остановке сервера.
+    """
+    await get_buffer().flush()
+
+
+@atexit.register
+def write_pending():
+    """
+    Синхронно записывает сообщения, оставшиеся в буферах, когда циклы
+    событий уже остановлены: запасной путь, если процесс завершается
+    без остановки daphne.
+    """
+    for buffer in list(_buffers.values()):
+        if buffer.timer is not None:
+            buffer.timer.cancel()
+            buffer.timer = None
+        batch, buffer.pending = buffer.pending, []
+        if not batch:
+            continue
+        try:
+            models.ChatMessage.objects.bulk_create(batch)
+        except Exception:
+            logger.exception('Could not save %d chat messages at exit', len(batch))
+        else:
+            logger.info('Saved %d chat messages at exit', len(batch))
+
+
+def parse_event_id(event_id):
+    """
+    Id записи потока Redis "<миллисекунды>-<номер>" в виде кортежа для сравнения.
+    Возвращает None для некорректного id.
+    """
+    ms, _, seq = str(event_id or '').partition('-')
+    if not (ms.isdigit() and seq.isdigit()):
+        return None
+    return int(ms), int(seq)
+
+
+async def append_event(order_id, event):
+    """
+    Добавляет событие комнаты в поток и возвращает его id.
+    """
+    redis = await get_redis()
+    key = CHAT_STREAM_KEY % order_id
+    pipe = redis.pipeline()
+    event_id = pipe.xadd(key, {'event': json.dumps(event)}, max_len=settings.CHAT_STREAM_MAXLEN)
+    pipe.expire(key, CHAT_STREAM_TTL)
+    await pipe.execute()
+    return (await event_id).decode('utf8')
+
+
+async def replay_events(order_id, last_event_id):
+    """
+    События комнаты после last_event_id. Читается не больше CHAT_REPLAY_LIMIT
+    последних событий, поэтому стоимость не зависит от длины истории.
+    Возвращает события и признак того, что часть пропущенных событий
+    недоступна (их нужно загрузить из истории чата).
+    """
+    after = parse_event_id(last_event_id)
+    if after is None:
+        return [], True
+    redis = await get_redis()
+    key = CHAT_STREAM_KEY % order_id
+    entries = await redis.xrevrange(key, start='+', stop='%d-%d' % after, count=settings.CHAT_REPLAY_LIMIT + 1)
+    # нижняя граница XREVRANGE включительная
+    entries = [(event_id, fields) for event_id, fields in entries
+               if parse_event_id(event_id.decode('utf8')) > after]
+    gap = len(entries) > settings.CHAT_REPLAY_LIMIT
+    if not gap:
+        # если поток уже обрезан дальше last_event_id, часть событий могла потеряться
+        oldest = await redis.xrange(key, count=1)
+        gap = bool(oldest) and parse_event_id(oldest[0][0].decode('utf8')) > after
+    events = []
+    for event_id, fields in reversed(entries[:settings.CHAT_REPLAY_LIMIT]):
+        event = json.loads(fields[b'event'].decode('utf8'))
+        event['id'] = event_id.decode('utf8')
+        events.append(event)
+    return events, gap
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+LOCAL_CACHE_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Права пользователей REST API кешируются (main/authentication.py), а
+    сигналы удаляют их только из кеша текущего процесса. С LocMemCache
+    остальные процессы будут проверять старые права до истечения срока.
+    """
+    if settings.DEBUG or settings.CACHES['default']['BACKEND'] != LOCAL_CACHE_BACKEND:
+        return []
+    return [Warning(
+        'The default cache is local to each process.',
+        hint='Set CACHE_URL to a cache shared by all server processes, '
+             'otherwise revoked API permissions stay granted in other '
+             'processes for API_AUTH_CACHE_TIMEOUT seconds.',
+        id='main.W001',
+    )]
@@ -1,20 +1,99 @@
 import aiohttp
-import aioredis
 import asyncio
-import logging
 import json
+import logging
+from collections import deque
+from urllib.parse import parse_qs
 from django.conf import settings
-from django.urls import reverse
+from django.core.cache import cache
+from django.db.models import Exists
 from django.shortcuts import get_object_or_404
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.exceptions import StopConsumer
 from channels.generic.http import AsyncHttpConsumer
-from . import models
+from . import chatlog, events, metrics, models, presence, tracking
+from .metrics import database_sync_to_async
 
 logger = logging.getLogger(__name__)
 
 
+def query_params(scope):
+    """Параметры строки запроса соединения."""
+    query_string = scope.get('query_string') or b''
+    if isinstance(query_string, bytes):
+        query_string = query_string.decode('latin1')
+    return parse_qs(query_string)
+
+
+class ChatOutbox:
+    """
+    Очередь исходящих событий одного соединения чата. Первое событие
+    отправляется сразу, а пришедшие в следующие CHAT_BATCH_WINDOW_MS
+    миллисекунд уходят одним кадром {"type": "batch", "events": [...]}.
+
+    Каждый кадр получает номер seq, и клиент может подтверждать прочитанные
+    кадры сообщением {"type": "ack", "seq": ...}. Send в Channels не ждет
+    клиента, поэтому медленного клиента видно только по подтверждениям.
+    Окно подтверждений действует с первого ack соединения: клиенты, которые
+    их не шлют, получают кадры как раньше. Пока без ответа CHAT_ACK_WINDOW
+    кадров, новые не отправляются, а копятся в очереди.
+
+    Очередь ограничена CHAT_OUTBOX_SIZE событиями всегда, в том числе внутри
+    одного окна объединения. Если она полна, старые события отбрасываются, и
+    клиент получает chat_gap (политика drop), или put() возвращает False, и
+    соединение закрывается (политика disconnect).
+    """
+    def __init__(self, send):
+        self.send = send
+        self.events = deque()
+        self.dropped = 0
+        self.seq = 0
+        self.acked = None
+        self.wakeup = asyncio.Event()
+        self.ack_received = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    def stalled(self):
+        return self.acked is not None and self.seq - self.acked >= settings.CHAT_ACK_WINDOW
+
+    def put(self, event):
+        if len(self.events) >= settings.CHAT_OUTBOX_SIZE:
+            if settings.CHAT_SLOW_CLIENT_POLICY == 'disconnect':
+                return False
+            self.events.popleft()
+            self.dropped += 1
+        self.events.append(event)
+        self.wakeup.set()
+        return True
+
+    def ack(self, seq):
+        if isinstance(seq, int) and (self.acked or 0) < seq <= self.seq:
+            self.acked = seq
+            self.ack_received.set()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            while self.stalled():
+                self.ack_received.clear()
+                await self.ack_received.wait()
+            self.wakeup.clear()
+            events, self.events = list(self.events), deque()
+            if self.dropped:
+                logger.warning('Dropped %d chat events for a slow client', self.dropped)
+                events.insert(0, {'type': 'chat_gap'})
+                self.dropped = 0
+            self.seq += 1
+            frame = dict(events[0]) if len(events) == 1 else {'type': 'batch', 'events': events}
+            frame['seq'] = self.seq
+            await self.send(frame)
+            await asyncio.sleep(settings.CHAT_BATCH_WINDOW_MS / 1000)
+
+    def stop(self):
+        self.task.cancel()
+
+
+@metrics.instrument('connect', 'disconnect', 'receive_json', 'chat_message', 'chat_join', 'chat_leave')
 class ChatConsumer(AsyncJsonWebsocketConsumer):
     """
     Мы унаследовали наш потребитель от AsyncJsonWebsocketConsumer, который
@@ -24,23 +103,49 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     """
     EMPLOYEE = 2
     CLIENT = 1
+    NOBODY = 0
+    closing = False
 
-    def get_user_type(self, user, order_id):
+    @staticmethod
+    def get_user_type(user, order_id):
         """
         Метод get_user_type(), помимо проверки типа пользователя,
         сохраняет имя последнего сотрудника,
         с которым разговаривал клиент, в заказе.
+
+        Владелец заказа и членство в группе сотрудников читаются одним
+        запросом, результат кешируется на CHAT_AUTH_CACHE_TIMEOUT секунд,
+        поэтому переподключения не обращаются к базе данных. Заказ не
+        сохраняется целиком: last_spoken_to обновляется отдельным UPDATE,
+        только если сотрудник сменился, и не чаще раза в
+        CHAT_LAST_SPOKEN_THROTTLE секунд.
         """
-        order = get_object_or_404(models.Order, pk=order_id)
+        key = 'chat:user-type:%s:%s' % (user.pk, order_id)
+        user_type = cache.get(key)
+        if user_type is None:
+            employees = models.User.in_group_query(user.pk, models.User.EMPLOYEES)
+            row = (models.Order.objects.filter(pk=order_id)
+                   .annotate(in_employees=Exists(employees))
+                   .values_list('user_id', 'in_employees')
+                   .first())
+            if row is None:
+                user_type = ChatConsumer.NOBODY
+            elif user.has_role(models.User.EMPLOYEES, in_group=row[1]):
+                user_type = ChatConsumer.EMPLOYEE
+            elif row[0] == user.pk:
+                user_type = ChatConsumer.CLIENT
+            else:
+                user_type = ChatConsumer.NOBODY
+            cache.set(key, user_type, settings.CHAT_AUTH_CACHE_TIMEOUT)
 
-        if user.is_employee:
-            order.last_spoken_to = user
-            order.save()
-            return ChatConsumer.EMPLOYEE
-        elif order.user == user:
-            return ChatConsumer.CLIENT
-        else:
-            return None
+        if user_type == ChatConsumer.EMPLOYEE:
+            throttle_key = 'chat:last-spoken-to:%s' % order_id
+            if cache.get(throttle_key) != user.pk:
+                (models.Order.objects.filter(pk=order_id)
+                 .exclude(last_spoken_to=user)
+                 .update(last_spoken_to=user))
+                cache.set(throttle_key, user.pk, settings.CHAT_LAST_SPOKEN_THROTTLE)
+        return user_type or None
 
     # Три основных метода, receive_json (), connect () и disconnect (), используют методы уровня канала
     # group_send(st:72, 77, 85), group_add(st:70) и group_discard(st:80) для управления связью и синхронизацией
@@ -56,6 +161,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         authorized = False
         if self.scope['user'].is_anonymous:
             await self.close()
+            return
 
         # Для доступа к базе данных от асинхронного потребителя требуется заключить код в синхронную функцию,
         # а затем использовать метод database_sync_to_async().
@@ -72,23 +178,32 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             logger.info('Unauthorized connection from %s', self.scope['user'],)
             await self.close()
 
+        self.authorized = authorized
         if authorized:
-            self.r_conn = await aioredis.create_redis(settings.REDIS_URL)
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
             await self.accept()
+            # Пока выполняется connect(), сообщения группы не обрабатываются, поэтому
+            # пропущенные события дойдут до клиента раньше новых
+            await self.replay(self.last_event_id())
+            self.outbox = ChatOutbox(self.send_json)
             # В методе connect() мы используем метод group_send()
             # для создания сообщений о присоединении различных пользователей.
-            await self.channel_layer.group_send(self.room_group_name, {'type': 'chat_join',
-                                                                       'username': self.scope['user'].get_full_name(),},)
+            await self.broadcast({'type': 'chat_join',
+                                  'username': self.scope['user'].get_full_name(),})
 
     async def disconnect(self, close_code):
-        if not self.scope['user'].is_anonymous:
+        if hasattr(self, 'outbox'):
+            self.outbox.stop()
+        # о выходе сообщается только для пользователей, допущенных в комнату
+        if getattr(self, 'authorized', False):
             # В методе disconnect() мы используем метод group_send()
             # для создания сообщений о выходе различных пользователей.
-            await self.channel_layer.group_send(self.room_group_name, {'type': 'chat_leave',
-                                                                       'username': self.scope['user'].get_full_name(),},)
+            await self.broadcast({'type': 'chat_leave',
+                                  'username': self.scope['user'].get_full_name(),})
             logger.info('Closing chat stream for user %s', self.scope['user'],)
             await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            # пользователь пропадает из списка присутствия сразу, а не по истечении PRESENCE_TTL
+            await presence.leave(self.order_id, self.scope['user'].email)
 
     async def receive_json(self, content):
         """
@@ -99,11 +214,61 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         """
         typ = content.get('type')
         if typ == 'message':
-            await self.channel_layer.group_send(self.room_group_name, {'type': 'chat_message',
-                                                                       'username': self.scope['user'].get_full_name(),
-                                                                       'message': content['message'],},)
+            # сообщение сохраняется в истории чата отложенной записью, без обращения к базе данных
+            chatlog.save_message(self.order_id, self.scope['user'], content['message'])
+            await self.broadcast({'type': 'chat_message',
+                                  'username': self.scope['user'].get_full_name(),
+                                  'message': content['message'],})
         elif typ == 'heartbeat':
-            await self.r_conn.setex('%s_%s' % (self.room_group_name, self.scope['user'].email,), 10, '1') # выдох (через 10 секунд)
+            await presence.heartbeat(self.order_id, self.scope['user'].email)
+        elif typ == 'ack' and hasattr(self, 'outbox'):
+            self.outbox.ack(content.get('seq'))
+
+    async def broadcast(self, event):
+        """
+        Записывает событие в поток комнаты и рассылает его участникам.
+        Id записи в потоке становится id события, по нему клиент
+        сообщает, что он уже получил, при переподключении.
+        """
+        event['id'] = await chatlog.append_event(self.order_id, event)
+        await self.channel_layer.group_send(self.room_group_name, event)
+
+    def last_event_id(self):
+        values = query_params(self.scope).get('last_event_id')
+        return values[0] if values else None
+
+    async def replay(self, last_event_id):
+        """
+        Досылает клиенту события комнаты после last_event_id. Если часть
+        событий уже вытеснена из потока, клиент получает chat_gap и
+        должен загрузить историю чата заново.
+        """
+        self.replayed_id = None
+        if not last_event_id:
+            return
+        events, gap = await chatlog.replay_events(self.order_id, last_event_id)
+        logger.info('Replaying %d chat events for user %s', len(events), self.scope['user'],)
+        if gap:
+            await self.send_json({'type': 'chat_gap'})
+        for event in events:
+            await self.send_json(event)
+        self.replayed_id = events[-1]['id'] if events else last_event_id
+
+    async def send_event(self, event):
+        # соединение уже закрывается, события из группы до него не дойдут
+        if self.closing:
+            return
+        # события, пришедшие во время досылки, клиент уже получил
+        if self.replayed_id is not None:
+            replayed = chatlog.parse_event_id(self.replayed_id)
+            if replayed is not None and chatlog.parse_event_id(event['id']) <= replayed:
+                return
+            self.replayed_id = None
+        if not self.outbox.put(event):
+            logger.warning('Closing chat stream for slow client %s', self.scope['user'],)
+            self.closing = True
+            self.outbox.stop()
+            await self.close(code=4008)
 
 # group_send () не отправляет данные обратно в соединение браузера WebSocket.
 # Он используется только для передачи информации между потребителями с
@@ -118,25 +283,114 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     # Если group_send() вызывается с сообщением ['type'] для chat_message,
     # получатель обработает это с помощью обработчика chat_message()
     async def chat_message(self, event):
-        await self.send_json(event)
+        await self.send_event(event)
 
     async def chat_join(self, event):
-        await self.send_json(event)
+        await self.send_event(event)
 
     async def chat_leave(self, event):
+        await self.send_event(event)
+
+
+@metrics.instrument('connect', 'disconnect', 'order_status')
+class DispatchConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Поток изменений статусов заказов и строк заказов для диспетчеров.
+    Клиент может ограничить поток статусами и странами доставки:
+    ?status=20&country=uk (параметры повторяются или перечисляются через запятую).
+    """
+    def is_dispatcher_func(self, user):
+        return not user.is_anonymous and user.is_dispatcher
+
+    def filters(self):
+        params = query_params(self.scope)
+
+        def values(name):
+            return {value for param in params.get(name, []) for value in param.split(',') if value}
+
+        statuses = values('status')
+        return ({int(status) for status in statuses if status.isdigit()} if statuses else None,
+                values('country') or None)
+
+    async def connect(self):
+        if not await database_sync_to_async(self.is_dispatcher_func)(self.scope['user']):
+            logger.info('Unauthorized dispatch stream for user %s', self.scope['user'],)
+            await self.close()
+            return
+        self.statuses, self.countries = self.filters()
+        logger.info('Opening dispatch stream for user %s (statuses %s, countries %s)',
+                    self.scope['user'], self.statuses, self.countries)
+        await self.channel_layer.group_add(events.DISPATCH_GROUP, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(events.DISPATCH_GROUP, self.channel_name)
+
+    async def order_status(self, event):
+        if self.statuses is not None and event['status'] not in self.statuses:
+            return
+        if self.countries is not None and event['country'] not in self.countries:
+            return
         await self.send_json(event)
 
 
+@metrics.instrument('connect', 'disconnect', 'order_event')
+class OrderEventsConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Поток изменений статусов заказов пользователя для мобильного приложения
+    (вместо периодического опроса my_orders). Приложение подключается с
+    токеном, а при переподключении передает id последнего полученного
+    события: ?token=...&last_event_id=... Пропущенные события досылаются
+    из OrderStatusEvent до новых. Если пропущено больше
+    ORDER_EVENTS_REPLAY_LIMIT событий, приходит resync: заказы нужно
+    перечитать, а поток продолжится после указанного в нем id.
+    """
+    async def connect(self):
+        user = self.scope['user']
+        if user.is_anonymous:
+            await self.close()
+            return
+        self.group_name = events.CUSTOMER_GROUP % user.pk
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        self.replayed_id = 0
+        last_event_id = query_params(self.scope).get('last_event_id')
+        if last_event_id and last_event_id[0].isdigit():
+            # пока выполняется connect(), сообщения группы ждут, поэтому порядок сохраняется
+            missed, latest = await database_sync_to_async(events.missed_events)(
+                user, int(last_event_id[0]), settings.ORDER_EVENTS_REPLAY_LIMIT)
+            if missed is None:
+                await self.send_json({'type': 'resync', 'id': latest})
+                self.replayed_id = latest
+            else:
+                logger.info('Replaying %d order events for user %s', len(missed), user,)
+                for event in missed:
+                    await self.send_json(dict(event, type='order_status'))
+                    self.replayed_id = event['id']
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def order_event(self, event):
+        # события, пришедшие во время досылки, клиент уже получил
+        if event['id'] <= self.replayed_id:
+            return
+        await self.send_json(dict(event, type='order_status'))
+
+
 # События, отправленные сервером (SSE), по сути, представляют собой HTTP-соединение, которое остается открытым и
 # продолжает получать порции информации, как только они происходят. Каждый фрагмент информации начинается со слова
 # «data:» и заканчивается двумя символами новой строки.
+# handle() длится все время потока, поэтому замеряется только disconnect()
+@metrics.instrument('disconnect')
 class ChatNotifyConsumer(AsyncHttpConsumer):
     """
     Этот потребитель реализует интерфейс AsyncHttpConsumer с помощью методов handle () и disconnect ().
     Из-за потокового характера конечной точки, которую мы пытаемся построить, нам нужно держать соединение открытым.
 
     Мы будем вызывать метод send_headers() для запуска HTTP-ответа, и мы будем вызывать send_body() с аргументом
-    more_body, установленным в True, в отдельной асинхронной задаче, которая остается активной.
+    more_body, установленным в True, пока соединение остается активным.
     """
     def is_employee_func(self, user):
         return not user.is_anonymous and user.is_employee
@@ -158,47 +412,53 @@ class ChatNotifyConsumer(AsyncHttpConsumer):
                                              ('Content-Type', 'text/event-stream'),
                                              ('Transfer-Encoding', 'chunked'),])
             self.is_streaming = True
-            self.no_poll = (self.scope.get('query_string') == 'nopoll')
-            asyncio.get_event_loop().create_task(self.stream())
+            self.no_poll = (self.scope.get('query_string') in ('nopoll', b'nopoll'))
+            # AsyncHttpConsumer завершает потребителя сразу после возврата из handle(),
+            # поэтому поток работает здесь же, пока клиент не отключится
+            await self.stream()
         else:
             logger.info('Unauthorized notify stream for user %s and params %s',
                         self.scope.get('user'),
                         self.scope.get('query_string'))
             raise StopConsumer('Unauthorized')
 
+    def last_event_id(self):
+        """
+        Id последнего полученного клиентом события: EventSource передает его
+        в заголовке Last-Event-ID, ReconnectingEventSource - в параметре lastEventId.
+        """
+        for name, value in self.scope.get('headers', []):
+            if name.lower() == b'last-event-id':
+                return value.decode('latin1')
+        values = query_params(self.scope).get('lastEventId')
+        return values[0] if values else None
+
     async def stream(self):
         """
-        Активация метода stream() добавляется в цикл обработки событий и будет оставаться активной до тех пор,
-        пока не будет вызван метод disconnect() (отключение инициировано клиентом). Когда этот метод вызывается,
-        он устанавливает для флага is_streaming значение False, что приведет к завершению внутреннего цикла stream(),
-        выполняемого в другой задаче asyncio. Метод stream() будет периодически читать из Redis ключи, срок действия
-        которых не истек, и отправлять их обратно клиенту. Если во время соединения передан флаг nopoll,
-        он выйдет из цикла, не дожидаясь отключения клиента.
-        """
-        r_conn = await aioredis.create_redis(settings.REDIS_URL)
-        while self.is_streaming:
-            active_chats = await r_conn.keys('customer-service_*')
-            presences = {}
-            for i in active_chats:
-                _, order_id, user_email = i.decode("utf8").split("_")
-                if order_id in presences:
-                    presences[order_id].append(user_email)
-                else:
-                    presences[order_id] = [user_email]
-            data = []
-            for order_id, emails in presences.items():
-                data.append({
-                    'link': reverse('cs_chat', kwargs={'order_id': order_id}),
-                    'text': '%s (%s)' % (order_id, ", ".join(emails)),
-                })
-                payload = "data: %s\n\n" % json.dumps(data)
-                logger.info('Broadcasting presence info to user %s', self.scope['user'],)
-                if self.no_poll:
-                    await self.send_body(payload.encode("utf-8"))
-                    self.is_streaming = False
-                else:
-                    await self.send_body(payload.encode("utf-8"), more_body=self.is_streaming,)
-                    await asyncio.sleep(5)
+        Метод stream() отправляет клиенту снимок чатов, в которых кто-то есть (событие snapshot),
+        а затем только изменения: события join и leave. События строит и кодирует общий для
+        процесса PresenceHub, поток только пересылает готовые байты. При переподключении
+        с Last-Event-ID досылаются только пропущенные события. Если во время соединения
+        передан флаг nopoll, отправляется список чатов и поток завершается.
+        Когда клиент отключается, сервер отменяет задачу потребителя.
+        """
+        if self.no_poll:
+            payload = presence.encode_presence(presence.presence_data(await presence.active_chats()))
+            logger.info('Sending presence info to user %s', self.scope['user'],)
+            await self.send_body(payload)
+            return
+        hub = presence.get_hub()
+        queue = await hub.subscribe(self.last_event_id())
+        try:
+            while self.is_streaming:
+                try:
+                    payload = await asyncio.wait_for(queue.get(), presence.PRESENCE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # комментарий SSE не дает прокси закрыть простаивающее соединение
+                    payload = b": keepalive\n\n"
+                await self.send_body(payload, more_body=True,)
+        finally:
+            hub.unsubscribe(queue)
 
     async def disconnect(self):
         logger.info('Closing notify stream for user %s', self.scope.get('user'),)
@@ -208,6 +468,7 @@ class ChatNotifyConsumer(AsyncHttpConsumer):
 # Этот потребитель полностью асинхронен, за исключением запросов к базе данных.
 # Он принимает запрос с идентификатором заказа, указанным в URL-адресе,
 # а затем пересылает обратно клиенту результат query_remote_server ().
+@metrics.instrument('handle')
 class OrderTrackerConsumer(AsyncHttpConsumer):
     def verify_user(self, user, order_id):
         order = get_object_or_404(models.Order, pk=order_id)
@@ -215,14 +476,10 @@ class OrderTrackerConsumer(AsyncHttpConsumer):
 
     async def query_remote_server(self, order_id):
         """
-        query_remote_server() использует библиотеку, aiohttp,
-        для отправки запроса GET на удаленный Pastebin.
+        query_remote_server() запрашивает удаленный сервис отслеживания
+        через общую для процесса сессию aiohttp (main/tracking.py).
         """
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://pastebin.com/raw/Zu8MBGW3"
-            ) as resp:
-                return await resp.read()
+        return await tracking.track(order_id)
 
     async def handle(self, body):
         self.order_id = self.scope["url_route"]["kwargs"]["order_id"]
@@ -232,7 +489,11 @@ class OrderTrackerConsumer(AsyncHttpConsumer):
             logger.info("Order tracking request for user %s and order %s",
                         self.scope.get("user"),
                         self.order_id,)
-            payload = await self.query_remote_server(self.order_id)
+            try:
+                payload = await self.query_remote_server(self.order_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await self.send_response(502, b"Order tracking is unavailable")
+                return
             logger.info("Order tracking response %s for user %s and order %s",
                         payload,
                         self.scope.get("user"),
@@ -240,3 +501,79 @@ class OrderTrackerConsumer(AsyncHttpConsumer):
             await self.send_response(200, payload)
         else:
             raise StopConsumer("unauthorized")
+
+
+@metrics.instrument('handle')
+class BatchOrderTrackerConsumer(AsyncHttpConsumer):
+    """
+    Отслеживание нескольких заказов одним запросом: ?ids=1,2,3.
+    Заказы пользователя проверяются одним запросом к базе данных, статусы
+    запрашиваются у сервиса одновременно (не больше ORDER_TRACKER_CONCURRENCY
+    сразу) и отправляются клиенту строками NDJSON по мере получения,
+    поэтому ответ занимает время самого медленного запроса, а не их сумму.
+    """
+    def user_orders(self, user, order_ids):
+        if user.is_anonymous:
+            return None
+        return set(models.Order.objects.filter(user=user, pk__in=order_ids).values_list('pk', flat=True))
+
+    def order_ids(self):
+        values = ','.join(query_params(self.scope).get('ids', []))
+        order_ids = []
+        for value in values.split(','):
+            if not value.strip().isdigit():
+                return None
+            if int(value) not in order_ids:
+                order_ids.append(int(value))
+        return order_ids
+
+    async def handle(self, body):
+        order_ids = self.order_ids()
+        if not order_ids or len(order_ids) > settings.ORDER_TRACKER_BATCH_SIZE:
+            await self.send_response(400, b"Expected up to %d order ids" % settings.ORDER_TRACKER_BATCH_SIZE)
+            return
+        allowed = await database_sync_to_async(self.user_orders)(self.scope["user"], order_ids)
+        if allowed is None:
+            raise StopConsumer("unauthorized")
+
+        logger.info("Batch order tracking request for user %s and orders %s",
+                    self.scope.get("user"),
+                    order_ids,)
+        await self.send_headers(headers=[(b"Content-Type", b"application/x-ndjson"),
+                                         (b"Cache-Control", b"no-cache"),])
+        semaphore = asyncio.Semaphore(settings.ORDER_TRACKER_CONCURRENCY)
+
+        async def track(order_id):
+            async with semaphore:
+                try:
+                    payload = await tracking.track(order_id)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    return {"id": order_id, "error": "unavailable"}
+            return {"id": order_id, "status": payload.decode("utf8", "replace")}
+
+        for order_id in order_ids:
+            if order_id not in allowed:
+                await self.send_body(self.encode_line({"id": order_id, "error": "not found"}), more_body=True)
+        for result in asyncio.as_completed([track(order_id) for order_id in order_ids if order_id in allowed]):
+            await self.send_body(self.encode_line(await result), more_body=True)
+        await self.send_body(b"")
+
+    def encode_line(self, data):
+        return (json.dumps(data) + "\n").encode("utf8")
+
+
+class MetricsConsumer(AsyncHttpConsumer):
+    """
+    Метрики процесса (main/metrics.py) в текстовом формате Prometheus.
+    Доступны только с заголовком "Authorization: Bearer <METRICS_TOKEN>":
+    за обратным прокси адрес клиента всегда адрес прокси, поэтому по нему
+    не проверяем. Пока METRICS_TOKEN не задан, метрики не отдаются вовсе.
+    """
+    async def handle(self, body):
+        if not metrics.authorized(dict(self.scope.get('headers') or [])):
+            client = self.scope.get('client') or (None,)
+            logger.info('Refusing metrics request from %s', client[0])
+            await self.send_response(403, b"Forbidden")
+            return
+        await self.send_response(200, metrics.exposition().encode('utf8'),
+                                 headers=[(b"Content-Type", metrics.CONTENT_TYPE)])
@@ -1,6 +1,7 @@
-from rest_framework import serializers, viewsets
+from rest_framework import generics, serializers, viewsets
 from rest_framework.decorators import (api_view,
                                        permission_classes,)
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
@@ -17,7 +18,9 @@ class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
 
 
 class PaidOrderLineViewSet(viewsets.ModelViewSet):
-    queryset = models.OrderLine.objects.filter(order__status=models.Order.PAID).order_by('-order__date_added')
+    queryset = (models.OrderLine.objects.filter(order__status=models.Order.PAID)
+                .select_related('product')
+                .order_by('-order__date_added'))
     serializer_class = OrderLineSerializer
     filter_fields = ('order', 'status')
 
@@ -40,13 +43,43 @@ class PaidOrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
 
 
+class ChatMessageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.ChatMessage
+        fields = ('id', 'username', 'message', 'date_added')
+
+
+class ChatMessagePagination(CursorPagination):
+    # курсор - id сообщения, поэтому любая страница истории - один запрос по индексу (order, id)
+    page_size = 50
+    ordering = '-id'
+
+
+class ChatMessageList(generics.ListAPIView):
+    """
+    История чата заказа от последних сообщений к первым.
+    Доступна сотрудникам и владельцу заказа.
+    """
+    serializer_class = ChatMessageSerializer
+    pagination_class = ChatMessagePagination
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        messages = models.ChatMessage.objects.filter(order_id=self.kwargs['order_id'])
+        if not self.request.user.is_employee:
+            messages = messages.filter(order__user=self.request.user)
+        return messages
+
+
 @api_view()
 @permission_classes((IsAuthenticated,))
 def my_orders(request):
     user = request.user
+    # строки, продукты и изображения загружаются тремя запросами на все заказы,
+    # свойства заказа ниже считаются по уже загруженным данным
     orders = models.Order.objects.filter(user=user).order_by(
         "-date_added"
-    )
+    ).prefetch_related("lines__product__productimage_set")
     data = []
     for order in orders:
         data.append(
@@ -0,0 +1,227 @@
+from contextlib import contextmanager
+import logging
+import threading
+import weakref
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import connection, transaction
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# Изменения статусов заказов и строк заказов рассылаются в группу канального
+# уровня DISPATCH_GROUP после фиксации транзакции. На группу подписаны
+# потребители диспетчеров (DispatchConsumer), каждый со своим фильтром.
+# Изменения статусов существующих заказов, кроме того, записываются в
+# OrderStatusEvent и рассылаются в группу владельца заказа CUSTOMER_GROUP
+# (OrderEventsConsumer мобильного приложения).
+DISPATCH_GROUP = 'dispatch-orders'
+CUSTOMER_GROUP = 'order-events-%s'
+
+# Сообщения, ожидающие фиксации транзакции, собираются в пакет. Каждая
+# порция сообщений регистрируется своим обработчиком on_commit, а пакет
+# хранит на порции только слабые ссылки: при откате транзакции или точки
+# сохранения Django забывает обработчики, и их сообщения исчезают из пакета
+# вместе с ними. На сам пакет в _pending тоже слабая ссылка, поэтому пакет
+# откаченной транзакции не достанется следующей. Записи OrderStatusEvent
+# внутри collect() копятся и вставляются одним запросом.
+_pending = threading.local()
+
+
+def remember_status(instance):
+    """
+    Запоминает статус загруженного или созданного объекта, чтобы после
+    сохранения понять, изменился ли он, не перечитывая строку из базы.
+    """
+    instance._saved_status = instance.__dict__.get('status')
+
+
+def status_changed(instance, created):
+    changed = created or instance.status != getattr(instance, '_saved_status', None)
+    remember_status(instance)
+    return changed
+
+
+def order_event(order):
+    return {'kind': 'order',
+            'order_id': order.id,
+            'status': order.status,
+            'status_name': order.get_status_display(),
+            'country': order.shipping_country,
+            'date_updated': order.date_updated.isoformat()}
+
+
+def orderline_event(line, country):
+    return {'kind': 'orderline',
+            'order_id': line.order_id,
+            'line_id': line.id,
+            'status': line.status,
+            'status_name': line.get_status_display(),
+            'country': country,
+            'product_id': line.product_id}
+
+
+def customer_event(status_event):
+    event = {'id': status_event.id,
+             'order_id': status_event.order_id,
+             'status': status_event.status}
+    if status_event.line_id is not None:
+        event['line_id'] = status_event.line_id
+    return event
+
+
+def order_changed(order, created):
+    record_and_publish(order_event(order), order.user_id, order.id, None, order.status, created)
+
+
+def orderline_changed(line, created):
+    # заказ загружается один раз и остается в строке для orderline_to_order_status
+    order = line.order
+    record_and_publish(orderline_event(line, order.shipping_country), order.user_id, line.order_id,
+                       line.id, line.status, created)
+
+
+def record_and_publish(event, user_id, order_id, line_id, status, created):
+    """
+    Записывает изменение статуса для владельца заказа (кроме создания
+    заказа или строки) и рассылает его после фиксации текущей транзакции:
+    если она откатится, никто не узнает о несостоявшемся изменении.
+    """
+    if getattr(_pending, 'suppressed', False):
+        return
+    dispatch = (DISPATCH_GROUP, dict(event, type='order.status'))
+    if created:
+        publish_on_commit([dispatch])
+        return
+    status_event = models.OrderStatusEvent(user_id=user_id, order_id=order_id, line_id=line_id, status=status)
+    collected = getattr(_pending, 'collected', None)
+    if collected is None:
+        save_status_events([(status_event, dispatch)])
+    else:
+        collected.append((status_event, dispatch))
+
+
+@contextmanager
+def collect():
+    """
+    Записи OrderStatusEvent, появившиеся внутри блока (например, строки
+    и завершенного ею заказа), вставляются одним запросом при выходе.
+    """
+    if getattr(_pending, 'collected', None) is not None:
+        yield
+        return
+    _pending.collected = []
+    try:
+        yield
+        collected = _pending.collected
+    finally:
+        _pending.collected = None
+    if collected:
+        save_status_events(collected)
+
+
+@contextmanager
+def suppressed():
+    """
+    Изменения статусов внутри блока не записываются и не рассылаются,
+    например, для служебных заказов нагрузочного прогона.
+    """
+    _pending.suppressed = True
+    try:
+        yield
+    finally:
+        _pending.suppressed = False
+
+
+def save_status_events(collected):
+    status_events = [status_event for status_event, _ in collected]
+    # id событий нужны клиентам, а bulk_create возвращает их не на всех базах данных
+    if len(status_events) > 1 and connection.features.can_return_rows_from_bulk_insert:
+        models.OrderStatusEvent.objects.bulk_create(status_events)
+    else:
+        for status_event in status_events:
+            status_event.save()
+    messages = []
+    for status_event, dispatch in collected:
+        messages.append(dispatch)
+        messages.append((CUSTOMER_GROUP % status_event.user_id,
+                         dict(customer_event(status_event), type='order.event')))
+    publish_on_commit(messages)
+
+
+class _Batch:
+    def __init__(self):
+        self.parts = []
+        self.sent = False
+
+    def send(self):
+        if self.sent:
+            return
+        self.sent = True
+        if _current_batch() is self:
+            _pending.batch = None
+        parts = [ref() for ref in self.parts]
+        publish([message for part in parts if part is not None for message in part.messages])
+
+
+def _current_batch():
+    ref = getattr(_pending, 'batch', None)
+    return ref() if ref is not None else None
+
+
+class _Part:
+    def __init__(self, batch, messages):
+        self.batch = batch
+        self.messages = messages
+
+    def __call__(self):
+        self.batch.send()
+
+
+def publish_on_commit(messages):
+    """
+    Добавляет сообщения к рассылке текущей транзакции. Все сообщения
+    транзакции отправляются первым сработавшим обработчиком on_commit,
+    а не по переходу в цикл событий на каждый измененный объект.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        publish(messages)
+        return
+    batch = _current_batch()
+    if batch is None:
+        batch = _Batch()
+        _pending.batch = weakref.ref(batch)
+    part = _Part(batch, messages)
+    batch.parts.append(weakref.ref(part))
+    transaction.on_commit(part)
+
+
+async def send_messages(messages):
+    channel_layer = get_channel_layer()
+    for group, message in messages:
+        await channel_layer.group_send(group, message)
+
+
+def publish(messages):
+    try:
+        async_to_sync(send_messages)(messages)
+    except Exception:
+        # событие не должно ломать сохранение заказа
+        logger.exception('Could not publish %d order status messages', len(messages))
+
+
+def missed_events(user, last_event_id, limit):
+    """
+    События пользователя после last_event_id, не больше limit. Если их
+    больше, возвращает None и id последнего события: клиенту проще
+    перечитать заказы целиком.
+    """
+    status_events = list(models.OrderStatusEvent.objects
+                         .filter(user=user, id__gt=last_event_id)
+                         .order_by('id')[:limit + 1])
+    if len(status_events) > limit:
+        latest = models.OrderStatusEvent.objects.filter(user=user).order_by('-id').values_list('id', flat=True)
+        return None, latest.first()
+    return [customer_event(status_event) for status_event in status_events], None
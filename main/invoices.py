@@ -0,0 +1,251 @@
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
+from functools import lru_cache
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import threading
+import zipfile
+from urllib.parse import unquote, urlparse
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch
+from django.template.loader import render_to_string
+from weasyprint import CSS, HTML, default_url_fetcher
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# Отрендеренные PDF счетов хранятся в кеше Django (не в публичном хранилище
+# файлов: в счетах адреса клиентов) под ключом версии счета, а недавно
+# отданные - еще и в памяти процесса. Ключ текущей версии заказа хранится
+# под INVOICE_CURRENT_KEY, поэтому при изменении заказа удаляется именно он.
+INVOICE_KEY = 'invoice:pdf:%d:%s'
+INVOICE_CURRENT_KEY = 'invoice:current:%d'
+
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+INVOICE_STYLESHEETS = ('css/bootstrap.min.css',)
+
+
+def invoice_lines(order):
+    return list(order.lines.select_related('product').order_by('id'))
+
+
+def invoice_version(order, lines):
+    """
+    Версия счета: меняется при любом изменении заказа (date_updated)
+    или его строк (статус, продукт, цена продукта).
+    """
+    state = [order.date_updated.isoformat() if order.date_updated else '']
+    state += ['%d:%d:%d:%s' % (line.id, line.status, line.product_id, line.product.price) for line in lines]
+    return hashlib.sha1('|'.join(state).encode('utf8')).hexdigest()[:16]
+
+
+def invoice_key(order_id, version):
+    return INVOICE_KEY % (order_id, version)
+
+
+def find_static(name):
+    """
+    Путь к статическому файлу на диске: сначала собранный STATIC_ROOT
+    (там же лежат хэшированные имена ManifestStaticFilesStorage), затем finders.
+    """
+    name = posixpath.normpath(name).lstrip('/')
+    if name.startswith('..'):
+        return None
+    if settings.STATIC_ROOT:
+        path = os.path.join(settings.STATIC_ROOT, name)
+        if os.path.isfile(path):
+            return path
+    return finders.find(name)
+
+
+def invoice_url_fetcher(url):
+    """
+    URL-fetcher для WeasyPrint: статические файлы и медиа читаются прямо
+    с диска или из хранилища, а не запрашиваются по HTTP у нашего же сервера.
+    Все остальные URL обрабатываются стандартным fetcher'ом.
+    """
+    parsed = urlparse(url)
+    path = unquote(parsed.path)
+    if parsed.scheme in ('http', 'https', ''):
+        if settings.STATIC_URL and path.startswith(settings.STATIC_URL):
+            filename = find_static(path[len(settings.STATIC_URL):])
+            if filename:
+                return {'file_obj': open(filename, 'rb'),
+                        'mime_type': mimetypes.guess_type(filename)[0],
+                        'redirected_url': url}
+        if settings.MEDIA_URL and path.startswith(settings.MEDIA_URL):
+            name = path[len(settings.MEDIA_URL):]
+            if default_storage.exists(name):
+                return {'file_obj': default_storage.open(name, 'rb'),
+                        'mime_type': mimetypes.guess_type(name)[0],
+                        'redirected_url': url}
+    return default_url_fetcher(url)
+
+
+@lru_cache(maxsize=None)
+def invoice_stylesheets():
+    """
+    Таблицы стилей счета разбираются один раз на процесс и
+    переиспользуются при каждом рендеринге.
+    """
+    return [CSS(filename=find_static(name), url_fetcher=invoice_url_fetcher)
+            for name in INVOICE_STYLESHEETS]
+
+
+def render_invoice_html(order, lines, for_pdf=False):
+    return render_to_string("invoice.html", {"order": order, "lines": lines, "for_pdf": for_pdf})
+
+
+def write_invoice_pdf(html_string, base_url):
+    # стили подключаются уже разобранными, поэтому в HTML для PDF их ссылок нет
+    html = HTML(string=html_string,
+                base_url=base_url,
+                url_fetcher=invoice_url_fetcher,)
+    return html.write_pdf(stylesheets=invoice_stylesheets())
+
+
+def render_invoice_pdf(order, lines, base_url):
+    return write_invoice_pdf(render_invoice_html(order, lines, for_pdf=True), base_url)
+
+
+def _remember(key, pdf):
+    with _memory_lock:
+        _memory_cache[key] = pdf
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > settings.INVOICE_MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def get_invoice_pdf(order, base_url):
+    """
+    Возвращает PDF счета. Рендеринг WeasyPrint выполняется только
+    если для текущей версии заказа еще нет готового файла.
+    """
+    lines = invoice_lines(order)
+    key = invoice_key(order.id, invoice_version(order, lines))
+
+    pdf = cached_invoice_pdf(key)
+    if pdf is None:
+        logger.info('Rendering invoice for order %d', order.id)
+        pdf = render_invoice_pdf(order, lines, base_url)
+        store_invoice_pdf(order.id, key, pdf)
+    return pdf
+
+
+def cached_invoice_pdf(key):
+    with _memory_lock:
+        pdf = _memory_cache.get(key)
+        if pdf is not None:
+            _memory_cache.move_to_end(key)
+            return pdf
+    pdf = cache.get(key)
+    if pdf is not None:
+        _remember(key, pdf)
+    return pdf
+
+
+def store_invoice_pdf(order_id, key, pdf):
+    cache.set_many({key: pdf, INVOICE_CURRENT_KEY % order_id: key}, settings.INVOICE_CACHE_TIMEOUT)
+    _remember(key, pdf)
+
+
+def invalidate_invoices(order_id):
+    """
+    Удаляет сохраненный счет заказа. Вызывается при изменении заказа,
+    чтобы устаревшие PDF не занимали кеш до истечения срока.
+    """
+    prefix = INVOICE_KEY % (order_id, '')
+    with _memory_lock:
+        for key in [key for key in _memory_cache if key.startswith(prefix)]:
+            del _memory_cache[key]
+    current = INVOICE_CURRENT_KEY % order_id
+    key = cache.get(current)
+    if key is not None:
+        cache.delete_many([key, current])
+
+
+class _ZipStream:
+    """
+    Файлоподобный объект без seek/tell, в который пишет zipfile.
+    Записанные байты забираются по мере готовности, поэтому в памяти
+    находится только текущий файл архива.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def invoice_order_ids(orders):
+    return list(orders.order_by('id').values_list('id', flat=True))
+
+
+def iter_invoices_zip(order_ids, base_url, executor=None, max_pending=1, chunk_size=100):
+    """
+    Генератор ZIP-архива со счетами заказов order_ids. Готовые версии
+    берутся из кэша счетов, остальные рендерятся в текущем процессе или,
+    если передан executor (пул процессов команды export_invoices), в нем.
+    Байты архива отдаются по мере готовности счетов, а в пуле одновременно
+    не больше max_pending счетов, поэтому память не зависит от количества
+    заказов.
+    """
+    stream = _ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    pending = {}
+
+    def add(order_id, key, pdf):
+        store_invoice_pdf(order_id, key, pdf)
+        archive.writestr('invoice-BT%d.pdf' % order_id, pdf)
+
+    def drain(return_when):
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            order_id, key = pending.pop(future)
+            add(order_id, key, future.result())
+
+    for start in range(0, len(order_ids), chunk_size):
+        chunk = (models.Order.objects
+                 .filter(pk__in=order_ids[start:start + chunk_size])
+                 .order_by('id')
+                 .prefetch_related(Prefetch('lines', queryset=models.OrderLine.objects
+                                            .select_related('product').order_by('id'))))
+        for order in chunk:
+            lines = list(order.lines.all())
+            key = invoice_key(order.id, invoice_version(order, lines))
+            pdf = cached_invoice_pdf(key)
+            if pdf is not None:
+                archive.writestr('invoice-BT%d.pdf' % order.id, pdf)
+            else:
+                html_string = render_invoice_html(order, lines, for_pdf=True)
+                if executor is None:
+                    add(order.id, key, write_invoice_pdf(html_string, base_url))
+                else:
+                    pending[executor.submit(write_invoice_pdf, html_string, base_url)] = (order.id, key)
+                    if len(pending) >= max_pending:
+                        drain(FIRST_COMPLETED)
+            yield stream.take()
+    while pending:
+        drain(FIRST_COMPLETED)
+        yield stream.take()
+    archive.close()
+    yield stream.take()
+    logger.info('Exported %d invoices', len(order_ids))
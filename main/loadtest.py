@@ -0,0 +1,251 @@
+import asyncio
+from functools import partial
+import gc
+import logging
+import math
+import time
+import tracemalloc
+from channels.db import database_sync_to_async
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import Group
+
+from . import chatlog, consumers, events, models, presence
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Нагрузочный прогон потребителей чата (ChatConsumer) и уведомлений
+# (ChatNotifyConsumer) внутри одного процесса. Соединения открываются
+# коммуникаторами channels.testing прямо к потребителям, без daphne,
+# поэтому измеряется стоимость самих потребителей, канального уровня и
+# Redis. Пользователи и заказы прогона создаются с адресами LOADTEST_EMAIL
+# и удаляются после него (и перед ним, если прошлый прогон прервался).
+# Команда loadtest_consumers запускает прогон во временной тестовой базе
+# данных, а изменения статусов служебных заказов не рассылаются.
+LOADTEST_EMAIL = 'loadtest-%s@booktime.domain'
+PROBE_EMAIL = LOADTEST_EMAIL % 'probe'
+PERCENTILES = (50, 95, 99)
+CONNECT_TIMEOUT = 10
+# сколько соединений открывается одновременно
+CONNECT_CONCURRENCY = 50
+
+
+def percentile(values, p):
+    """Перцентиль по методу ближайшего ранга."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)), 1) - 1]
+
+
+def summarize(values):
+    summary = {'count': len(values)}
+    for p in PERCENTILES:
+        summary['p%d' % p] = percentile(values, p)
+    summary['max'] = max(values) if values else None
+    return summary
+
+
+def elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+
+def delete_fixtures():
+    models.User.objects.filter(email__startswith='loadtest-', email__endswith='@booktime.domain').delete()
+
+
+def create_fixtures(rooms):
+    """
+    Сотрудник и по заказу с отдельным клиентом на каждую комнату чата.
+    """
+    delete_fixtures()
+    employees, _ = Group.objects.get_or_create(name=models.User.EMPLOYEES)
+    employee = models.User.objects.create_user(LOADTEST_EMAIL % 'cs', is_staff=True,
+                                               first_name='Loadtest', last_name='Employee')
+    employee.groups.add(employees)
+    orders = []
+    # служебные заказы не должны попасть к диспетчерам (events.DISPATCH_GROUP)
+    with events.suppressed():
+        for room in range(rooms):
+            user = models.User.objects.create_user(LOADTEST_EMAIL % room, first_name='Loadtest', last_name=str(room))
+            orders.append(models.Order.objects.create(user=user, billing_name='Loadtest', shipping_name='Loadtest'))
+    return employee, orders
+
+
+async def open_chat(user, order_id):
+    communicator = WebsocketCommunicator(consumers.ChatConsumer, '/ws/customer-service/%d/' % order_id)
+    communicator.scope['user'] = user
+    communicator.scope['url_route'] = {'kwargs': {'order_id': order_id}}
+    started = time.perf_counter()
+    try:
+        connected, _ = await communicator.connect(timeout=CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        connected = False
+    if not connected:
+        return None, None
+    return communicator, elapsed_ms(started)
+
+
+async def open_stream(user):
+    communicator = HttpCommunicator(consumers.ChatNotifyConsumer, 'GET', '/customer-service/notify/')
+    communicator.scope['user'] = user
+    started = time.perf_counter()
+    await communicator.send_input({'type': 'http.request', 'body': b''})
+    try:
+        # заголовки ответа и снимок присутствия
+        await communicator.receive_output(CONNECT_TIMEOUT)
+        await communicator.receive_output(CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None, None
+    return communicator, elapsed_ms(started)
+
+
+async def open_all(openers):
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def open_one(opener):
+        async with semaphore:
+            return await opener()
+
+    results = await asyncio.gather(*[open_one(opener) for opener in openers])
+    return ([communicator for communicator, _ in results],
+            [latency for _, latency in results if latency is not None])
+
+
+async def ack(communicator, frame):
+    """Подтверждает кадр чата, как это делает браузер (см. ChatOutbox)."""
+    await communicator.send_json_to({'type': 'ack', 'seq': frame['seq']})
+
+
+async def drain(communicator, quiet=0.2):
+    """Читает все, что пришло в соединение чата, пока оно не замолчит на quiet секунд."""
+    while not await communicator.receive_nothing(timeout=quiet):
+        await ack(communicator, await communicator.receive_json_from())
+
+
+async def collect_messages(communicator, sent, expected, latencies, deadline):
+    """
+    Получает expected сообщений прогона, записывая задержку каждого
+    от отправки. Возвращает количество неполученных сообщений.
+    """
+    loop = asyncio.get_event_loop()
+    received = 0
+    while received < expected:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            frame = await communicator.receive_json_from(timeout)
+        except asyncio.TimeoutError:
+            break
+        now = time.perf_counter()
+        await ack(communicator, frame)
+        for event in (frame['events'] if frame['type'] == 'batch' else [frame]):
+            if event['type'] == 'chat_message' and event['message'] in sent:
+                latencies.append((now - sent[event['message']]) * 1000)
+                received += 1
+    return expected - received
+
+
+async def close(communicator):
+    if communicator.future.done():
+        return
+    if isinstance(communicator, WebsocketCommunicator):
+        # потребитель чата должен остановить свою очередь исходящих событий
+        await communicator.disconnect(timeout=CONNECT_TIMEOUT)
+        return
+    # поток уведомлений завершается только отменой, как при отключении клиента
+    communicator.future.cancel()
+    try:
+        await communicator.wait()
+    except asyncio.CancelledError:
+        pass
+
+
+async def run(chats=100, rooms=10, streams=20, messages=20, interval_ms=10, trace_memory=True, timeout=30):
+    """
+    Открывает chats соединений чата, поровну в rooms комнатах (первое
+    соединение комнаты - сотрудник, остальные - клиент), и streams потоков
+    уведомлений. Затем в каждую комнату отправляется messages сообщений
+    через interval_ms миллисекунд, и одно изменение присутствия для потоков.
+
+    Возвращает отчет: задержки подключения и доставки сообщения до каждого
+    участника (перцентили, в миллисекундах), количество неполученных
+    сообщений и память на соединение по tracemalloc (в килобайтах). При
+    trace_memory задержки подключения включают накладные расходы tracemalloc.
+    """
+    loop = asyncio.get_event_loop()
+    rooms = max(min(rooms, chats), 1)
+    employee, orders = await database_sync_to_async(create_fixtures)(rooms)
+    report = {'chat': {'connections': chats, 'rooms': rooms, 'messages': messages},
+              'notify': {'streams': streams}}
+    opened = []
+    try:
+        if trace_memory:
+            gc.collect()
+            tracemalloc.start()
+        try:
+            openers = []
+            for i in range(chats):
+                order = orders[i % rooms]
+                openers.append(partial(open_chat, employee if i < rooms else order.user, order.id))
+            chat_communicators, chat_connect = await open_all(openers)
+            opened.extend(communicator for communicator in chat_communicators if communicator is not None)
+            if trace_memory:
+                gc.collect()
+                chat_memory = tracemalloc.get_traced_memory()[0]
+            stream_communicators, notify_connect = await open_all([partial(open_stream, employee)] * streams)
+            opened.extend(communicator for communicator in stream_communicators if communicator is not None)
+            if trace_memory:
+                gc.collect()
+                notify_memory = tracemalloc.get_traced_memory()[0] - chat_memory
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        report['chat'].update(failed=chat_communicators.count(None), connect_ms=summarize(chat_connect))
+        report['notify'].update(failed=stream_communicators.count(None), connect_ms=summarize(notify_connect))
+        if trace_memory:
+            report['chat']['kb_per_connection'] = chat_memory / 1024 / max(chats, 1)
+            report['notify']['kb_per_connection'] = notify_memory / 1024 / max(streams, 1)
+
+        # события о входе участников не участвуют в измерениях
+        members = {order.id: [] for order in orders}
+        for i, communicator in enumerate(chat_communicators):
+            if communicator is not None:
+                members[orders[i % rooms].id].append(communicator)
+        await asyncio.gather(*[drain(communicator) for room in members.values() for communicator in room])
+
+        sent, fanout = {}, []
+        deadline = loop.time() + timeout
+        collectors = [loop.create_task(collect_messages(communicator, sent, messages, fanout, deadline))
+                      for room in members.values() for communicator in room]
+        for seq in range(messages):
+            for order_id, room in members.items():
+                if room:
+                    message = 'loadtest %s %d' % (order_id, seq)
+                    sent[message] = time.perf_counter()
+                    await room[0].send_json_to({'type': 'message', 'message': message})
+            await asyncio.sleep(interval_ms / 1000)
+        lost = sum(await asyncio.gather(*collectors))
+        report['chat'].update(fanout_ms=summarize(fanout), lost=lost)
+
+        streams_open = [communicator for communicator in stream_communicators if communicator is not None]
+        notify_fanout = []
+        started = time.perf_counter()
+        await presence.heartbeat(orders[0].id, PROBE_EMAIL)
+        for communicator in streams_open:
+            try:
+                await communicator.receive_output(max(deadline - loop.time(), 1))
+            except asyncio.TimeoutError:
+                continue
+            notify_fanout.append(elapsed_ms(started))
+        await presence.leave(orders[0].id, PROBE_EMAIL)
+        report['notify'].update(fanout_ms=summarize(notify_fanout), lost=len(streams_open) - len(notify_fanout))
+    finally:
+        await asyncio.gather(*[close(communicator) for communicator in opened])
+        await chatlog.flush_messages()
+        redis = await get_redis()
+        await redis.delete(*[chatlog.CHAT_STREAM_KEY % order.id for order in orders])
+        await database_sync_to_async(delete_fixtures)()
+    logger.info('Load test finished: %s', report)
+    return report
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from main.reporting import SalesCube
+
+
+class Command(BaseCommand):
+    help = 'Построение куба продаж для отчетов админки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', type=str, default=None)
+        parser.add_argument('--days', type=int, default=settings.REPORTING_CUBE_DAYS)
+
+    def handle(self, *args, **options):
+        path = options['output'] or settings.REPORTING_CUBE_PATH
+        self.stdout.write("Построение куба продаж")
+        cube = SalesCube.build(days=options['days'])
+        cube.save(path)
+        self.stdout.write("Сохранен куб %s (дней=%d, продуктов=%d, стран=%d) в %s"
+                          % (cube.units.shape, cube.days, len(cube.product_ids), len(cube.countries), path))
@@ -0,0 +1,52 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import multiprocessing
+import os
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from main import invoices
+from main import models
+
+
+class Command(BaseCommand):
+    help = 'Выгрузка счетов заказов за период в ZIP-архив'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', type=str)
+        parser.add_argument('--since', type=lambda s: datetime.strptime(s, '%Y-%m-%d').date())
+        parser.add_argument('--until', type=lambda s: datetime.strptime(s, '%Y-%m-%d').date())
+        parser.add_argument('--workers', type=int, default=settings.INVOICE_EXPORT_WORKERS,
+                            help='Процессы для рендеринга счетов (0 - в текущем процессе)')
+        parser.add_argument('--base-url', type=str, default='http://localhost/')
+
+    def handle(self, *args, **options):
+        orders = models.Order.objects.all()
+        if options['since']:
+            orders = orders.filter(date_added__date__gte=options['since'])
+        if options['until']:
+            orders = orders.filter(date_added__date__lte=options['until'])
+        order_ids = invoices.invoice_order_ids(orders)
+        self.stdout.write("Выгрузка счетов")
+
+        workers = options['workers']
+        if workers is None:
+            workers = os.cpu_count() or 1
+        executor = None
+        if workers:
+            # процессы пула запускаются заново (spawn), а не копией текущего,
+            # поэтому не наследуют его соединения с базой данных
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=django.setup)
+        size = 0
+        try:
+            with open(options['output'], 'wb') as output:
+                for chunk in invoices.iter_invoices_zip(order_ids, options['base_url'],
+                                                        executor=executor, max_pending=2 * max(workers, 1)):
+                    output.write(chunk)
+                    size += len(chunk)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.stdout.write("Выгружено счетов=%d (%d байт) в %s" % (len(order_ids), size, options['output']))
@@ -0,0 +1,97 @@
+import asyncio
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from main import loadtest, presence
+from main.redis_pool import close_redis
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def format_values(items):
+    return ' '.join('%s=%s' % (key, '%.1f' % value if isinstance(value, float) else value) for key, value in items)
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный прогон потребителей чата и уведомлений с проверкой порогов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, default=100, help='Количество соединений чата')
+        parser.add_argument('--rooms', type=int, default=10, help='Количество комнат чата')
+        parser.add_argument('--streams', type=int, default=20, help='Количество потоков уведомлений')
+        parser.add_argument('--messages', type=int, default=20, help='Сообщений в каждую комнату')
+        parser.add_argument('--interval-ms', type=int, default=10, help='Пауза между сообщениями')
+        parser.add_argument('--timeout', type=int, default=30, help='Сколько секунд ждать доставки')
+        parser.add_argument('--in-memory', action='store_true',
+                            help='InMemoryChannelLayer вместо Redis (присутствие и поток чата все равно в Redis)')
+        parser.add_argument('--no-memory', action='store_true', help='Не измерять память через tracemalloc')
+        parser.add_argument('--json', action='store_true', help='Вывести отчет в JSON')
+        # пороги: если хотя бы один превышен, команда завершается с ошибкой
+        parser.add_argument('--max-connect-p95-ms', type=float)
+        parser.add_argument('--max-fanout-p95-ms', type=float)
+        parser.add_argument('--max-notify-p95-ms', type=float)
+        parser.add_argument('--max-kb-per-connection', type=float)
+        parser.add_argument('--max-lost', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # прогон создает пользователей и заказы, поэтому идет во временной
+        # тестовой базе данных, а не в рабочей
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            report = self.run_load_test(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_report(report)
+
+        failures = self.check_limits(report, options)
+        if failures:
+            raise CommandError('Превышены пороги: %s' % '; '.join(failures))
+
+    def run_load_test(self, options):
+        with override_settings(**({'CHANNEL_LAYERS': IN_MEMORY_LAYERS} if options['in_memory'] else {})):
+            loop = asyncio.get_event_loop()
+            try:
+                report = loop.run_until_complete(loadtest.run(chats=options['chats'],
+                                                              rooms=options['rooms'],
+                                                              streams=options['streams'],
+                                                              messages=options['messages'],
+                                                              interval_ms=options['interval_ms'],
+                                                              trace_memory=not options['no_memory'],
+                                                              timeout=options['timeout']))
+            finally:
+                loop.run_until_complete(presence.close_hub())
+                loop.run_until_complete(close_redis())
+        return report
+
+    def write_report(self, report):
+        for name in ('chat', 'notify'):
+            section = report[name]
+            self.stdout.write('%s: %s' % (name, format_values(
+                (key, value) for key, value in section.items() if not isinstance(value, dict))))
+            for key in ('connect_ms', 'fanout_ms'):
+                self.stdout.write('  %s: %s' % (key, format_values(section[key].items())))
+
+    def check_limits(self, report, options):
+        chat, notify = report['chat'], report['notify']
+        limits = [
+            ('connect p95', [chat['connect_ms']['p95'], notify['connect_ms']['p95']],
+             options['max_connect_p95_ms']),
+            ('chat fan-out p95', [chat['fanout_ms']['p95']], options['max_fanout_p95_ms']),
+            ('notify fan-out p95', [notify['fanout_ms']['p95']], options['max_notify_p95_ms']),
+            ('KB per connection', [chat.get('kb_per_connection'), notify.get('kb_per_connection')],
+             options['max_kb_per_connection']),
+            ('lost messages and connections', [chat['lost'] + chat['failed'], notify['lost'] + notify['failed']],
+             options['max_lost']),
+        ]
+        failures = []
+        for name, values, limit in limits:
+            if limit is None:
+                continue
+            for value in values:
+                if value is not None and value > limit:
+                    failures.append('%s %.1f > %s' % (name, value, limit))
+        return failures
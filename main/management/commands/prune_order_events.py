@@ -0,0 +1,17 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from main import models
+
+
+class Command(BaseCommand):
+    help = 'Удаление старых событий статусов заказов мобильного приложения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ORDER_EVENTS_RETENTION_DAYS)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        count = models.OrderStatusEvent.objects.prune(before)
+        self.stdout.write("Удалено событий: %d" % count)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main import models
+
+
+class Command(BaseCommand):
+    help = 'Пересчет дневной таблицы продаж продуктов из строк заказов'
+
+    def handle(self, *args, **options):
+        self.stdout.write("Пересчет таблицы продаж")
+        facts = models.ProductSalesDay.objects.facts(models.OrderLine.objects.all())
+        with transaction.atomic():
+            models.ProductSalesDay.objects.all().delete()
+            models.ProductSalesDay.objects.bulk_create(facts, batch_size=1000)
+        self.stdout.write("Записано строк=%d" % len(facts))
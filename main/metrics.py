@@ -0,0 +1,192 @@
+import asyncio
+from bisect import bisect_left
+import functools
+import hmac
+import logging
+import threading
+import time
+import weakref
+from channels.db import database_sync_to_async as channels_database_sync_to_async
+from django.conf import settings
+
+from .redis_pool import pool_stats
+
+logger = logging.getLogger(__name__)
+
+# Метрики процесса для поиска причин задержек в чатах: время обработчиков
+# потребителей, ожидание свободного потока для запросов к базе данных и его
+# выполнение, задержка цикла событий. Все хранится в памяти процесса и
+# отдается потребителем MetricsConsumer в текстовом формате Prometheus.
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_monitors = weakref.WeakKeyDictionary()
+
+
+class Histogram:
+    """
+    Гистограмма в духе Prometheus: количество наблюдений по корзинам,
+    их сумма и количество, отдельно для каждого набора значений меток.
+    Наблюдения приходят и из цикла событий, и из потоков базы данных.
+    """
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # по корзине на каждую границу и одна для +Inf, затем сумма
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def count(self, *labels):
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s histogram' % self.name]
+        with self.lock:
+            values = sorted((labels, list(counts)) for labels, counts in self.values.items())
+        for labels, counts in values:
+            pairs = list(zip(self.labelnames, labels))
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(pairs + [('le', bound)]), total))
+            lines.append('%s_sum%s %r' % (self.name, format_labels(pairs), counts[-1]))
+            lines.append('%s_count%s %d' % (self.name, format_labels(pairs), total))
+        return lines
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+HANDLER_SECONDS = Histogram('booktime_consumer_handler_seconds',
+                            'Time spent in consumer handlers.', ('consumer', 'handler'))
+DB_WAIT_SECONDS = Histogram('booktime_db_thread_wait_seconds',
+                            'Time database_sync_to_async calls wait for a free thread.', ('function',))
+DB_RUN_SECONDS = Histogram('booktime_db_thread_run_seconds',
+                           'Time database_sync_to_async calls run in the thread.', ('function',))
+LOOP_LAG_SECONDS = Histogram('booktime_event_loop_lag_seconds',
+                             'How late the event loop wakes up a sleeping task.')
+HISTOGRAMS = (HANDLER_SECONDS, DB_WAIT_SECONDS, DB_RUN_SECONDS, LOOP_LAG_SECONDS)
+
+
+def timed(consumer, handler, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start_monitor()
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, consumer, handler)
+    return wrapper
+
+
+def instrument(*handlers):
+    """
+    Декоратор класса потребителя: замеряет время перечисленных
+    асинхронных обработчиков (connect, receive_json, обработчики
+    сообщений группы и т.д.) и запускает наблюдение за циклом событий.
+    """
+    def decorate(cls):
+        for handler in handlers:
+            setattr(cls, handler, timed(cls.__name__, handler, getattr(cls, handler)))
+        return cls
+    return decorate
+
+
+def database_sync_to_async(func):
+    """
+    database_sync_to_async из channels, который отдельно замеряет ожидание
+    свободного потока и выполнение функции в нем.
+    """
+    name = getattr(func, '__name__', repr(func))
+
+    def run(queued, *args, **kwargs):
+        started = time.perf_counter()
+        DB_WAIT_SECONDS.observe(started - queued, name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_RUN_SECONDS.observe(time.perf_counter() - started, name)
+
+    run = channels_database_sync_to_async(run)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(time.perf_counter(), *args, **kwargs)
+    return wrapper
+
+
+async def monitor_loop(loop):
+    """
+    Засыпает на METRICS_LOOP_LAG_INTERVAL секунд и записывает, насколько
+    позже цикл событий ее разбудил: это время, когда цикл был занят.
+    """
+    while True:
+        interval = settings.METRICS_LOOP_LAG_INTERVAL
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(loop.time() - expected, 0))
+
+
+def start_monitor():
+    loop = asyncio.get_event_loop()
+    task = _monitors.get(loop)
+    if task is None or task.done():
+        _monitors[loop] = loop.create_task(monitor_loop(loop))
+
+
+async def stop_monitor():
+    """
+    Останавливает наблюдение за текущим циклом событий. Вызывается при остановке сервера.
+    """
+    task = _monitors.pop(asyncio.get_event_loop(), None)
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def authorized(headers):
+    """
+    Проверяет заголовок Authorization запроса метрик (заголовки ASGI в
+    виде словаря) на совпадение с METRICS_TOKEN.
+    """
+    if not settings.METRICS_TOKEN:
+        return False
+    expected = b'Bearer ' + settings.METRICS_TOKEN.encode('utf8')
+    return hmac.compare_digest(headers.get(b'authorization', b''), expected)
+
+
+def exposition():
+    """Все метрики процесса в текстовом формате Prometheus."""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.expose())
+    lines.append('# HELP booktime_redis_pool_connections Connections of the shared Redis pools.')
+    lines.append('# TYPE booktime_redis_pool_connections gauge')
+    stats = pool_stats()
+    for state in ('size', 'freesize', 'in_use', 'maxsize'):
+        lines.append('booktime_redis_pool_connections%s %d' % (format_labels([('state', state)]), stats[state]))
+    lines.append('# HELP booktime_redis_pools Open shared Redis pools (one per event loop).')
+    lines.append('# TYPE booktime_redis_pools gauge')
+    lines.append('booktime_redis_pools %d' % stats['pools'])
+    return '\n'.join(lines) + '\n'
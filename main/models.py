@@ -1,7 +1,11 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
 from django.contrib.auth.models import (AbstractUser, BaseUserManager)
 from django.core.validators import MinValueValidator
+from django.utils import timezone
 
+from collections import Counter
 import logging
 
 logger = logging.getLogger(__name__)
@@ -89,15 +93,42 @@ class User(AbstractUser):
 
     objects = UserManager()
 
+    EMPLOYEES = 'Employees'
+    DISPATCHERS = 'Dispatchers'
+
+    @classmethod
+    def in_group_query(cls, user_id, group_name):
+        """
+        Членство пользователя в группе: .exists() для проверки или
+        Exists() в запросах других моделей (ChatConsumer.get_user_type).
+        """
+        return cls.groups.through.objects.filter(user_id=user_id, group__name=group_name)
+
+    def has_role(self, group_name, in_group=None):
+        """
+        Роль есть у активного суперпользователя и у активного сотрудника
+        (is_staff) из группы роли. Если членство in_group уже известно,
+        оно не запрашивается, иначе запрашивается, только когда нужно.
+        """
+        if not self.is_active:
+            return False
+        if self.is_superuser:
+            return True
+        if not self.is_staff:
+            return False
+        if in_group is None:
+            in_group = self.in_group_query(self.pk, group_name).exists()
+        return bool(in_group)
+
     @property
     def is_employee(self):
         """сотрудники"""
-        return self.is_active and (self.is_superuser or self.is_staff and self.groups.filter(name='Employees').exists())
+        return self.has_role(self.EMPLOYEES)
 
     @property
     def is_dispatcher(self):
         """диспетчеры"""
-        return self.is_active and (self.is_superuser or self.is_staff and self.groups.filter(name='Dispatchers').exists())
+        return self.has_role(self.DISPATCHERS)
 
 
 class Address(models.Model):
@@ -210,30 +241,27 @@ class Order(models.Model):
 
     @property
     def mobile_thumb_url(self):
-        products = [i.product for i in self.lines.all()]
-        if products:
-            img = products[0].productimage_set.first()
-            if img:
-                return img.thumbnail.url
+        lines = self.lines.all()
+        if lines:
+            images = lines[0].product.productimage_set.all()
+            if images:
+                return images[0].thumbnail.url
 
     @property
     def summary(self):
-        product_counts = self.lines.values(
-            "product__name"
-        ).annotate(c=Count("product__name"))
+        product_counts = Counter(line.product.name for line in self.lines.all())
         pieces = []
-        for pc in product_counts:
+        for name, c in product_counts.items():
             pieces.append(
-                "%s x %s" % (pc["c"], pc["product__name"])
+                "%s x %s" % (c, name)
             )
         return ", ".join(pieces)
 
     @property
     def total_price(self):
-        res = self.lines.aggregate(
-            total_price=Sum("product__price")
-        )
-        return res["total_price"]
+        lines = self.lines.all()
+        if lines:
+            return sum(line.product.price for line in lines)
 
 
 class OrderLine(models.Model):
@@ -250,3 +278,125 @@ class OrderLine(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='lines')
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     status = models.IntegerField(choices=STATUSES, default=NEW)
+
+
+class ChatMessage(models.Model):
+    """
+    Сообщение чата службы поддержки по заказу. Записывается не сразу,
+    а пачками через буфер main/chatlog.py, поэтому дата берется в момент
+    получения сообщения, а не сохранения строки.
+    """
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='chat_messages')
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    username = models.CharField(max_length=150)
+    message = models.TextField()
+    date_added = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # история читается по заказу от последних сообщений к первым
+        index_together = (('order', 'id'),)
+
+
+class OrderStatusEventManager(models.Manager):
+    def prune(self, before):
+        """Удаляет события старше before, возвращает их количество."""
+        return self.filter(date_added__lt=before).delete()[0]
+
+
+class OrderStatusEvent(models.Model):
+    """
+    Изменение статуса заказа или строки заказа для потока событий мобильного
+    приложения. Записывается в той же транзакции, что и само изменение,
+    а id служит курсором, с которого переподключившийся клиент продолжает поток.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='order_events')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='status_events')
+    line_id = models.IntegerField(null=True, blank=True)
+    status = models.IntegerField()
+    date_added = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = OrderStatusEventManager()
+
+    class Meta:
+        # поток читается по пользователю начиная с id
+        index_together = (('user', 'id'),)
+
+
+class ProductSalesDayManager(models.Manager):
+    def record(self, product_id, day, units=1, revenue=0):
+        """
+        Инкрементально обновляет дневную строку продаж продукта.
+        Сначала пробуем UPDATE с F()-выражениями, и только если строки
+        за этот день еще нет, создаем ее. revenue может быть выражением.
+        """
+        lookup = self.filter(product_id=product_id, day=day)
+        if lookup.update(units=F('units') + units, revenue=F('revenue') + revenue):
+            return
+        try:
+            with transaction.atomic():
+                self.create(product_id=product_id, day=day, units=units, revenue=revenue)
+        except IntegrityError:
+            # строку успел создать параллельный запрос
+            lookup.update(units=F('units') + units, revenue=F('revenue') + revenue)
+
+    def facts(self, lines):
+        """Строки продаж, посчитанные заново по строкам заказов lines."""
+        rows = (lines
+                .annotate(day=TruncDate('order__date_added'))
+                .values('product_id', 'day')
+                .annotate(units=Count('id'), revenue=Sum('product__price'))
+                .order_by())
+        return [self.model(product_id=row['product_id'], day=row['day'],
+                           units=row['units'], revenue=row['revenue'])
+                for row in rows]
+
+    def rebuild(self, product_ids, days):
+        """
+        Пересчитывает продажи продуктов за дни из строк заказов. Нужен,
+        когда строку нельзя поправить на единицу: у строки заказа сменился
+        продукт или у заказа - дата.
+        """
+        facts = self.facts(OrderLine.objects.filter(product_id__in=product_ids,
+                                                    order__date_added__date__in=days))
+        with transaction.atomic():
+            self.filter(product_id__in=product_ids, day__in=days).delete()
+            self.bulk_create(facts)
+
+    def window(self, since, until=None):
+        # since и until входят в окно (см. admin.period_start)
+        qs = self.filter(day__gte=since)
+        if until:
+            qs = qs.filter(day__lte=until)
+        return qs
+
+    def top(self, since, until=None, by='units', limit=None):
+        """
+        Рейтинг продуктов за окно дней, посчитанный в базе данных.
+        by - 'units' (количество продаж) или 'revenue' (выручка).
+        """
+        if by not in ('units', 'revenue'):
+            raise ValueError('Unknown ranking %r' % by)
+        qs = (self.window(since, until)
+              .values('product_id', 'product__name')
+              .annotate(units=Sum('units'), revenue=Sum('revenue'))
+              .order_by('-%s' % by, 'product__name'))
+        if limit:
+            qs = qs[:limit]
+        return qs
+
+
+class ProductSalesDay(models.Model):
+    """
+    Таблица фактов: продажи одного продукта за один день.
+    Поддерживается сигналами OrderLine, поэтому любое окно отчета -
+    это сумма по небольшому диапазону дней, а не JOIN по всем строкам заказов.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='sales_days')
+    day = models.DateField(db_index=True)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    objects = ProductSalesDayManager()
+
+    class Meta:
+        unique_together = (('product', 'day'),)
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import logging
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.utils.functional import cached_property
+
+logger = logging.getLogger(__name__)
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Пагинатор для больших списков изменений админки. Вместо COUNT(*)
+    на каждой странице он берет оценку планировщика PostgreSQL (pg_class
+    для таблицы без фильтров, EXPLAIN для отфильтрованного запроса).
+    Если оценка ниже threshold, или база данных не PostgreSQL, выполняется
+    точный подсчет. Оценка или точное число больше threshold кэшируются
+    на cache_timeout секунд, поэтому повторные страницы больших списков
+    не делают запросов, а небольшие списки всегда показывают точное число.
+    """
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True,
+                 threshold=10000, cache_timeout=60):
+        super().__init__(object_list, per_page, orphans, allow_empty_first_page)
+        self.threshold = threshold
+        self.cache_timeout = cache_timeout
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None:
+            return super().count
+        try:
+            sql, params = query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        key = 'paginator-count-%s' % hashlib.md5(
+            ('%s|%s|%r' % (self.object_list.db, sql, params)).encode('utf8')
+        ).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = self.estimate()
+            if count is None or count <= self.threshold:
+                count = self.object_list.count()
+            if count > self.threshold:
+                cache.set(key, count, self.cache_timeout)
+        return count
+
+    def estimate(self):
+        queryset = self.object_list
+        query = queryset.query
+        if connections[queryset.db].vendor != 'postgresql':
+            return None
+        with connections[queryset.db].cursor() as cursor:
+            if not query.where:
+                cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s",
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+                if not row or row[0] < 0:
+                    return None
+                estimate = int(row[0])
+            else:
+                sql, params = query.sql_with_params()
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                estimate = int(plan[0]['Plan']['Plan Rows'])
+        logger.debug('Estimated %d rows for %s changelist', estimate, queryset.model._meta.label)
+        return estimate
@@ -0,0 +1,290 @@
+import asyncio
+from collections import deque
+import json
+import logging
+import time
+import uuid
+import weakref
+from aioredis.pubsub import Receiver
+from django.urls import reverse
+
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Присутствие в чатах хранится в сортированных множествах:
+#   presence:order:<заказ> - email участников со временем последнего heartbeat,
+#   presence:orders        - индекс заказов со временем последнего heartbeat в чате.
+# Участник считается присутствующим PRESENCE_TTL секунд после heartbeat.
+# Список активных чатов читается по индексу, без перебора ключей.
+# О появлении участника сообщается публикацией в PRESENCE_CHANNEL, устаревшие
+# записи раз в PRESENCE_SWEEP_INTERVAL секунд удаляет PresenceHub, который тоже
+# публикует об этом в PRESENCE_CHANNEL.
+PRESENCE_TTL = 10
+PRESENCE_ORDER_KEY = 'presence:order:%s'
+PRESENCE_INDEX_KEY = 'presence:orders'
+PRESENCE_CHANNEL = 'customer-service-presence'
+
+PRESENCE_COALESCE = 0.1
+PRESENCE_SWEEP_INTERVAL = 1
+PRESENCE_BACKLOG = 256
+PRESENCE_QUEUE_SIZE = 100
+PRESENCE_KEEPALIVE = 30
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+async def heartbeat(order_id, email):
+    """
+    Продлевает присутствие пользователя в чате заказа. Все команды
+    отправляются в Redis одним конвейером; публикация происходит
+    только когда пользователь появился в чате.
+    """
+    redis = await get_redis()
+    now = time.time()
+    key = PRESENCE_ORDER_KEY % order_id
+    pipe = redis.pipeline()
+    added = pipe.zadd(key, now, email)
+    pipe.expire(key, PRESENCE_TTL)
+    pipe.zadd(PRESENCE_INDEX_KEY, now, order_id)
+    pipe.expire(PRESENCE_INDEX_KEY, PRESENCE_TTL)
+    await pipe.execute()
+    if await added:
+        await redis.publish(PRESENCE_CHANNEL, 'join')
+
+
+async def leave(order_id, email):
+    redis = await get_redis()
+    if await redis.zrem(PRESENCE_ORDER_KEY % order_id, email):
+        await redis.publish(PRESENCE_CHANNEL, 'leave')
+
+
+async def active_chats():
+    """
+    Словарь {id заказа: [email, ...]} чатов, в которых кто-то есть.
+    Читаются только индекс и множества активных заказов.
+    """
+    redis = await get_redis()
+    cutoff = time.time() - PRESENCE_TTL
+    order_ids = await redis.zrangebyscore(PRESENCE_INDEX_KEY, min=cutoff, exclude=redis.ZSET_EXCLUDE_MIN)
+    if not order_ids:
+        return {}
+    pipe = redis.pipeline()
+    members = [pipe.zrangebyscore(PRESENCE_ORDER_KEY % order_id.decode('utf8'),
+                                  min=cutoff, exclude=redis.ZSET_EXCLUDE_MIN, encoding='utf8')
+               for order_id in order_ids]
+    await pipe.execute()
+    presences = {}
+    for order_id, emails in zip(order_ids, members):
+        emails = await emails
+        if emails:
+            presences[int(order_id)] = emails
+    return presences
+
+
+async def sweep():
+    """
+    Удаляет участников, от которых давно не было heartbeat, и заказы
+    без участников из индекса. Если что-то удалено, публикует изменение.
+    """
+    redis = await get_redis()
+    cutoff = time.time() - PRESENCE_TTL
+    order_ids = await redis.zrange(PRESENCE_INDEX_KEY)
+    pipe = redis.pipeline()
+    removed = [pipe.zremrangebyscore(PRESENCE_ORDER_KEY % order_id.decode('utf8'), max=cutoff)
+               for order_id in order_ids]
+    pipe.zremrangebyscore(PRESENCE_INDEX_KEY, max=cutoff)
+    await pipe.execute()
+    count = 0
+    for future in removed:
+        count += await future
+    if count:
+        await redis.publish(PRESENCE_CHANNEL, 'leave')
+    return count
+
+
+def presence_data(presences):
+    return [{'link': reverse('cs_chat', kwargs={'order_id': order_id}),
+             'text': '%s (%s)' % (order_id, ', '.join(sorted(emails)))}
+            for order_id, emails in sorted(presences.items())]
+
+
+class PresenceHub:
+    """
+    Один на процесс (точнее, на цикл событий) источник присутствия для
+    SSE-потоков. Хаб подписан на изменения присутствия в Redis и по каждому
+    изменению один раз сравнивает новый список чатов с предыдущим. Разница
+    кодируется в SSE-события join/leave с последовательными id, и одни и те же
+    байты раздаются всем подписчикам. Новый подписчик получает один снимок
+    состояния (snapshot), а переподключившийся с Last-Event-ID - только
+    пропущенные события из журнала последних PRESENCE_BACKLOG событий.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.subscribers = set()
+        self.state = None
+        self.snapshot = None
+        # id событий уникальны только в пределах хаба, поэтому включают его эпоху
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.backlog = deque(maxlen=PRESENCE_BACKLOG)
+        self.lock = asyncio.Lock()
+        self.ready = loop.create_future()
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        try:
+            redis = await get_redis()
+            receiver = Receiver()
+            await redis.subscribe(receiver.channel(PRESENCE_CHANNEL))
+        except Exception as e:
+            self.ready.set_exception(e)
+            raise
+        self.ready.set_result(True)
+        next_sweep = self.loop.time()
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(receiver.get(), max(next_sweep - self.loop.time(), 0))
+                except asyncio.TimeoutError:
+                    next_sweep = self.loop.time() + PRESENCE_SWEEP_INTERVAL
+                    # об удаленных записях хаб узнает из собственной публикации
+                    await sweep()
+                    continue
+                if message is None:
+                    # пул соединений закрыт
+                    break
+                # изменения, пришедшие почти одновременно, рассылаются одним событием
+                if not await self.coalesce(receiver):
+                    break
+                await self.refresh()
+        except Exception:
+            logger.exception('Presence hub failed')
+        finally:
+            receiver.stop()
+            if not redis.closed:
+                # соединение pub/sub общее для пула и переживает хаб
+                await asyncio.shield(redis.unsubscribe(PRESENCE_CHANNEL))
+
+    async def coalesce(self, receiver):
+        deadline = self.loop.time() + PRESENCE_COALESCE
+        while True:
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                return True
+            try:
+                if await asyncio.wait_for(receiver.get(), timeout) is None:
+                    return False
+            except asyncio.TimeoutError:
+                return True
+
+    async def refresh(self):
+        async with self.lock:
+            chats = await active_chats()
+            state = {order_id: set(emails) for order_id, emails in chats.items()}
+            if self.state is None:
+                self.state = state
+                return
+            events = []
+            for order_id in sorted(set(self.state) | set(state)):
+                old = self.state.get(order_id, set())
+                new = state.get(order_id, set())
+                for email in sorted(new - old):
+                    events.append(('join', {'order_id': order_id,
+                                            'link': reverse('cs_chat', kwargs={'order_id': order_id}),
+                                            'email': email}))
+                for email in sorted(old - new):
+                    events.append(('leave', {'order_id': order_id, 'email': email}))
+            self.state = state
+            if not events:
+                return
+            self.snapshot = None
+            logger.info('Broadcasting %d presence events to %d streams', len(events), len(self.subscribers))
+            for event, data in events:
+                self.seq += 1
+                payload = encode_event(self.event_id(self.seq), event, data)
+                self.backlog.append((self.seq, payload))
+                for queue in list(self.subscribers):
+                    self.offer(queue, payload)
+
+    def event_id(self, seq):
+        return '%s-%d' % (self.epoch, seq)
+
+    def snapshot_event(self):
+        if self.snapshot is None:
+            data = [{'order_id': order_id,
+                     'link': reverse('cs_chat', kwargs={'order_id': order_id}),
+                     'emails': sorted(emails)}
+                    for order_id, emails in sorted(self.state.items())]
+            self.snapshot = encode_event(self.event_id(self.seq), 'snapshot', data)
+        return self.snapshot
+
+    def missed_events(self, last_event_id):
+        """
+        События после last_event_id, или None, если они не могут быть
+        восстановлены (id другого хаба или события уже вытеснены из журнала).
+        """
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        seq = int(seq)
+        first = self.backlog[0][0] if self.backlog else self.seq + 1
+        if seq < first - 1:
+            return None
+        return [payload for event_seq, payload in self.backlog if event_seq > seq]
+
+    def offer(self, queue, payload):
+        # отставший клиент получает снимок вместо накопившихся событий
+        if queue.qsize() >= PRESENCE_QUEUE_SIZE:
+            while not queue.empty():
+                queue.get_nowait()
+            payload = self.snapshot_event()
+        queue.put_nowait(payload)
+
+    async def subscribe(self, last_event_id=None):
+        """
+        Возвращает очередь, в которую будут приходить SSE-события. В ней сразу
+        лежат пропущенные после last_event_id события или снимок состояния.
+        """
+        await asyncio.shield(self.ready)
+        if self.state is None:
+            await self.refresh()
+        queue = asyncio.Queue()
+        missed = self.missed_events(last_event_id)
+        for payload in (missed if missed is not None else [self.snapshot_event()]):
+            queue.put_nowait(payload)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+
+def encode_event(event_id, event, data):
+    return ("id: %s\nevent: %s\ndata: %s\n\n" % (event_id, event, json.dumps(data))).encode("utf-8")
+
+
+def encode_presence(data):
+    return ("data: %s\n\n" % json.dumps(data)).encode("utf-8")
+
+
+def get_hub():
+    loop = asyncio.get_event_loop()
+    hub = _hubs.get(loop)
+    if hub is None or hub.task.done():
+        hub = _hubs[loop] = PresenceHub(loop)
+    return hub
+
+
+async def close_hub():
+    """
+    Останавливает хаб текущего цикла событий. Вызывается при остановке сервера.
+    """
+    hub = _hubs.pop(asyncio.get_event_loop(), None)
+    if hub is None:
+        return
+    hub.task.cancel()
+    try:
+        await hub.task
+    except asyncio.CancelledError:
+        pass
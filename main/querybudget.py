@@ -0,0 +1,56 @@
+from contextlib import ContextDecorator
+import logging
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class query_budget(ContextDecorator):
+    """
+    Ограничивает количество SQL-запросов внутри блока кода.
+    Работает и как контекстный менеджер, и как декоратор:
+
+        with query_budget(5):
+            client.get(url)
+
+        @query_budget(3, label='my_orders')
+        def my_orders(request): ...
+
+    Если запросов больше max_queries, выбрасывается QueryBudgetExceeded
+    со списком выполненных запросов (или, при raise_exception=False,
+    пишется предупреждение в лог). Предназначен в первую очередь для тестов,
+    потому что записывает все запросы соединения.
+    """
+    def __init__(self, max_queries, using=DEFAULT_DB_ALIAS, label=None, raise_exception=True):
+        self.max_queries = max_queries
+        self.using = using
+        self.label = label
+        self.raise_exception = raise_exception
+        self.captured = None
+
+    def __enter__(self):
+        self.captured = CaptureQueriesContext(connections[self.using])
+        self.captured.__enter__()
+        return self.captured
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.captured.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return False
+        executed = len(self.captured)
+        if executed > self.max_queries:
+            message = "%s executed %d queries, budget is %d:\n%s" % (
+                self.label or "Block",
+                executed,
+                self.max_queries,
+                "\n".join("%d. %s" % (i, query["sql"]) for i, query in enumerate(self.captured.captured_queries, start=1)),
+            )
+            if self.raise_exception:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return False
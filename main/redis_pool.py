@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import weakref
+import aioredis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Пул соединений создается при первом обращении, отдельно для каждого
+# цикла событий: соединения aioredis привязаны к циклу, в котором открыты.
+_pools = weakref.WeakKeyDictionary()
+
+
+async def _create_pool():
+    pool = await aioredis.create_redis_pool(settings.REDIS_URL,
+                                            minsize=settings.REDIS_POOL_MINSIZE,
+                                            maxsize=settings.REDIS_POOL_MAXSIZE)
+    logger.info('Opened Redis pool (minsize %d, maxsize %d)',
+                settings.REDIS_POOL_MINSIZE,
+                settings.REDIS_POOL_MAXSIZE)
+    return pool
+
+
+async def get_redis():
+    """
+    Возвращает общий пул соединений с Redis для текущего цикла событий.
+    Потребители не закрывают его сами: команды берут свободное соединение
+    из пула и сразу возвращают его, поэтому количество соединений ограничено
+    REDIS_POOL_MAXSIZE независимо от числа открытых чатов.
+    """
+    loop = asyncio.get_event_loop()
+    task = _pools.get(loop)
+    if task is not None and task.done() and (task.cancelled()
+                                             or task.exception() is not None
+                                             or task.result().closed):
+        task = None
+    if task is None:
+        # пока пул создается, остальные потребители ждут ту же задачу
+        task = loop.create_task(_create_pool())
+        _pools[loop] = task
+    return await asyncio.shield(task)
+
+
+async def close_redis():
+    """
+    Закрывает пул текущего цикла событий. Вызывается при остановке сервера.
+    """
+    task = _pools.pop(asyncio.get_event_loop(), None)
+    if task is None:
+        return
+    try:
+        pool = await task
+    except Exception:
+        return
+    pool.close()
+    await pool.wait_closed()
+    logger.info('Closed Redis pool')
+
+
+def pool_stats():
+    """
+    Использование пулов процесса: сколько соединений открыто (size),
+    сколько из них свободно (freesize) и занято (in_use), и предел (maxsize).
+    """
+    stats = {'pools': 0, 'size': 0, 'freesize': 0, 'in_use': 0, 'maxsize': 0}
+    for task in list(_pools.values()):
+        if not task.done() or task.cancelled() or task.exception() is not None:
+            continue
+        pool = task.result().connection
+        if pool.closed:
+            continue
+        stats['pools'] += 1
+        stats['size'] += pool.size
+        stats['freesize'] += pool.freesize
+        stats['in_use'] += pool.size - pool.freesize
+        stats['maxsize'] += pool.maxsize
+    return stats
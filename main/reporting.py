@@ -0,0 +1,335 @@
+from datetime import date, timedelta
+import json
+import logging
+import os
+import tempfile
+import uuid
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+import numpy as np
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# Куб хранится в каталоге: метаданные в CUBE_META, массивы - в несжатых
+# файлах <имя>.<версия>.npy, которые отображаются в память процессов.
+CUBE_META = 'cube.json'
+
+
+class SalesCube:
+    """
+    Компактный куб продаж: массивы NumPy с измерениями (день, продукт,
+    страна доставки) за последние REPORTING_CUBE_DAYS дней и только по
+    продуктам, которые продавались в этом окне. Теги продуктов хранятся
+    отдельной матрицей принадлежности (тег x продукт), потому что у продукта
+    может быть несколько тегов. Срезы и свертки по любому набору
+    измерений выполняются векторно, без запросов к базе данных.
+    """
+    MEASURES = ('units', 'revenue')
+    ARRAYS = ('units', 'revenue', 'tag_matrix')
+    DIMENSIONS = ('day', 'week', 'month', 'product', 'tag', 'country')
+    PERIODS = ('day', 'week', 'month')
+
+    def __init__(self, start, product_ids, product_names, countries,
+                 tag_ids, tag_names, tag_matrix, units, revenue):
+        self.start = start
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.product_names = np.asarray(product_names, dtype=str)
+        self.countries = np.asarray(countries, dtype=str)
+        self.tag_ids = np.asarray(tag_ids, dtype=np.int64)
+        self.tag_names = np.asarray(tag_names, dtype=str)
+        self.tag_matrix = np.asarray(tag_matrix, dtype=bool).reshape(len(self.tag_ids), len(self.product_ids))
+        self.units = np.asarray(units, dtype=np.int32)
+        self.revenue = np.asarray(revenue, dtype=np.float64)
+
+    @property
+    def days(self):
+        return self.units.shape[0]
+
+    @property
+    def end(self):
+        return self.start + timedelta(days=self.days - 1)
+
+    @classmethod
+    def build(cls, until=None, days=None):
+        """
+        Строит куб из Order/OrderLine за days дней до until включительно.
+        Группировка по дню, продукту и стране выполняется в базе данных,
+        поэтому в Python приходит одна строка на ячейку. Измерение продуктов
+        берется из тех же строк, а не отдельным запросом, поэтому продукт,
+        созданный во время построения, не ломает индексы.
+        """
+        until = until or date.today()
+        days = days or settings.REPORTING_CUBE_DAYS
+        rows = list(models.OrderLine.objects
+                    .filter(order__date_added__date__gt=until - timedelta(days=days),
+                            order__date_added__date__lte=until)
+                    .annotate(day=TruncDate('order__date_added'))
+                    .values_list('day', 'product_id', 'order__shipping_country')
+                    .annotate(units=Count('id'), revenue=Sum('product__price'))
+                    .order_by())
+        start = min([row[0] for row in rows] + [until])
+
+        product_ids = sorted({row[1] for row in rows})
+        names = dict(models.Product.objects.filter(pk__in=product_ids).values_list('id', 'name'))
+        tags = list(models.ProductTag.objects.order_by('id').values_list('id', 'name'))
+        countries = sorted({code for code, _ in models.Address.SUPPORTED_COUNTRIES} | {row[2] for row in rows})
+
+        product_index = {pk: i for i, pk in enumerate(product_ids)}
+        tag_index = {pk: i for i, (pk, _) in enumerate(tags)}
+        country_index = {code: i for i, code in enumerate(countries)}
+
+        shape = ((until - start).days + 1, len(product_ids), len(countries))
+        units = np.zeros(shape, dtype=np.int32)
+        revenue = np.zeros(shape, dtype=np.float64)
+        if rows:
+            cells = (np.array([(row[0] - start).days for row in rows]),
+                     np.array([product_index[row[1]] for row in rows]),
+                     np.array([country_index[row[2]] for row in rows]))
+            np.add.at(units, cells, [row[3] for row in rows])
+            np.add.at(revenue, cells, [float(row[4]) for row in rows])
+
+        tag_matrix = np.zeros((len(tags), len(product_ids)), dtype=bool)
+        memberships = (models.Product.tags.through.objects
+                       .filter(product_id__in=product_ids)
+                       .values_list('producttag_id', 'product_id'))
+        for tag_id, product_id in memberships:
+            # тег, созданный во время построения, в куб не попадает
+            if tag_id in tag_index:
+                tag_matrix[tag_index[tag_id], product_index[product_id]] = True
+
+        logger.info('Built sales cube with shape %s from %d cells', shape, len(rows))
+        return cls(start,
+                   product_ids, [names.get(pk, '#%d' % pk) for pk in product_ids],
+                   countries,
+                   [pk for pk, _ in tags], [name for _, name in tags],
+                   tag_matrix, units, revenue)
+
+    def save(self, path):
+        """
+        Сохраняет куб в каталог path. Массивы пишутся под новой версией,
+        затем атомарно заменяется файл метаданных, поэтому читатели видят
+        либо старый куб, либо новый целиком. Файлы старых версий удаляются:
+        процессы, которые уже отобразили их в память, продолжают их читать.
+        """
+        os.makedirs(path, exist_ok=True)
+        version = uuid.uuid4().hex
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, '%s.%s.npy' % (name, version)), getattr(self, name))
+        meta = {'version': version,
+                'start': self.start.isoformat(),
+                'product_ids': self.product_ids.tolist(),
+                'product_names': self.product_names.tolist(),
+                'countries': self.countries.tolist(),
+                'tag_ids': self.tag_ids.tolist(),
+                'tag_names': self.tag_names.tolist()}
+        with tempfile.NamedTemporaryFile('w', dir=path, suffix='.json', delete=False) as output:
+            json.dump(meta, output)
+        os.replace(output.name, os.path.join(path, CUBE_META))
+        for filename in os.listdir(path):
+            if filename.endswith('.npy') and filename.split('.')[1] != version:
+                os.remove(os.path.join(path, filename))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Загружает куб из каталога. Массивы не читаются в память, а
+        отображаются (mmap_mode='r'), поэтому процессы делят одну копию.
+        """
+        with open(os.path.join(path, CUBE_META)) as meta_file:
+            meta = json.load(meta_file)
+        arrays = {name: np.load(os.path.join(path, '%s.%s.npy' % (name, meta['version'])), mmap_mode='r')
+                  for name in cls.ARRAYS}
+        return cls(date.fromisoformat(meta['start']),
+                   meta['product_ids'], meta['product_names'],
+                   meta['countries'],
+                   meta['tag_ids'], meta['tag_names'],
+                   arrays['tag_matrix'], arrays['units'], arrays['revenue'])
+
+    def _period_starts(self, first, count, period):
+        """
+        Индексы начала каждого периода (неделя с понедельника или месяц)
+        внутри среза из count дней, начинающегося с дня first, и даты начала периодов.
+        """
+        ordinals = first.toordinal() + np.arange(count)
+        if period == 'day':
+            keys = ordinals
+        elif period == 'week':
+            # date.fromordinal(1) - понедельник, поэтому недели выровнены по понедельникам
+            keys = (ordinals - 1) // 7 * 7 + 1
+        else:
+            keys = (np.datetime64(first, 'D') + np.arange(count)).astype('datetime64[M]')
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        if period == 'month':
+            labels = [key.item() for key in keys[starts].astype('datetime64[D]')]
+        else:
+            labels = [date.fromordinal(int(key)) for key in keys[starts]]
+        return starts, labels
+
+    def query(self, measure='revenue', by=(), since=None, until=None,
+              countries=None, tags=None, products=None):
+        """
+        Срез и свертка куба.
+
+        by - измерения, которые остаются в результате (не больше одного
+        периода из day/week/month и не одновременно product и tag).
+        countries, tags, products - фильтры по кодам стран, id тегов и id продуктов.
+        Возвращает список словарей с метками измерений и значением меры.
+        """
+        if measure not in self.MEASURES:
+            raise ValueError('Unknown measure %r' % measure)
+        unknown = set(by) - set(self.DIMENSIONS)
+        if unknown:
+            raise ValueError('Unknown dimensions %s' % ', '.join(sorted(unknown)))
+        periods = [dim for dim in by if dim in self.PERIODS]
+        if len(periods) > 1:
+            raise ValueError('Only one of day/week/month can be used')
+        if 'product' in by and 'tag' in by:
+            raise ValueError('Cannot group by product and tag at the same time')
+
+        first = max(since or self.start, self.start)
+        last = min(until or self.end, self.end)
+        if first > last:
+            return []
+        d0 = (first - self.start).days
+        d1 = (last - self.start).days + 1
+        cube = getattr(self, measure)[d0:d1]
+
+        product_mask = np.ones(len(self.product_ids), dtype=bool)
+        if products is not None:
+            product_mask &= np.isin(self.product_ids, list(products))
+        if tags is not None:
+            tag_mask = np.isin(self.tag_ids, list(tags))
+            product_mask &= self.tag_matrix[tag_mask].any(axis=0)
+        country_mask = np.ones(len(self.countries), dtype=bool)
+        if countries is not None:
+            country_mask &= np.isin(self.countries, list(countries))
+        cube = cube[:, product_mask][:, :, country_mask]
+
+        axes = []
+        labels = []
+        if periods:
+            starts, period_labels = self._period_starts(first, d1 - d0, periods[0])
+            cube = np.add.reduceat(cube, starts, axis=0) if len(starts) else cube[:0]
+            axes.append(periods[0])
+            labels.append([label.isoformat() for label in period_labels])
+        else:
+            cube = cube.sum(axis=0, keepdims=True)
+
+        tag_subset = None
+        if 'tag' in by:
+            # продукт с несколькими тегами учитывается в каждом из них
+            tag_subset = np.isin(self.tag_ids, list(tags)) if tags is not None else slice(None)
+            memberships = self.tag_matrix[tag_subset][:, product_mask].astype(cube.dtype)
+            cube = np.einsum('dpc,tp->dtc', cube, memberships)
+            axes.append('tag')
+            labels.append(list(self.tag_names[tag_subset]))
+        elif 'product' in by:
+            axes.append('product')
+            labels.append(list(self.product_names[product_mask]))
+        else:
+            cube = cube.sum(axis=1, keepdims=True)
+
+        if 'country' in by:
+            axes.append('country')
+            labels.append(list(self.countries[country_mask]))
+        else:
+            cube = cube.sum(axis=2, keepdims=True)
+
+        cube = cube.reshape([len(axis_labels) for axis_labels in labels] or [1])
+        if not axes:
+            return [{measure: self._value(measure, cube.item())}]
+        result = []
+        for index in zip(*np.nonzero(cube)):
+            row = {axis: labels[i][j] for i, (axis, j) in enumerate(zip(axes, index))}
+            row[measure] = self._value(measure, cube[index].item())
+            result.append(row)
+        return result
+
+    @staticmethod
+    def _value(measure, value):
+        if measure == 'units':
+            return int(round(value))
+        return round(value, 2)
+
+
+_cube_cache = {}
+
+
+def get_sales_cube(path=None):
+    """
+    Возвращает куб продаж из каталога REPORTING_CUBE_PATH. Куб кэшируется
+    в процессе и перечитывается только после того, как его перестроили.
+    Куб строится только командой build_sales_cube, а не в запросе:
+    если он еще не построен, возвращается None.
+    """
+    path = path or settings.REPORTING_CUBE_PATH
+    cached = _cube_cache.get(path)
+    try:
+        mtime = os.path.getmtime(os.path.join(path, CUBE_META))
+        if cached is None or cached[0] != mtime:
+            cached = _cube_cache[path] = (mtime, SalesCube.load(path))
+    except FileNotFoundError:
+        # куба нет или его файлы заменили между чтением метаданных и массивов
+        if cached is None:
+            return None
+    return cached[1]
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: выбирает threshold точек ряда так,
+    чтобы сохранить визуальную форму графика (пики и провалы).
+    Возвращает индексы выбранных точек.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    every = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=np.intp)
+    selected[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+
+def bucket_sum(y, threshold):
+    """
+    Агрегация по корзинам: делит ряд на threshold смежных корзин и суммирует
+    значения в каждой. В отличие от LTTB сохраняет итоговую сумму.
+    Возвращает индексы начала корзин и суммы.
+    """
+    n = len(y)
+    if threshold >= n or threshold < 1:
+        return np.arange(n), np.asarray(y)
+    starts = np.unique((np.arange(threshold) * n) // threshold)
+    return starts, np.add.reduceat(np.asarray(y), starts)
+
+
+def downsample(labels, values, points, mode='lttb'):
+    """
+    Уменьшает ряд (labels, values) до points точек методом LTTB
+    или суммированием по корзинам (mode='sum').
+    """
+    if mode == 'sum':
+        starts, sums = bucket_sum(values, points)
+        return [labels[i] for i in starts], sums.tolist()
+    if mode != 'lttb':
+        raise ValueError('Unknown downsampling mode %r' % mode)
+    indices = lttb(np.arange(len(values)), values, points)
+    values = np.asarray(values)
+    return [labels[i] for i in indices], values[indices].tolist()
@@ -5,10 +5,14 @@ from booktime.auth import TokenGetAuthMiddlewareStack
 from . import consumers
 
 websocket_urlpatterns = [
-    path("ws/customer-service/<int:order_id>/", consumers.ChatConsumer)
+    path("ws/customer-service/<int:order_id>/", consumers.ChatConsumer),
+    path("ws/dispatch/orders/", consumers.DispatchConsumer),
+    path("ws/my-orders/events/", consumers.OrderEventsConsumer),
 ]
 
 http_urlpatterns = [
     path('customer-service/notify/', AuthMiddlewareStack(consumers.ChatNotifyConsumer),),
-    path('mobile-api/my-orders/<int:order_id>/tracker/', TokenGetAuthMiddlewareStack(consumers.OrderTrackerConsumer),)
+    path('mobile-api/my-orders/<int:order_id>/tracker/', TokenGetAuthMiddlewareStack(consumers.OrderTrackerConsumer),),
+    path('mobile-api/my-orders/tracker/', TokenGetAuthMiddlewareStack(consumers.BatchOrderTrackerConsumer),),
+    path('metrics/', consumers.MetricsConsumer),
 ]
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import sys
+
+from . import chatlog, metrics, presence, tracking
+from .redis_pool import close_redis
+
+logger = logging.getLogger(__name__)
+
+# Общие ресурсы процесса закрываются при остановке daphne (Procfile).
+# daphne не поддерживает протокол lifespan, но по SIGTERM и SIGINT
+# останавливает реактор Twisted и перед этим ждет обработчики события
+# "before shutdown": к нему и подключается close_resources().
+
+
+async def close_resources():
+    """
+    Дописывает сообщения чата из буфера, закрывает хаб присутствия,
+    сессию сервиса отслеживания, наблюдение за циклом событий и общий
+    пул соединений с Redis.
+    """
+    await chatlog.flush_messages()
+    await presence.close_hub()
+    await tracking.close_tracker()
+    await metrics.stop_monitor()
+    await close_redis()
+
+
+def install(reactor=None):
+    """
+    Регистрирует close_resources() перед остановкой реактора Twisted.
+    Вызывается из booktime/asgi.py; если реактор не установлен (приложение
+    запущено не daphne), ничего не делает и возвращает False.
+    """
+    if reactor is None:
+        reactor = sys.modules.get('twisted.internet.reactor')
+        if reactor is None:
+            return False
+    from twisted.internet import defer
+
+    def before_shutdown():
+        logger.info('Closing shared resources before shutdown')
+        return defer.Deferred.fromFuture(asyncio.ensure_future(close_resources()))
+
+    reactor.addSystemEventTrigger('before', 'shutdown', before_shutdown)
+    return True
@@ -3,11 +3,17 @@ import logging
 from PIL import Image
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.contrib.auth.models import Group, Permission
 from django.contrib.auth.signals import user_logged_in
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete, post_init, m2m_changed
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, Subquery
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
-from .models import ProductImage, Basket, OrderLine, Order
+from booktime.auth import invalidate_token
+from . import authentication, events
+from .invoices import invalidate_invoices
+from .models import ProductImage, Basket, OrderLine, Order, Product, ProductSalesDay, User
 
 THUMBNAIL_SIZE = (300, 300)
 
@@ -58,16 +64,46 @@ def merge_baskets_if_found(sender, user, request, **kwargs):
             logger.info('Assigned user to basket id %d', anonymous_basket.id,)
 
 
+# Изменения статусов заказов и строк публикуются для диспетчеров
+# и владельцев заказов (main/events.py). Статус при загрузке запоминается, чтобы после
+# сохранения сравнить его без дополнительного запроса. Событие строки идет
+# до события заказа, который она завершила (orderline_to_order_status).
+@receiver(post_init, sender=Order)
+@receiver(post_init, sender=OrderLine)
+def remember_status(sender, instance, **kwargs):
+    events.remember_status(instance)
+
+
+@receiver(post_save, sender=Order)
+def order_status_event(sender, instance, created, raw=False, **kwargs):
+    if not raw and events.status_changed(instance, created):
+        events.order_changed(instance, created)
+
+
+# Каждая смена статуса, кроме самого UPDATE, вставляет OrderStatusEvent, а
+# строка, завершившая заказ, - еще UPDATE заказа и его событие. События строки
+# и заказа вставляются одним запросом (events.collect()).
+@receiver(post_save, sender=OrderLine)
+def orderline_status_event(sender, instance, created, raw=False, **kwargs):
+    if raw or not events.status_changed(instance, created):
+        return
+    with events.collect():
+        events.orderline_changed(instance, created)
+        orderline_to_order_status(instance)
+
+
 # Отмеченные заказы больше не отображаются в api списка.
 # чтобы не зависеть от того, как они помечены, через REST API или через администратора Django.
-@receiver(post_save, sender=OrderLine)
-def orderline_to_order_status(sender, instance, **kwargs):
+def orderline_to_order_status(instance):
     """
-    Этот сигнал будет выполнен после сохранения экземпляров модели OrderLine.
-    Первое, что он делает, это проверяет, имеют ли какие-либо строки заказа,
+    Эта функция выполняется после смены статуса строки заказа (OrderLine).
+    Первое, что она делает, это проверяет, имеют ли какие-либо строки заказа,
     связанные с заказом, статусы ниже «sent». Если есть, выполнение прекращается.
     Если под статусом «sent» нет строчки, весь заказ помечается как «done».
+    Уже выполненный заказ повторно не сохраняется.
     """
+    if instance.order.status == Order.DONE:
+        return
     if not instance.order.lines.filter(status__lt=OrderLine.SENT).exists():
         logger.info("All lines for order %d have been processed."
                     "Marking as done.", instance.order.id,)
@@ -75,6 +111,78 @@ def orderline_to_order_status(sender, instance, **kwargs):
         instance.order.save()
 
 
+# Дневная таблица продаж обновляется инкрементально при появлении
+# и удалении строк заказа, чтобы отчеты не агрегировали все OrderLine.
+# Смена продукта строки или даты заказа пересчитывает затронутые дни;
+# прежние значения запоминаются при загрузке, без запроса перед сохранением.
+def sales_day(line):
+    order = line._state.fields_cache.get('order')
+    if order is not None:
+        return order.date_added.date()
+    date_added = Order.objects.filter(pk=line.order_id).values_list('date_added', flat=True).first()
+    return date_added.date() if date_added is not None else None
+
+
+@receiver(post_init, sender=OrderLine)
+def remember_sales_product(sender, instance, **kwargs):
+    instance._saved_product_id = instance.__dict__.get('product_id')
+
+
+@receiver(post_init, sender=Order)
+def remember_sales_date(sender, instance, **kwargs):
+    instance._saved_date_added = instance.__dict__.get('date_added')
+
+
+@receiver(post_save, sender=OrderLine)
+def orderline_to_sales_facts(sender, instance, created, raw=False, **kwargs):
+    old_product_id, instance._saved_product_id = instance._saved_product_id, instance.product_id
+    if raw:
+        return
+    if created:
+        ProductSalesDay.objects.record(instance.product_id,
+                                       sales_day(instance),
+                                       units=1,
+                                       revenue=instance.product.price)
+    elif old_product_id is not None and old_product_id != instance.product_id:
+        ProductSalesDay.objects.rebuild([old_product_id, instance.product_id], [sales_day(instance)])
+
+
+@receiver(post_save, sender=Order)
+def order_to_sales_facts(sender, instance, created, raw=False, **kwargs):
+    old_date, instance._saved_date_added = instance._saved_date_added, instance.date_added
+    if created or raw or old_date is None or old_date.date() == instance.date_added.date():
+        return
+    product_ids = set(instance.lines.values_list('product_id', flat=True))
+    if product_ids:
+        ProductSalesDay.objects.rebuild(product_ids, [old_date.date(), instance.date_added.date()])
+
+
+@receiver(post_delete, sender=OrderLine)
+def orderline_from_sales_facts(sender, instance, **kwargs):
+    day = sales_day(instance)
+    if day is None:
+        return
+    # цена берется подзапросом в том же UPDATE, без загрузки продукта
+    price = Subquery(Product.objects.filter(pk=instance.product_id).values('price')[:1])
+    ProductSalesDay.objects.record(instance.product_id, day, units=-1,
+                                   revenue=ExpressionWrapper(-price, output_field=DecimalField()))
+
+
+# Сохраненные PDF счетов устаревают при изменении заказа или его строк
+@receiver(post_save, sender=Order)
+def order_invalidates_invoice(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        transaction.on_commit(lambda: invalidate_invoices(instance.id))
+
+
+@receiver(post_save, sender=OrderLine)
+@receiver(post_delete, sender=OrderLine)
+def orderline_invalidates_invoice(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        order_id = instance.order_id
+        transaction.on_commit(lambda: invalidate_invoices(order_id))
+
+
 # С этого момента каждый новый пользователь может получить доступ к аутентифицированным
 # конечным точкам DRF с помощью токенов, помимо уже существующих методов.
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -83,3 +191,35 @@ def create_auth_token(
 ):
     if created:
         Token.objects.create(user=instance)
+
+
+# Токен, найденный потребителем Channels, хранится в кеше, поэтому
+# удаленный токен и измененный пользователь удаляются из кеша сразу.
+# Вместе с пользователем из кеша удаляется набор его прав в REST API.
+@receiver(post_delete, sender=Token)
+def token_invalidates_cache(sender, instance, **kwargs):
+    invalidate_token(key=instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_invalidates_token_cache(sender, instance, created=False, **kwargs):
+    if not created:
+        invalidate_token(user_id=instance.pk)
+        authentication.invalidate_user(instance.pk)
+
+
+# Наборы прав пользователей REST API кешируются; изменение групп
+# пользователей, прав групп или пользователей сбрасывает их все.
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def membership_invalidates_permissions(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        authentication.invalidate_permissions()
+
+
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+def group_invalidates_permissions(sender, **kwargs):
+    authentication.invalidate_permissions()
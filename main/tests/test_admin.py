@@ -1,11 +1,20 @@
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
 from unittest.mock import patch
 from main import factories
+from main import invoices
 from main import models
+from main.paginators import ApproximateCountPaginator
+import io
+import os
 import re
+import tempfile
+import zipfile
 
 
 def compare_bodies(content, expected_content):
@@ -39,6 +48,37 @@ class TestAdminViews(TestCase):
 
         self.assertEqual(data, {"B": 3, "C": 2, "A": 6})
 
+    def test_most_bought_products_by_revenue_keeps_same_names_apart(self):
+        products = [factories.ProductFactory(name='A', active=True, price=Decimal('10.00')),
+                    factories.ProductFactory(name='A', active=True, price=Decimal('1.00')),
+                    factories.ProductFactory(name='B', active=True, price=Decimal('4.00')),]
+        order = factories.OrderFactory()
+        factories.OrderLineFactory.create_batch(1, order=order, product=products[0])
+        factories.OrderLineFactory.create_batch(3, order=order, product=products[1])
+        factories.OrderLineFactory.create_batch(2, order=order, product=products[2])
+        user = models.User.objects.create_superuser('user2', 'pw432joij')
+        self.client.force_login(user)
+
+        response = self.client.post(reverse("admin:most_bought_products"), {"period": "30", "rank_by": "revenue"},)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(response.context["labels"], ["A", "B", "A"])
+        self.assertEqual(response.context["values"], [10.0, 8.0, 3.0])
+
+    def test_most_bought_products_period_has_exactly_that_many_days(self):
+        inside = factories.ProductFactory(name='A', active=True)
+        outside = factories.ProductFactory(name='B', active=True)
+        today = date.today()
+        models.ProductSalesDay.objects.create(product=inside, day=today - timedelta(days=29),
+                                              units=1, revenue=Decimal('1.00'))
+        models.ProductSalesDay.objects.create(product=outside, day=today - timedelta(days=30),
+                                              units=1, revenue=Decimal('1.00'))
+        user = models.User.objects.create_superuser('user2', 'pw432joij')
+        self.client.force_login(user)
+
+        response = self.client.post(reverse("admin:most_bought_products"), {"period": "30"},)
+        self.assertEqual(response.context["labels"], ["A"])
+
     def test_invoice_renders_exactly_as_expected(self):
         products = [factories.ProductFactory(name='A', active=True, price=Decimal('10.00')),
                     factories.ProductFactory(name='B', active=True, price=Decimal('12.00')),]
@@ -67,3 +107,114 @@ class TestAdminViews(TestCase):
             with open('main/fixtures/invoice_test_order.pdf', 'rb') as fixture:
                 expected_content = fixture.read()
             self.assertEqual(content[:5], expected_content[:5])
+
+    def test_order_changelist_uses_cached_count(self):
+        factories.OrderFactory.create_batch(3)
+        user = models.User.objects.create_superuser('user2', 'pw432joij')
+        self.client.force_login(user)
+        cache.clear()
+
+        response = self.client.get(reverse('admin:main_order_changelist'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertIsNone(response.context['cl'].full_result_count)
+
+        # точное число не больше порога не кэшируется
+        queryset = models.Order.objects.order_by('id')
+        self.assertEqual(ApproximateCountPaginator(queryset, 100).count, 3)
+        factories.OrderFactory()
+        self.assertEqual(ApproximateCountPaginator(queryset, 100).count, 4)
+
+        # число больше порога кэшируется
+        self.assertEqual(ApproximateCountPaginator(queryset, 100, threshold=2).count, 4)
+        with self.assertNumQueries(0):
+            self.assertEqual(ApproximateCountPaginator(queryset, 100, threshold=2).count, 4)
+
+        # полный подсчет отключается только в тех списках, где это указано
+        response = self.client.get(reverse('admin:main_basket_changelist'))
+        self.assertEqual(response.context['cl'].full_result_count, 0)
+
+    def test_invoice_pdf_is_cached_per_order_version(self):
+        product = factories.ProductFactory(name='A', active=True, price=Decimal('10.00'))
+        order = factories.OrderFactory()
+        line = factories.OrderLineFactory(order=order, product=product)
+        user = models.User.objects.create_superuser('user2', 'pw432joij')
+        self.client.force_login(user)
+        url = reverse('admin:invoice', kwargs={'order_id': order.id})
+
+        with patch('main.invoices.render_invoice_pdf', return_value=b'%PDF-1') as render_pdf:
+            self.assertEqual(self.client.get(url, {'format': 'pdf'}).content, b'%PDF-1')
+            self.assertEqual(self.client.get(url, {'format': 'pdf'}).content, b'%PDF-1')
+            self.assertEqual(render_pdf.call_count, 1)
+
+            # изменение строки заказа дает новую версию счета
+            render_pdf.return_value = b'%PDF-2'
+            line.status = models.OrderLine.SENT
+            line.save()
+            self.assertEqual(self.client.get(url, {'format': 'pdf'}).content, b'%PDF-2')
+            self.assertEqual(render_pdf.call_count, 2)
+
+        # счет хранится в кеше, а не в публичном хранилище файлов
+        key = cache.get(invoices.INVOICE_CURRENT_KEY % order.id)
+        self.assertEqual(cache.get(key), b'%PDF-2')
+        with patch('main.invoices.default_storage') as storage:
+            invoices.invalidate_invoices(order.id)
+        self.assertFalse(storage.method_calls)
+        self.assertIsNone(cache.get(key))
+        self.assertIsNone(invoices.cached_invoice_pdf(key))
+
+    def test_invoice_url_fetcher_reads_static_files_locally(self):
+        with patch('main.invoices.default_url_fetcher') as http_fetcher:
+            result = invoices.invoice_url_fetcher('http://testserver/static/css/bootstrap.min.css')
+            with result['file_obj'] as f:
+                self.assertIn(b'Bootstrap', f.read(200))
+            self.assertEqual(result['mime_type'], 'text/css')
+            invoices.invoice_url_fetcher('http://testserver/static/../settings.py')
+            self.assertEqual(http_fetcher.call_count, 1)
+
+    def test_export_invoices_action_streams_zip(self):
+        product = factories.ProductFactory(name='A', active=True, price=Decimal('10.00'))
+        orders = factories.OrderFactory.create_batch(3)
+        for order in orders:
+            factories.OrderLineFactory(order=order, product=product)
+        user = models.User.objects.create_superuser('user2', 'pw432joij')
+        self.client.force_login(user)
+
+        with patch('main.invoices.write_invoice_pdf', return_value=b'%PDF') as write_pdf:
+            response = self.client.post(reverse('admin:main_order_changelist'),
+                                        {'action': 'export_invoices',
+                                         '_selected_action': [order.id for order in orders[:2]]})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/zip')
+            content = b''.join(response.streaming_content)
+            self.assertEqual(write_pdf.call_count, 2)
+
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(sorted(archive.namelist()),
+                             ['invoice-BT%d.pdf' % order.id for order in orders[:2]])
+            self.assertEqual(archive.read('invoice-BT%d.pdf' % orders[0].id), b'%PDF')
+
+    def test_export_invoices_command_renders_in_process_pool(self):
+        product = factories.ProductFactory(name='A', active=True, price=Decimal('10.00'))
+        orders = factories.OrderFactory.create_batch(2)
+        for order in orders:
+            factories.OrderLineFactory(order=order, product=product)
+
+        out = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'invoices.zip')
+            with patch('main.management.commands.export_invoices.ProcessPoolExecutor',
+                       wraps=ProcessPoolExecutor) as pool:
+                call_command('export_invoices', output, '--workers', '2', stdout=out)
+            self.assertEqual(pool.call_args[1]['max_workers'], 2)
+            with zipfile.ZipFile(output) as archive:
+                self.assertEqual(sorted(archive.namelist()),
+                                 ['invoice-BT%d.pdf' % order.id for order in orders])
+                for name in archive.namelist():
+                    self.assertTrue(archive.read(name).startswith(b'%PDF'))
+        self.assertIn('Выгружено счетов=2', out.getvalue())
+
+        # отрендеренные в пуле счета попадают в кеш
+        with patch('main.invoices.render_invoice_pdf') as render_pdf:
+            invoices.get_invoice_pdf(orders[0], 'http://localhost/')
+        self.assertFalse(render_pdf.called)
@@ -1,12 +1,30 @@
 import asyncio
+from aiohttp import web
+from django.conf import settings
 from django.contrib.auth.models import Group
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TransactionTestCase
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator, HttpCommunicator
 from unittest.mock import patch, MagicMock
+from rest_framework.authtoken.models import Token
+from io import StringIO
 import json
+import time
+from booktime import auth
+from main import chatlog
+from main import loadtest
+from main import metrics
 from main import consumers
+from main import presence
+from main import redis_pool
+from main import shutdown
+from main import tracking
 from main import factories
+from main import models
 
 # Каналы предлагают конструкции, называемые коммуникаторами.
 # Коммуникаторы можно рассматривать как эквивалент тестовых клиентов,
@@ -18,7 +36,57 @@ from main import factories
 # низкоуровневый asyncio API.
 
 
-class TestConsumers(TestCase):
+def parse_sse(body):
+    event = {}
+    for line in body.decode("utf8").strip().split("\n"):
+        field, _, value = line.partition(": ")
+        event[field] = json.loads(value) if field == "data" else value
+    return event
+
+
+async def receive_events(communicator, count):
+    """
+    Получает count событий чата, раскрывая кадры batch и подтверждая
+    каждый кадр, как это делает браузер.
+    """
+    events = []
+    while len(events) < count:
+        frame = await communicator.receive_json_from()
+        seq = frame.pop("seq", None)
+        if seq is not None:
+            await communicator.send_json_to({"type": "ack", "seq": seq})
+        events.extend(frame["events"] if frame["type"] == "batch" else [frame])
+    return events
+
+
+async def start_tracker(handler):
+    """
+    Запускает локальный сервис отслеживания заказов, возвращает его и
+    адрес для ORDER_TRACKER_URL.
+    """
+    app = web.Application()
+    app.router.add_get("/track/{order_id}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, "http://127.0.0.1:%d/track/{order_id}" % port
+
+
+class TestConsumers(TransactionTestCase):
+    def setUp(self):
+        async def clear_presence():
+            await presence.close_hub()
+            redis = await redis_pool.get_redis()
+            keys = await redis.keys("presence:*") + await redis.keys("chat:stream:*")
+            if keys:
+                await redis.delete(*keys)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(clear_presence())
+        cache.clear()
+
     def test_chat_presence_works(self):
         def init_db():
             user = factories.UserFactory(
@@ -59,17 +127,19 @@ class TestConsumers(TestCase):
             await communicator.send_json_to(
                 {"type": "heartbeat"}
             )
-            await communicator.disconnect()
+            # chat_join подключения; пока ждем тишины, heartbeat обрабатывается
+            await communicator.receive_json_from()
+            self.assertTrue(await communicator.receive_nothing())
 
-            communicator = HttpCommunicator(
+            notify = HttpCommunicator(
                 consumers.ChatNotifyConsumer,
                 "GET",
                 "/customer-service/notify/",
             )
-            communicator.scope["user"] = notify_user
-            communicator.scope["query_string"] = "nopoll"
+            notify.scope["user"] = notify_user
+            notify.scope["query_string"] = "nopoll"
 
-            response = await communicator.get_response()
+            response = await notify.get_response()
             self.assertTrue(
                 response["body"].startswith(b"data: ")
             )
@@ -86,16 +156,17 @@ class TestConsumers(TestCase):
                 "expecting someone in the room but noone found",
             )
 
-            await asyncio.sleep(10)
+            # при отключении пользователь сразу пропадает из комнаты
+            await communicator.disconnect()
 
-            communicator = HttpCommunicator(
+            notify = HttpCommunicator(
                 consumers.ChatNotifyConsumer,
                 "GET",
                 "/customer-service/notify/",
             )
-            communicator.scope["user"] = notify_user
-            communicator.scope["query_string"] = "nopoll"
-            response = await communicator.get_response()
+            notify.scope["user"] = notify_user
+            notify.scope["query_string"] = "nopoll"
+            response = await notify.get_response()
             self.assertTrue(
                 response["body"].startswith(b"data: ")
             )
@@ -171,29 +242,26 @@ class TestConsumers(TestCase):
                 {"type": "message", "message": "hello user"}
             )
 
+            events = await receive_events(communicator, 4)
+            for event in events:
+                # id события - id записи в потоке комнаты
+                self.assertRegex(event.pop("id"), r"^\d+-\d+$")
             self.assertEquals(
-                await communicator.receive_json_from(),
-                {"type": "chat_join", "username": "John Smith"},
-            )
-            self.assertEquals(
-                await communicator.receive_json_from(),
-                {"type": "chat_join", "username": "Adam Ford"},
-            )
-            self.assertEquals(
-                await communicator.receive_json_from(),
-                {
-                    "type": "chat_message",
-                    "username": "John Smith",
-                    "message": "hello customer service",
-                },
-            )
-            self.assertEquals(
-                await communicator.receive_json_from(),
-                {
-                    "type": "chat_message",
-                    "username": "Adam Ford",
-                    "message": "hello user",
-                },
+                events,
+                [
+                    {"type": "chat_join", "username": "John Smith"},
+                    {"type": "chat_join", "username": "Adam Ford"},
+                    {
+                        "type": "chat_message",
+                        "username": "John Smith",
+                        "message": "hello customer service",
+                    },
+                    {
+                        "type": "chat_message",
+                        "username": "Adam Ford",
+                        "message": "hello user",
+                    },
+                ],
             )
 
             await communicator.disconnect()
@@ -233,6 +301,74 @@ class TestConsumers(TestCase):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(test_body())
 
+    def test_chat_authorization_is_cached_and_read_only(self):
+        user = factories.UserFactory(email="auth@site.com")
+        order = factories.OrderFactory(user=user)
+        cs_user = factories.UserFactory(
+            email="auth@booktime.domain", is_staff=True
+        )
+        employees, _ = Group.objects.get_or_create(name="Employees")
+        cs_user.groups.add(employees)
+        stranger = factories.UserFactory(email="stranger@site.com")
+        date_updated = order.date_updated
+
+        # роль читается одним запросом, last_spoken_to - одним UPDATE
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                consumers.ChatConsumer.get_user_type(cs_user, order.id),
+                consumers.ChatConsumer.EMPLOYEE,
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                consumers.ChatConsumer.get_user_type(cs_user, order.id),
+                consumers.ChatConsumer.EMPLOYEE,
+            )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                consumers.ChatConsumer.get_user_type(user, order.id),
+                consumers.ChatConsumer.CLIENT,
+            )
+        self.assertIsNone(
+            consumers.ChatConsumer.get_user_type(stranger, order.id)
+        )
+        self.assertIsNone(
+            consumers.ChatConsumer.get_user_type(user, order.id + 1000)
+        )
+
+        order.refresh_from_db()
+        self.assertEqual(order.last_spoken_to, cs_user)
+        self.assertEqual(order.date_updated, date_updated)
+
+    def test_token_middleware_resolves_user_once(self):
+        def init_db():
+            user = factories.UserFactory(email="token@site.com")
+            order = factories.OrderFactory(user=user)
+            return user, order, Token.objects.get(user=user)
+
+        async def test_body():
+            user, order, token = await database_sync_to_async(init_db)()
+
+            communicator = WebsocketCommunicator(
+                auth.TokenGetAuthMiddlewareStack(consumers.ChatConsumer),
+                "/ws/customer-service/%d/?token=%s" % (order.id, token.key),
+            )
+            communicator.scope["url_route"] = {
+                "kwargs": {"order_id": order.id}
+            }
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.disconnect()
+
+            with patch.object(Token.objects, "select_related") as select_related:
+                self.assertEqual(await auth.get_token_user(token.key), user)
+            select_related.assert_not_called()
+
+            await database_sync_to_async(token.delete)()
+            self.assertIsNone(await auth.get_token_user(token.key))
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
     def test_order_tracker_works(self):
         def init_db():
             user = factories.UserFactory(
@@ -274,6 +410,777 @@ class TestConsumers(TestCase):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(test_body())
 
+    def test_order_tracking_is_cached_and_coalesced(self):
+        async def test_body():
+            requests = []
+
+            async def tracker(request):
+                requests.append(request.match_info["order_id"])
+                await asyncio.sleep(0.1)
+                return web.Response(body=b"SHIPPED")
+
+            runner, url = await start_tracker(tracker)
+            try:
+                with self.settings(ORDER_TRACKER_URL=url):
+                    # одновременные запросы одного заказа - один запрос к сервису
+                    results = await asyncio.gather(
+                        *[tracking.track(1) for _ in range(5)]
+                    )
+                    self.assertEqual(results, [b"SHIPPED"] * 5)
+                    # повторный запрос - из кеша
+                    self.assertEqual(await tracking.track(1), b"SHIPPED")
+                    self.assertEqual(await tracking.track(2), b"SHIPPED")
+            finally:
+                await tracking.close_tracker()
+                await runner.cleanup()
+            self.assertEqual(requests, ["1", "2"])
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_batch_order_tracker_streams_results_as_they_arrive(self):
+        def init_db():
+            user = factories.UserFactory(email="batchtracker@site.com")
+            orders = factories.OrderFactory.create_batch(3, user=user)
+            other = factories.OrderFactory()
+            return user, orders, other
+
+        async def test_body():
+            user, orders, other = await database_sync_to_async(init_db)()
+            delays = {orders[0].id: 0.3, orders[1].id: 0.1, orders[2].id: 0.2}
+
+            async def tracker(request):
+                order_id = int(request.match_info["order_id"])
+                await asyncio.sleep(delays[order_id])
+                return web.Response(body=b"SHIPPED %d" % order_id)
+
+            runner, url = await start_tracker(tracker)
+            ids = [orders[0].id, orders[1].id, other.id, orders[2].id]
+            try:
+                with self.settings(ORDER_TRACKER_URL=url):
+                    communicator = HttpCommunicator(
+                        consumers.BatchOrderTrackerConsumer,
+                        "GET",
+                        "/mobile-api/my-orders/tracker/",
+                    )
+                    communicator.scope["user"] = user
+                    communicator.scope["query_string"] = (
+                        "ids=%s" % ",".join(map(str, ids))
+                    ).encode()
+                    started = time.monotonic()
+                    response = await communicator.get_response(timeout=5)
+                    elapsed = time.monotonic() - started
+            finally:
+                await tracking.close_tracker()
+                await runner.cleanup()
+
+            self.assertEqual(response["status"], 200)
+            lines = [
+                json.loads(line)
+                for line in response["body"].decode("utf8").splitlines()
+            ]
+            self.assertEqual(
+                lines,
+                [
+                    {"id": other.id, "error": "not found"},
+                    {"id": orders[1].id, "status": "SHIPPED %d" % orders[1].id},
+                    {"id": orders[2].id, "status": "SHIPPED %d" % orders[2].id},
+                    {"id": orders[0].id, "status": "SHIPPED %d" % orders[0].id},
+                ],
+            )
+            # запросы к сервису идут одновременно
+            self.assertLess(elapsed, 0.55)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_dispatchers_receive_filtered_order_status_events(self):
+        def init_db():
+            dispatcher = factories.UserFactory(
+                email="dispatcher@booktime.domain", is_staff=True
+            )
+            dispatchers, _ = Group.objects.get_or_create(name="Dispatchers")
+            dispatcher.groups.add(dispatchers)
+            customer = factories.UserFactory(email="dispatched@site.com")
+            return dispatcher, customer
+
+        def change_orders(customer):
+            uk_order = factories.OrderFactory(user=customer, shipping_country="uk")
+            us_order = factories.OrderFactory(user=customer, shipping_country="us")
+            line = factories.OrderLineFactory(
+                order=uk_order, product=factories.ProductFactory()
+            )
+            us_order.status = models.Order.PAID
+            us_order.save()
+            # сохранение без смены статуса не публикуется
+            uk_order.save()
+            uk_order.status = models.Order.PAID
+            uk_order.save()
+            return uk_order, line
+
+        async def test_body():
+            dispatcher, customer = await database_sync_to_async(init_db)()
+
+            communicator = WebsocketCommunicator(
+                consumers.DispatchConsumer,
+                "/ws/dispatch/orders/?status=%d&country=uk" % models.Order.PAID,
+            )
+            communicator.scope["user"] = dispatcher
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            order, line = await database_sync_to_async(change_orders)(customer)
+            event = await communicator.receive_json_from()
+            self.assertEqual(event["kind"], "order")
+            self.assertEqual(event["order_id"], order.id)
+            self.assertEqual(event["status"], models.Order.PAID)
+            self.assertEqual(event["country"], "uk")
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+            communicator = WebsocketCommunicator(
+                consumers.DispatchConsumer, "/ws/dispatch/orders/"
+            )
+            communicator.scope["user"] = customer
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_order_events_stream_resumes_after_disconnect(self):
+        def init_db():
+            user = factories.UserFactory(email="orderevents@site.com")
+            order = factories.OrderFactory(user=user)
+            line = factories.OrderLineFactory(
+                order=order, product=factories.ProductFactory()
+            )
+            other = factories.OrderFactory(
+                user=factories.UserFactory(email="otherevents@site.com")
+            )
+            return user, order, line, other, Token.objects.get(user=user)
+
+        def set_status(instance, status):
+            instance.status = status
+            instance.save()
+
+        async def connect(token, last_event_id=None):
+            path = "/ws/my-orders/events/?token=%s" % token.key
+            if last_event_id is not None:
+                path += "&last_event_id=%d" % last_event_id
+            communicator = WebsocketCommunicator(
+                auth.TokenGetAuthMiddlewareStack(consumers.OrderEventsConsumer),
+                path,
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            return communicator
+
+        async def test_body():
+            user, order, line, other, token = await database_sync_to_async(
+                init_db
+            )()
+
+            communicator = await connect(token)
+            await database_sync_to_async(set_status)(order, models.Order.PAID)
+            await database_sync_to_async(set_status)(other, models.Order.PAID)
+            event = await communicator.receive_json_from()
+            self.assertEqual(
+                event,
+                {
+                    "type": "order_status",
+                    "id": event["id"],
+                    "order_id": order.id,
+                    "status": models.Order.PAID,
+                },
+            )
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+            await database_sync_to_async(set_status)(
+                line, models.OrderLine.PROCESSING
+            )
+            await database_sync_to_async(set_status)(line, models.OrderLine.SENT)
+
+            communicator = await connect(token, event["id"])
+            missed = [await communicator.receive_json_from() for _ in range(3)]
+            self.assertEqual(
+                [(e.get("line_id"), e["status"]) for e in missed],
+                [
+                    (line.id, models.OrderLine.PROCESSING),
+                    (line.id, models.OrderLine.SENT),
+                    # все строки отправлены - заказ выполнен
+                    (None, models.Order.DONE),
+                ],
+            )
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+            with self.settings(ORDER_EVENTS_REPLAY_LIMIT=2):
+                communicator = await connect(token, event["id"])
+                self.assertEqual(
+                    await communicator.receive_json_from(),
+                    {"type": "resync", "id": missed[-1]["id"]},
+                )
+                await communicator.disconnect()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_chat_presence_is_pushed_on_join(self):
+        def init_db():
+            user = factories.UserFactory(email="first_last@site.com")
+            order = factories.OrderFactory(user=user)
+            cs_user = factories.UserFactory(
+                email="presence@booktime.domain",
+                is_staff=True,
+            )
+            employees, _ = Group.objects.get_or_create(
+                name="Employees"
+            )
+            cs_user.groups.add(employees)
+            return user, order, cs_user
+
+        async def test_body():
+            user, order, notify_user = await database_sync_to_async(
+                init_db
+            )()
+
+            communicator = HttpCommunicator(
+                consumers.ChatNotifyConsumer,
+                "GET",
+                "/customer-service/notify/",
+            )
+            communicator.scope["user"] = notify_user
+            await communicator.send_input({"type": "http.request", "body": b""})
+            response = await communicator.receive_output()
+            self.assertEqual(response["type"], "http.response.start")
+            snapshot = parse_sse(
+                (await communicator.receive_output())["body"]
+            )
+            self.assertEqual(snapshot["event"], "snapshot")
+            self.assertNotIn(
+                order.id, [chat["order_id"] for chat in snapshot["data"]]
+            )
+
+            await presence.heartbeat(order.id, user.email)
+            join = parse_sse((await communicator.receive_output())["body"])
+            self.assertEqual(join["event"], "join")
+            self.assertEqual(
+                join["data"],
+                {
+                    "order_id": order.id,
+                    "link": "/customer-service/%d/" % order.id,
+                    "email": "first_last@site.com",
+                },
+            )
+
+            # продление присутствия не рассылается
+            await presence.heartbeat(order.id, user.email)
+            self.assertTrue(await communicator.receive_nothing())
+
+            communicator.future.cancel()
+            await communicator.wait()
+
+            # переподключение досылает только пропущенные события
+            await presence.leave(order.id, user.email)
+            communicator = HttpCommunicator(
+                consumers.ChatNotifyConsumer,
+                "GET",
+                "/customer-service/notify/",
+                headers=[(b"last-event-id", join["id"].encode())],
+            )
+            communicator.scope["user"] = notify_user
+            await communicator.send_input({"type": "http.request", "body": b""})
+            await communicator.receive_output()
+            leave = parse_sse((await communicator.receive_output())["body"])
+            self.assertEqual(leave["event"], "leave")
+            self.assertEqual(
+                leave["data"],
+                {"order_id": order.id, "email": "first_last@site.com"},
+            )
+            self.assertTrue(await communicator.receive_nothing())
+
+            communicator.future.cancel()
+            await communicator.wait()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_presence_hub_encodes_once_for_all_streams(self):
+        def init_db():
+            user = factories.UserFactory(email="hub@site.com")
+            order = factories.OrderFactory(user=user)
+            cs_user = factories.UserFactory(
+                email="hub@booktime.domain",
+                is_staff=True,
+            )
+            employees, _ = Group.objects.get_or_create(
+                name="Employees"
+            )
+            cs_user.groups.add(employees)
+            return user, order, cs_user
+
+        async def test_body():
+            user, order, notify_user = await database_sync_to_async(
+                init_db
+            )()
+
+            communicators = []
+            for _ in range(3):
+                communicator = HttpCommunicator(
+                    consumers.ChatNotifyConsumer,
+                    "GET",
+                    "/customer-service/notify/",
+                )
+                communicator.scope["user"] = notify_user
+                await communicator.send_input({"type": "http.request", "body": b""})
+                await communicator.receive_output()
+                await communicator.receive_output()
+                communicators.append(communicator)
+
+            with patch.object(
+                presence, "active_chats", wraps=presence.active_chats
+            ) as active_chats:
+                await presence.heartbeat(order.id, user.email)
+                bodies = [
+                    (await communicator.receive_output())["body"]
+                    for communicator in communicators
+                ]
+
+            active_chats.assert_called_once()
+            self.assertEqual(parse_sse(bodies[0])["data"]["email"], "hub@site.com")
+            for body in bodies:
+                self.assertIs(body, bodies[0])
+
+            for communicator in communicators:
+                communicator.future.cancel()
+                await communicator.wait()
+            self.assertEqual(len(presence.get_hub().subscribers), 0)
+            await presence.leave(order.id, user.email)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_presence_sweep_removes_stale_participants(self):
+        async def test_body():
+            await presence.heartbeat(9001, "first_last@site.com")
+            await presence.heartbeat(9001, "cs@booktime.domain")
+            await presence.heartbeat(9002, "other@site.com")
+
+            chats = await presence.active_chats()
+            self.assertEqual(
+                sorted(chats[9001]),
+                ["cs@booktime.domain", "first_last@site.com"],
+            )
+            self.assertEqual(chats[9002], ["other@site.com"])
+
+            later = time.time() + presence.PRESENCE_TTL + 1
+            with patch("main.presence.time.time", return_value=later):
+                await presence.heartbeat(9001, "cs@booktime.domain")
+                self.assertEqual(await presence.sweep(), 2)
+                self.assertEqual(
+                    await presence.active_chats(),
+                    {9001: ["cs@booktime.domain"]},
+                )
+            await presence.leave(9001, "cs@booktime.domain")
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_chat_messages_are_written_in_batches(self):
+        def init_db():
+            user = factories.UserFactory(email="batch@site.com")
+            order = factories.OrderFactory(user=user)
+            return user, order
+
+        async def test_body():
+            user, order = await database_sync_to_async(init_db)()
+
+            communicator = WebsocketCommunicator(
+                consumers.ChatConsumer,
+                "/ws/customer-service/%d/" % order.id,
+            )
+            communicator.scope["user"] = user
+            communicator.scope["url_route"] = {
+                "kwargs": {"order_id": order.id}
+            }
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            with patch.object(
+                models.ChatMessage.objects, "bulk_create"
+            ) as bulk_create:
+                for i in range(4):
+                    await communicator.send_json_to(
+                        {"type": "message", "message": "message %d" % i}
+                    )
+                await asyncio.sleep(0.3)
+
+            self.assertEqual(
+                [
+                    [message.message for message in call[0][0]]
+                    for call in bulk_create.call_args_list
+                ],
+                [["message 0", "message 1", "message 2"], ["message 3"]],
+            )
+            await communicator.disconnect()
+
+        loop = asyncio.get_event_loop()
+        with self.settings(CHAT_FLUSH_MAX_MESSAGES=3, CHAT_FLUSH_INTERVAL_MS=100):
+            loop.run_until_complete(test_body())
+
+    def test_pending_chat_messages_are_written_at_exit(self):
+        user = factories.UserFactory(email="atexit@site.com")
+        order = factories.OrderFactory(user=user)
+        loop = asyncio.get_event_loop()
+
+        with self.settings(CHAT_FLUSH_INTERVAL_MS=60000):
+            chatlog.save_message(order.id, user, "unsaved")
+        buffer = chatlog.get_buffer()
+        self.assertIsNotNone(buffer.timer)
+
+        # цикл событий уже не выполняется, запись идет в текущем потоке
+        self.assertFalse(loop.is_running())
+        chatlog.write_pending()
+        self.assertIsNone(buffer.timer)
+        self.assertEqual(
+            list(models.ChatMessage.objects.filter(order=order).values_list("message", flat=True)),
+            ["unsaved"],
+        )
+        chatlog.write_pending()
+        self.assertEqual(models.ChatMessage.objects.filter(order=order).count(), 1)
+
+    def test_chat_consumers_share_redis_pool(self):
+        def init_db():
+            user = factories.UserFactory(email="pool@site.com")
+            orders = [factories.OrderFactory(user=user) for _ in range(5)]
+            return user, orders
+
+        async def test_body():
+            user, orders = await database_sync_to_async(init_db)()
+
+            communicators = []
+            for order in orders:
+                communicator = WebsocketCommunicator(
+                    consumers.ChatConsumer,
+                    "/ws/customer-service/%d/" % order.id,
+                )
+                communicator.scope["user"] = user
+                communicator.scope["url_route"] = {
+                    "kwargs": {"order_id": order.id}
+                }
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                await communicator.send_json_to({"type": "heartbeat"})
+                communicators.append(communicator)
+
+            for communicator in communicators:
+                await communicator.disconnect()
+            for order in orders:
+                await presence.leave(order.id, user.email)
+
+            stats = redis_pool.pool_stats()
+            self.assertEqual(stats["pools"], 1)
+            self.assertLessEqual(stats["size"], settings.REDIS_POOL_MAXSIZE)
+            self.assertEqual(stats["in_use"], 0)
+
+            # daphne закрывает общие ресурсы перед остановкой реактора
+            reactor = MagicMock()
+            self.assertTrue(shutdown.install(reactor))
+            phase, event, before_shutdown = reactor.addSystemEventTrigger.call_args[0]
+            self.assertEqual((phase, event), ("before", "shutdown"))
+            await before_shutdown().asFuture(asyncio.get_event_loop())
+            self.assertEqual(redis_pool.pool_stats()["pools"], 0)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_chat_coalesces_bursts_and_drops_for_slow_clients(self):
+        def init_db():
+            user = factories.UserFactory(email="burst@site.com")
+            order = factories.OrderFactory(user=user)
+            return user, order
+
+        async def connect(user, order):
+            communicator = WebsocketCommunicator(
+                consumers.ChatConsumer, "/ws/customer-service/%d/" % order.id
+            )
+            communicator.scope["user"] = user
+            communicator.scope["url_route"] = {
+                "kwargs": {"order_id": order.id}
+            }
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            return communicator
+
+        async def burst(order, count):
+            for i in range(count):
+                await get_channel_layer().group_send(
+                    "customer-service_%d" % order.id,
+                    {"type": "chat_message", "id": "1-%d" % i,
+                     "username": "Burst", "message": "message %d" % i},
+                )
+
+        async def test_body():
+            user, order = await database_sync_to_async(init_db)()
+
+            # клиент без подтверждений не ждет ack, но очередь ограничена
+            # и внутри одного окна объединения
+            communicator = await connect(user, order)
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame["type"], "chat_join")
+            await burst(order, 10)
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame["type"], "batch")
+            self.assertEqual(
+                [event.get("message") for event in frame["events"]],
+                [None, "message 7", "message 8", "message 9"],
+            )
+            self.assertEqual(frame["events"][0], {"type": "chat_gap"})
+            await burst(order, 2)
+            self.assertEqual(
+                [event["message"] for event in await receive_events(communicator, 2)],
+                ["message 0", "message 1"],
+            )
+            await communicator.disconnect()
+
+            # после первого ack кадры ждут подтверждения, а события копятся
+            communicator = await connect(user, order)
+            join = await communicator.receive_json_from()
+            await communicator.send_json_to({"type": "ack", "seq": join["seq"]})
+            await burst(order, 2)
+            frame = await communicator.receive_json_from()
+            self.assertEqual(
+                [event["message"] for event in frame["events"]],
+                ["message 0", "message 1"],
+            )
+            await burst(order, 10)
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.send_json_to({"type": "ack", "seq": frame["seq"]})
+            frame = await communicator.receive_json_from()
+            self.assertEqual(
+                [event.get("message") for event in frame["events"]],
+                [None, "message 7", "message 8", "message 9"],
+            )
+            await communicator.disconnect()
+
+            with self.settings(CHAT_SLOW_CLIENT_POLICY="disconnect"):
+                communicator = await connect(user, order)
+                await communicator.receive_json_from()
+                await burst(order, 10)
+                self.assertEqual(
+                    await communicator.receive_output(),
+                    {"type": "websocket.close", "code": 4008},
+                )
+                # соединение закрывается один раз, остальные события пропускаются
+                self.assertTrue(await communicator.receive_nothing())
+                await communicator.disconnect()
+
+        loop = asyncio.get_event_loop()
+        with self.settings(CHAT_OUTBOX_SIZE=3, CHAT_ACK_WINDOW=1, CHAT_BATCH_WINDOW_MS=300):
+            loop.run_until_complete(test_body())
+
+    def test_chat_replays_missed_events_on_reconnect(self):
+        def init_db():
+            user = factories.UserFactory(
+                email="replay@site.com",
+                first_name="Jane",
+                last_name="Doe",
+            )
+            order = factories.OrderFactory(user=user)
+            return user, order
+
+        async def connect(user, order, last_event_id=None):
+            path = "/ws/customer-service/%d/" % order.id
+            communicator = WebsocketCommunicator(consumers.ChatConsumer, path)
+            communicator.scope["user"] = user
+            communicator.scope["url_route"] = {
+                "kwargs": {"order_id": order.id}
+            }
+            if last_event_id:
+                communicator.scope["query_string"] = (
+                    "last_event_id=%s" % last_event_id
+                ).encode()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            return communicator
+
+        async def test_body():
+            user, order = await database_sync_to_async(init_db)()
+
+            communicator = await connect(user, order)
+            await communicator.receive_json_from()
+            await communicator.send_json_to({"type": "message", "message": "one"})
+            last_seen = await communicator.receive_json_from()
+            await communicator.disconnect()
+
+            other = await connect(user, order)
+            await other.send_json_to({"type": "message", "message": "two"})
+            await other.send_json_to({"type": "message", "message": "three"})
+            await receive_events(other, 3)
+
+            communicator = await connect(user, order, last_seen["id"])
+            received = await receive_events(communicator, 5)
+            self.assertEqual(
+                [(event["type"], event.get("message")) for event in received],
+                [
+                    ("chat_leave", None),
+                    ("chat_join", None),
+                    ("chat_message", "two"),
+                    ("chat_message", "three"),
+                    ("chat_join", None),
+                ],
+            )
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+            # досылается не больше CHAT_REPLAY_LIMIT последних событий
+            with self.settings(CHAT_REPLAY_LIMIT=2):
+                communicator = await connect(user, order, last_seen["id"])
+                received = await receive_events(communicator, 4)
+                self.assertEqual(
+                    [event["type"] for event in received],
+                    ["chat_gap", "chat_join", "chat_leave", "chat_join"],
+                )
+                self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+            await other.disconnect()
+            await chatlog.flush_messages()
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(test_body())
+
+    def test_load_harness_reports_and_gates(self):
+        self.assertEqual(loadtest.percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(loadtest.percentile(list(range(1, 101)), 95), 95)
+        self.assertIsNone(loadtest.percentile([], 99))
+
+        loop = asyncio.get_event_loop()
+        with self.settings(CHANNEL_LAYERS={
+            "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+        }), patch("main.events.publish_on_commit") as publish_on_commit:
+            report = loop.run_until_complete(
+                loadtest.run(chats=6, rooms=2, streams=3, messages=3, interval_ms=0)
+            )
+        # заказы прогона не рассылаются диспетчерам
+        self.assertFalse(publish_on_commit.called)
+        self.assertEqual(report["chat"]["failed"], 0)
+        self.assertEqual(report["chat"]["connect_ms"]["count"], 6)
+        # каждое сообщение доходит до всех участников своей комнаты
+        self.assertEqual(report["chat"]["fanout_ms"]["count"], 2 * 3 * 3)
+        self.assertEqual(report["chat"]["lost"], 0)
+        self.assertEqual(report["notify"]["fanout_ms"]["count"], 3)
+        self.assertEqual(report["notify"]["lost"], 0)
+        self.assertGreater(report["chat"]["kb_per_connection"], 0)
+        self.assertFalse(
+            models.User.objects.filter(email__startswith="loadtest-").exists()
+        )
+
+        # команда создает временную базу данных; тест уже работает в ней
+        command = "main.management.commands.loadtest_consumers."
+        with patch(command + "setup_databases", return_value=[]) as setup, \
+                patch(command + "teardown_databases") as teardown:
+            out = StringIO()
+            call_command(
+                "loadtest_consumers", "--in-memory", "--chats=4", "--rooms=2",
+                "--streams=2", "--messages=2", "--max-lost=0", stdout=out,
+            )
+            self.assertIn("fanout_ms: count=8", out.getvalue())
+            with self.assertRaisesRegex(CommandError, "chat fan-out p95"):
+                call_command(
+                    "loadtest_consumers", "--in-memory", "--chats=4", "--rooms=2",
+                    "--streams=2", "--messages=2", "--no-memory",
+                    "--max-fanout-p95-ms=0", stdout=StringIO(),
+                )
+        self.assertEqual(setup.call_count, 2)
+        teardown.assert_called_with([], verbosity=0)
+
+    def test_handlers_and_loop_lag_are_exposed_as_metrics(self):
+        def init_db():
+            user = factories.UserFactory(email="metrics@site.com")
+            order = factories.OrderFactory(user=user)
+            return user, order
+
+        async def scrape(headers):
+            communicator = HttpCommunicator(
+                consumers.MetricsConsumer, "GET", "/metrics/", headers=headers
+            )
+            # за обратным прокси все запросы приходят с его адреса
+            communicator.scope["client"] = ("127.0.0.1", 50000)
+            return await communicator.get_response()
+
+        async def test_body():
+            user, order = await database_sync_to_async(init_db)()
+            connects = metrics.HANDLER_SECONDS.count("ChatConsumer", "connect")
+            waits = metrics.DB_WAIT_SECONDS.count("get_user_type")
+
+            communicator = WebsocketCommunicator(
+                consumers.ChatConsumer, "/ws/customer-service/%d/" % order.id
+            )
+            communicator.scope["user"] = user
+            communicator.scope["url_route"] = {
+                "kwargs": {"order_id": order.id}
+            }
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+            await communicator.send_json_to({"type": "heartbeat"})
+            await asyncio.sleep(0.05)
+            await communicator.disconnect()
+
+            self.assertEqual(
+                metrics.HANDLER_SECONDS.count("ChatConsumer", "connect"),
+                connects + 1,
+            )
+            self.assertEqual(
+                metrics.DB_WAIT_SECONDS.count("get_user_type"), waits + 1
+            )
+
+            response = await scrape([(b"authorization", b"Bearer s3cret")])
+            self.assertEqual(response["status"], 200)
+            body = response["body"].decode("utf8")
+            for line in (
+                '# TYPE booktime_consumer_handler_seconds histogram',
+                'booktime_consumer_handler_seconds_count{consumer="ChatConsumer",handler="receive_json"}',
+                'booktime_consumer_handler_seconds_bucket{consumer="ChatConsumer",handler="connect",le="+Inf"}',
+                'booktime_db_thread_wait_seconds_count{function="get_user_type"}',
+                'booktime_db_thread_run_seconds_count{function="get_user_type"}',
+                'booktime_event_loop_lag_seconds_count',
+                'booktime_redis_pool_connections{state="in_use"}',
+            ):
+                self.assertIn(line, body)
+
+            # проксированный запрос без токена или с чужим токеном отклоняется
+            proxied = [(b"x-forwarded-for", b"203.0.113.7")]
+            self.assertEqual((await scrape(proxied))["status"], 403)
+            self.assertEqual(
+                (await scrape(proxied + [(b"authorization", b"Bearer guess")]))["status"],
+                403,
+            )
+            with self.settings(METRICS_TOKEN=""):
+                self.assertEqual(
+                    (await scrape([(b"authorization", b"Bearer ")]))["status"], 403
+                )
+            await metrics.stop_monitor()
+
+        loop = asyncio.get_event_loop()
+        with self.settings(METRICS_LOOP_LAG_INTERVAL=0.01, METRICS_TOKEN="s3cret"):
+            loop.run_until_complete(test_body())
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ("name",))
+        for value in (0.001, 0.003, 0.2, 20):
+            histogram.observe(value, "a")
+        lines = histogram.expose()
+        self.assertIn('test_seconds_bucket{name="a",le="0.001"} 1', lines)
+        self.assertIn('test_seconds_bucket{name="a",le="0.005"} 2', lines)
+        self.assertIn('test_seconds_bucket{name="a",le="0.25"} 3', lines)
+        self.assertIn('test_seconds_bucket{name="a",le="10"} 3', lines)
+        self.assertIn('test_seconds_bucket{name="a",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{name="a"} 4', lines)
+        self.assertEqual(histogram.count("a"), 4)
+
 
 
 
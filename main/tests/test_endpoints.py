@@ -1,7 +1,12 @@
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from rest_framework.authtoken.models import Token
+from main import checks
 from main import factories
 from main import models
 
@@ -44,6 +49,82 @@ class TestEndpoints(APITestCase):
         jsonresp = response.json()
         self.assertIn("token", jsonresp)
 
+    def test_chat_history_is_cursor_paginated(self):
+        user = factories.UserFactory(email="chatter@site.com")
+        order = factories.OrderFactory(user=user)
+        models.ChatMessage.objects.bulk_create(
+            models.ChatMessage(order=order, user=user, username="Chatter", message="message %d" % i)
+            for i in range(60)
+        )
+        self.client.force_authenticate(user)
 
+        response = self.client.get(reverse("chat_messages", kwargs={"order_id": order.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        page = response.json()
+        self.assertEqual(len(page["results"]), 50)
+        self.assertEqual(page["results"][0]["message"], "message 59")
+        self.assertIsNone(page["previous"])
+
+        response = self.client.get(page["next"])
+        page = response.json()
+        self.assertEqual(
+            [message["message"] for message in page["results"]],
+            ["message %d" % i for i in range(9, -1, -1)],
+        )
+        self.assertIsNone(page["next"])
+
+    def test_chat_history_is_private(self):
+        order = factories.OrderFactory(user=factories.UserFactory(email="owner@site.com"))
+        models.ChatMessage.objects.create(order=order, username="Owner", message="hello")
+        self.client.force_authenticate(factories.UserFactory(email="other@site.com"))
+
+        response = self.client.get(reverse("chat_messages", kwargs={"order_id": order.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["results"], [])
+
+    def test_permissions_are_cached(self):
+        cache.clear()
+        user = factories.UserFactory(email="dispatcher@booktime.domain", is_staff=True)
+        dispatchers = Group.objects.create(name="Dispatchers")
+        dispatchers.permissions.add(Permission.objects.get(codename="change_orderline"))
+        user.groups.add(dispatchers)
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        order = factories.OrderFactory(status=models.Order.PAID)
+        line = factories.OrderLineFactory(order=order, product=factories.ProductFactory())
+        url = reverse("orderline-detail", args=[line.id])
+
+        response = self.client.patch(url, {"status": models.OrderLine.PROCESSING})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # повторный запрос читает токен вместе с пользователем одним
+        # запросом, а права берет из кеша
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(url, {"status": models.OrderLine.PROCESSING})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            len([query for query in queries if "authtoken_token" in query["sql"]]), 1
+        )
+        self.assertEqual(
+            [query["sql"] for query in queries if "auth_permission" in query["sql"]], []
+        )
+
+        dispatchers.permissions.clear()
+        response = self.client.patch(url, {"status": models.OrderLine.PROCESSING})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+        token.delete()
+        response = self.client.patch(url, {"status": models.OrderLine.PROCESSING})
+        self.assertEqual(response.json()["detail"], "Invalid token.")
 
+    def test_local_cache_is_reported_outside_debug(self):
+        locmem = {"default": {"BACKEND": checks.LOCAL_CACHE_BACKEND}}
+        with self.settings(DEBUG=False, CACHES=locmem):
+            self.assertEqual(
+                [warning.id for warning in checks.check_shared_cache(None)],
+                ["main.W001"],
+            )
+        shared = {"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                              "LOCATION": "cache_table"}}
+        with self.settings(DEBUG=False, CACHES=shared):
+            self.assertEqual(checks.check_shared_cache(None), [])
@@ -1,4 +1,7 @@
+from datetime import timedelta
 from decimal import Decimal
+from django.contrib.auth.models import Group
+from django.db.models import Exists, OuterRef
 from django.test import TestCase
 from main import models
 from main import factories
@@ -15,6 +18,64 @@ class TestModel(TestCase):
         # models.Product.objects.create(name="Pride and Prejudice", price=Decimal("2.00"))
         # models.Product.objects.create(name="A Tale of Two Cities", price=Decimal("2.00"), active=False)
 
+    def test_sales_facts_follow_order_lines(self):
+        product = factories.ProductFactory(price=Decimal('5.00'))
+        order = factories.OrderFactory()
+        lines = factories.OrderLineFactory.create_batch(3, order=order, product=product)
+        lines[0].delete()
+
+        fact = models.ProductSalesDay.objects.get(product=product)
+        self.assertEqual(fact.day, order.date_added.date())
+        self.assertEqual(fact.units, 2)
+        self.assertEqual(fact.revenue, Decimal('10.00'))
+
+    def test_sales_facts_follow_product_and_date_changes(self):
+        old = factories.ProductFactory(price=Decimal('5.00'))
+        new = factories.ProductFactory(price=Decimal('7.00'))
+        order = factories.OrderFactory()
+        lines = factories.OrderLineFactory.create_batch(2, order=order, product=old)
+        day = order.date_added.date()
+
+        line = models.OrderLine.objects.get(pk=lines[0].pk)
+        line.product = new
+        line.save()
+        facts = {fact.product_id: fact for fact in models.ProductSalesDay.objects.filter(day=day)}
+        self.assertEqual((facts[old.id].units, facts[old.id].revenue), (1, Decimal('5.00')))
+        self.assertEqual((facts[new.id].units, facts[new.id].revenue), (1, Decimal('7.00')))
+
+        order = models.Order.objects.get(pk=order.pk)
+        order.date_added -= timedelta(days=3)
+        order.save()
+        self.assertFalse(models.ProductSalesDay.objects.filter(day=day).exists())
+        self.assertEqual(models.ProductSalesDay.objects.filter(day=day - timedelta(days=3)).count(), 2)
+
+        # удаление строки не загружает ни заказ, ни продукт: DELETE, дата заказа и UPDATE
+        line = models.OrderLine.objects.get(pk=lines[1].pk)
+        with self.assertNumQueries(3):
+            line.delete()
+        fact = models.ProductSalesDay.objects.get(product=old)
+        self.assertEqual((fact.units, fact.revenue), (0, Decimal('0.00')))
+
+    def test_employee_role_is_checked_in_one_place(self):
+        employees = Group.objects.create(name=models.User.EMPLOYEES)
+        employee = factories.UserFactory(email='employee@booktime.domain', is_staff=True)
+        employee.groups.add(employees)
+        staff = factories.UserFactory(email='staff@booktime.domain', is_staff=True)
+        customer = factories.UserFactory(email='customer@site.com')
+        customer.groups.add(employees)
+
+        self.assertEqual([user.is_employee for user in (employee, staff, customer)], [True, False, False])
+        self.assertFalse(employee.is_dispatcher)
+        # с уже известным членством в группе запросов нет
+        with self.assertNumQueries(0):
+            self.assertTrue(employee.has_role(models.User.EMPLOYEES, in_group=True))
+            self.assertFalse(customer.has_role(models.User.EMPLOYEES, in_group=True))
+        self.assertEqual(
+            sorted(models.User.objects.filter(Exists(models.User.in_group_query(OuterRef('pk'), models.User.EMPLOYEES)))
+                   .values_list('email', flat=True)),
+            ['customer@site.com', 'employee@booktime.domain'],
+        )
+
     def test_create_order_works(self):
         p1 = factories.ProductFactory()
         p2 = factories.ProductFactory()
@@ -0,0 +1,135 @@
+from decimal import Decimal
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from main import factories
+from main import models
+from main.querybudget import query_budget, QueryBudgetExceeded
+
+# Количество запросов каждой страницы не должно зависеть от количества строк:
+# бюджеты проверяются при N=1 и N=100 строк.
+SIZES = (1, 100)
+# Списки с ApproximateCountPaginator (корзины и заказы) на PostgreSQL при пустом
+# кэше делают еще один запрос - оценку количества строк из pg_class.
+ESTIMATE = 1
+# Список корзин, кроме того, показывает общее количество строк (show_full_result_count).
+FULL_COUNT = 1
+
+
+class TestQueryBudget(TestCase):
+    def test_budget_raises_when_exceeded(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(1):
+                list(models.Product.objects.all())
+                list(models.ProductTag.objects.all())
+
+    def test_budget_as_decorator(self):
+        @query_budget(1)
+        def products():
+            return list(models.Product.objects.all())
+
+        self.assertEqual(products(), [])
+
+
+class TestPageBudgets(TestCase):
+    def setUp(self):
+        self.admin_user = models.User.objects.create_superuser('owner@booktime.domain', 'pw432joij')
+        self.customer = factories.UserFactory(email='customer@site.com')
+        self.tag = models.ProductTag.objects.create(name='Fiction', slug='fiction')
+        self.created = 0
+
+    def populate(self, n):
+        """Дополняет базу данных до n строк каждого вида"""
+        for i in range(self.created, n):
+            product = factories.ProductFactory(name='Book %d' % i, slug='book-%d' % i, price=Decimal('10.00'))
+            product.tags.add(self.tag)
+            # bulk_create не вызывает сигнал генерации миниатюр
+            models.ProductImage.objects.bulk_create([
+                models.ProductImage(product=product, image='product-images/cb1.jpg', thumbnail='product-thumbnails/cb1.jpg')
+            ])
+            user = factories.UserFactory(email='user%d@site.com' % i)
+            factories.AddressFactory(user=user, name='Address %d' % i, country='uk')
+            basket = models.Basket.objects.create(user=user)
+            models.BasketLine.objects.create(basket=basket, product=product, quantity=2)
+            for owner in (user, self.customer):
+                order = factories.OrderFactory(user=owner, status=models.Order.PAID, shipping_country='uk')
+                factories.OrderLineFactory.create_batch(2, order=order, product=product)
+        self.created = n
+
+    def assertPageBudget(self, budget, url, **params):
+        for n in SIZES:
+            self.populate(n)
+            cache.clear()
+            with self.subTest(url=url, n=n):
+                with query_budget(budget, label='%s with %d rows' % (url, n)):
+                    response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+
+    def test_owners_admin_changelists(self):
+        self.client.force_login(self.admin_user)
+        budgets = {'product': 5, 'producttag': 5, 'productimage': 5, 'user': 6,
+                   'address': 5, 'basket': 4 + ESTIMATE + FULL_COUNT, 'order': 5 + ESTIMATE}
+        for model, budget in budgets.items():
+            self.assertPageBudget(budget, reverse('admin:main_%s_changelist' % model))
+
+    def test_central_office_admin_changelists(self):
+        self.client.force_login(self.admin_user)
+        budgets = {'product': 5, 'producttag': 5, 'productimage': 5, 'address': 5, 'order': 5 + ESTIMATE}
+        for model, budget in budgets.items():
+            self.assertPageBudget(budget, reverse('central-office-admin:main_%s_changelist' % model))
+
+    def test_dispatch_admin_changelists(self):
+        self.client.force_login(self.admin_user)
+        budgets = {'product': 5, 'producttag': 5, 'order': 5 + ESTIMATE}
+        for model, budget in budgets.items():
+            self.assertPageBudget(budget, reverse('dispatchers-admin:main_%s_changelist' % model))
+
+    def test_views(self):
+        self.assertPageBudget(2, reverse('products', kwargs={'tag': 'all'}))
+        self.assertPageBudget(3, reverse('products', kwargs={'tag': 'fiction'}))
+        self.client.force_login(self.admin_user)
+        self.assertPageBudget(4, reverse('order_dashboard'))
+        self.client.force_login(self.customer)
+        self.assertPageBudget(3, reverse('address_list'))
+
+    def test_basket(self):
+        self.populate(1)
+        basket = models.Basket.objects.create(user=self.customer)
+        session = self.client.session
+        session['basket_id'] = basket.id
+        session.save()
+        for n in SIZES:
+            for product in models.Product.objects.exclude(basketline__basket=basket):
+                models.BasketLine.objects.create(basket=basket, product=product)
+            with self.subTest(n=n):
+                with query_budget(5, label='basket with %d lines' % n):
+                    response = self.client.get(reverse('basket'))
+                self.assertEqual(response.status_code, 200)
+            self.populate(100)
+
+    def test_invoice(self):
+        self.client.force_login(self.admin_user)
+        order = factories.OrderFactory(user=self.customer)
+        self.populate(1)
+        for n in SIZES:
+            factories.OrderLineFactory.create_batch(n - order.lines.count(), order=order,
+                                                    product=models.Product.objects.first())
+            with self.subTest(n=n):
+                with query_budget(4, label='invoice with %d lines' % n):
+                    response = self.client.get(reverse('admin:invoice', kwargs={'order_id': order.id}))
+                self.assertEqual(response.status_code, 200)
+
+    def test_api_endpoints(self):
+        self.client.force_login(self.admin_user)
+        self.assertPageBudget(4, reverse('orderline-list'))
+        self.assertPageBudget(4, reverse('order-list'))
+        token = Token.objects.get(user=self.customer)
+        self.client.logout()
+        for n in SIZES:
+            self.populate(n)
+            with self.subTest(n=n):
+                with query_budget(5, label='my_orders with %d orders' % n):
+                    response = self.client.get(reverse('mobile_my_orders'),
+                                               HTTP_AUTHORIZATION='Token ' + token.key)
+                self.assertEqual(response.status_code, 200)
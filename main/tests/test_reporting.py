@@ -0,0 +1,115 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+import os
+import tempfile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+import numpy as np
+from main import factories
+from main import models
+from main.reporting import SalesCube, downsample, lttb
+
+
+class TestSalesCube(TestCase):
+    def setUp(self):
+        fiction = models.ProductTag.objects.create(name='Fiction', slug='fiction')
+        classics = models.ProductTag.objects.create(name='Classics', slug='classics')
+        self.a = factories.ProductFactory(name='A', price=Decimal('10.00'))
+        self.b = factories.ProductFactory(name='B', price=Decimal('4.00'))
+        self.a.tags.add(fiction, classics)
+        self.b.tags.add(fiction)
+        uk_order = factories.OrderFactory(shipping_country='uk')
+        us_order = factories.OrderFactory(shipping_country='us')
+        factories.OrderLineFactory.create_batch(2, order=uk_order, product=self.a)
+        factories.OrderLineFactory.create_batch(3, order=us_order, product=self.b)
+        self.fiction, self.classics = fiction, classics
+
+    def test_rollups_by_country_and_tag(self):
+        cube = SalesCube.build()
+
+        self.assertEqual(cube.query('revenue'), [{'revenue': 32.0}])
+        self.assertEqual(cube.query('units', by=['country']),
+                         [{'country': 'uk', 'units': 2}, {'country': 'us', 'units': 3}])
+        self.assertEqual(cube.query('revenue', by=['tag', 'country']),
+                         [{'tag': 'Fiction', 'country': 'uk', 'revenue': 20.0},
+                          {'tag': 'Fiction', 'country': 'us', 'revenue': 12.0},
+                          {'tag': 'Classics', 'country': 'uk', 'revenue': 20.0}])
+        self.assertEqual(cube.query('units', by=['week'], tags=[self.classics.id]),
+                         [{'week': cube.query('units', by=['week'])[0]['week'], 'units': 2}])
+
+    def test_save_and_load_roundtrip(self):
+        cube = SalesCube.build()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cube')
+            cube.save(path)
+            cube.save(path)
+            loaded = SalesCube.load(path)
+            # файлы прошлой версии удалены, массивы отображаются в память
+            self.assertEqual(len([name for name in os.listdir(path) if name.endswith('.npy')]), 3)
+            self.assertIsInstance(loaded.units.base, np.memmap)
+            self.assertEqual(loaded.start, cube.start)
+            self.assertEqual(loaded.query('units', by=['product']),
+                             [{'product': 'A', 'units': 2}, {'product': 'B', 'units': 3}])
+
+    def test_cube_keeps_only_recent_days_and_sold_products(self):
+        factories.ProductFactory(name='Unsold')
+        old_order = factories.OrderFactory()
+        models.Order.objects.filter(pk=old_order.pk).update(date_added=timezone.now() - timedelta(days=40))
+        factories.OrderLineFactory(order=models.Order.objects.get(pk=old_order.pk), product=self.a)
+
+        cube = SalesCube.build(days=30)
+        self.assertEqual(list(cube.product_names), ['A', 'B'])
+        self.assertLessEqual(cube.days, 30)
+        self.assertEqual(cube.query('units'), [{'units': 5}])
+
+    def test_admin_sales_cube_view(self):
+        user = models.User.objects.create_superuser('user2', 'pw432joij')
+        self.client.force_login(user)
+        params = {'measure': 'units', 'period': '30', 'group_by': ['country']}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cube')
+            with override_settings(REPORTING_CUBE_PATH=path):
+                # куб не строится в запросе
+                response = self.client.get(reverse('admin:sales_cube'), params)
+                self.assertTrue(response.context['not_built'])
+                self.assertIsNone(response.context['rows'])
+                self.assertFalse(os.path.exists(path))
+
+                call_command('build_sales_cube', stdout=StringIO())
+                response = self.client.get(reverse('admin:sales_cube'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['columns'], ['country', 'units'])
+        self.assertEqual(response.context['rows'], [['uk', 2], ['us', 3]])
+
+
+class TestDownsampling(TestCase):
+    def test_lttb_keeps_endpoints_and_peaks(self):
+        values = [0] * 1000
+        values[500] = 100
+        indices = lttb(range(1000), values, 50)
+        self.assertEqual(len(indices), 50)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 999)
+        self.assertIn(500, indices)
+
+    def test_bucket_sum_keeps_total(self):
+        labels, values = downsample(list(range(100)), list(range(100)), 7, mode='sum')
+        self.assertEqual(len(values), 7)
+        self.assertEqual(labels[0], 0)
+        self.assertEqual(sum(values), sum(range(100)))
+
+    def test_orders_per_day_data(self):
+        factories.OrderFactory.create_batch(3)
+        user = models.User.objects.create_superuser('user2', 'pw432joij')
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('admin:orders_per_day_data'), {'days': '400', 'points': '100'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=', response['Cache-Control'])
+        data = response.json()
+        self.assertEqual(len(data['labels']), 100)
+        self.assertEqual(data['labels'][-1], date.today().strftime('%Y-%m-%d'))
+        self.assertEqual(data['values'][-1], 3)
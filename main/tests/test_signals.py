@@ -1,7 +1,9 @@
+from django.db import connection, transaction
 from django.test import TestCase
-from main import models
+from main import events, factories, models
 from django.core.files.images import ImageFile
 from decimal import Decimal
+from unittest.mock import patch
 
 
 class TestSignal(TestCase):
@@ -25,3 +27,90 @@ class TestSignal(TestCase):
                 assert image.thumbnail.read() == expected_content
             image.thumbnail.delete(save=False)
             image.image.delete(save=False)
+
+    def test_status_changes_are_published_once_per_transaction(self):
+        # события создания публикуются отдельно, как после своей транзакции
+        with patch('main.events.publish'), self.captureOnCommitCallbacks(execute=True):
+            order = factories.OrderFactory()
+            lines = factories.OrderLineFactory.create_batch(3, order=order, product=factories.ProductFactory())
+
+        with patch('main.events.publish') as publish, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for line in lines:
+                    line.status = models.OrderLine.SENT
+                    line.save()
+                self.assertFalse(publish.called)
+        self.assertEqual(publish.call_count, 1)
+        messages = publish.call_args[0][0]
+        self.assertEqual(
+            [(group, message['type']) for group, message in messages if message.get('line_id') == lines[0].id],
+            [(events.DISPATCH_GROUP, 'order.status'),
+             (events.CUSTOMER_GROUP % order.user_id, 'order.event')],
+        )
+        # последняя отправленная строка завершает заказ
+        self.assertEqual(messages[-1][1]['status'], models.Order.DONE)
+
+        # откат точки сохранения отменяет только ее сообщения
+        with patch('main.events.publish') as publish, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                lines[0].status = models.OrderLine.PROCESSING
+                lines[0].save()
+                try:
+                    with transaction.atomic():
+                        lines[1].status = models.OrderLine.PROCESSING
+                        lines[1].save()
+                        raise RuntimeError
+                except RuntimeError:
+                    pass
+        published = [message for call in publish.call_args_list for _, message in call[0][0]]
+        self.assertEqual({message.get('line_id') for message in published}, {lines[0].id})
+
+        # сообщения откаченной транзакции не попадают в следующую
+        with patch('main.events.publish') as publish, self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    lines[1].status = models.OrderLine.SENT
+                    lines[1].save()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            with transaction.atomic():
+                lines[2].status = models.OrderLine.PROCESSING
+                lines[2].save()
+        self.assertEqual(publish.call_count, 1)
+        self.assertEqual({message.get('line_id') for _, message in publish.call_args[0][0]}, {lines[2].id})
+
+    def test_publish_errors_are_logged(self):
+        with patch('main.events.get_channel_layer', side_effect=ConnectionError), \
+                self.assertLogs('main.events', 'ERROR'):
+            events.publish([(events.DISPATCH_GROUP, {'type': 'order.status'})])
+
+    def test_line_status_change_query_count(self):
+        order = factories.OrderFactory()
+        product = factories.ProductFactory()
+        factories.OrderLineFactory.create_batch(2, order=order, product=product)
+        first, last = models.OrderLine.objects.filter(order=order).order_by('id')
+        # события строки и завершенного ею заказа вставляются одним запросом
+        event_inserts = 1 if connection.features.can_return_rows_from_bulk_insert else 2
+
+        # UPDATE строки, ее заказ, проверка остальных строк, INSERT события
+        with patch('main.events.publish'), self.assertNumQueries(4):
+            first.status = models.OrderLine.SENT
+            first.save()
+
+        # последняя строка еще и завершает заказ: UPDATE заказа и его событие
+        with patch('main.events.publish'), self.assertNumQueries(4 + event_inserts):
+            last.status = models.OrderLine.SENT
+            last.save()
+        self.assertEqual(
+            list(models.OrderStatusEvent.objects.filter(order=order).order_by('id')
+                 .values_list('line_id', 'status')),
+            [(first.id, models.OrderLine.SENT), (last.id, models.OrderLine.SENT), (None, models.Order.DONE)],
+        )
+
+        # сохранение без смены статуса ничего не пишет, выполненный заказ не пересохраняется
+        with self.assertNumQueries(1):
+            last.save()
+        with patch('main.events.publish'), self.assertNumQueries(2):
+            last.status = models.OrderLine.PROCESSING
+            last.save()
@@ -3,6 +3,7 @@ from django.test import TestCase
 from django.urls import reverse
 from django.contrib import auth
 from unittest.mock import patch
+from main import factories
 from main import forms
 from main import models
 
@@ -152,3 +153,24 @@ class TestPage(TestCase):
         self.assertTrue(models.Basket.objects.filter(user=user1).exists())
         basket = models.Basket.objects.get(user=user1)
         self.assertEqual(basket.count(), 3)
+
+    def test_chat_room_shows_recent_history(self):
+        user1 = models.User.objects.create_user('user1@a.com', 'pw432joij')
+        order = factories.OrderFactory(user=user1)
+        for i in range(3):
+            models.ChatMessage.objects.create(order=order, user=user1, username='User One', message='hello %d' % i)
+
+        response = self.client.get(reverse('cs_chat', kwargs={'order_id': order.id}))
+        self.assertEqual(response.status_code, 302)
+
+        self.client.force_login(user1)
+        with self.assertNumQueries(4):
+            # сессия, пользователь, заказ и история
+            response = self.client.get(reverse('cs_chat', kwargs={'order_id': order.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m.message for m in response.context['history']], ['hello 0', 'hello 1', 'hello 2'])
+        self.assertContains(response, 'User One: hello 2')
+
+        other = factories.OrderFactory(user=factories.UserFactory(email='other@site.com'))
+        response = self.client.get(reverse('cs_chat', kwargs={'order_id': other.id}))
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import weakref
+import aiohttp
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_trackers = weakref.WeakKeyDictionary()
+
+
+class Tracker:
+    """
+    Клиент удаленного сервиса отслеживания заказов, один на цикл событий.
+    Все запросы идут через одну сессию aiohttp с пулом соединений и
+    таймаутами. Ответ по заказу хранится ORDER_TRACKER_CACHE_TIMEOUT секунд,
+    а одновременные запросы одного заказа ждут один и тот же запрос к сервису.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.session = None
+        self.cache = {}
+        self.pending = {}
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=settings.ORDER_TRACKER_CONNECTIONS),
+                timeout=aiohttp.ClientTimeout(total=settings.ORDER_TRACKER_TIMEOUT),
+            )
+        return self.session
+
+    async def fetch(self, order_id):
+        url = settings.ORDER_TRACKER_URL.format(order_id=order_id)
+        async with self.get_session().get(url) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def track(self, order_id):
+        cached = self.cache.get(order_id)
+        if cached is not None and cached[0] > self.loop.time():
+            return cached[1]
+        future = self.pending.get(order_id)
+        if future is None:
+            future = self.pending[order_id] = self.loop.create_task(self.fetch(order_id))
+            future.add_done_callback(lambda future: self.done(order_id, future))
+        # отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(future)
+
+    def done(self, order_id, future):
+        self.pending.pop(order_id, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.warning('Order tracking request for order %s failed: %r', order_id, future.exception())
+            return
+        self.cache[order_id] = (self.loop.time() + settings.ORDER_TRACKER_CACHE_TIMEOUT, future.result())
+        # устаревшие ответы удаляются, чтобы кеш не рос без предела
+        if len(self.cache) > settings.ORDER_TRACKER_CACHE_SIZE:
+            now = self.loop.time()
+            for key in [key for key, (expires, _) in self.cache.items() if expires <= now]:
+                del self.cache[key]
+
+    async def close(self):
+        for future in list(self.pending.values()):
+            future.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+
+def get_tracker():
+    loop = asyncio.get_event_loop()
+    tracker = _trackers.get(loop)
+    if tracker is None:
+        tracker = _trackers[loop] = Tracker(loop)
+    return tracker
+
+
+async def track(order_id):
+    """
+    Ответ сервиса отслеживания по заказу (из кеша, если он свежий).
+    """
+    return await get_tracker().track(order_id)
+
+
+async def close_tracker():
+    """
+    Закрывает сессию текущего цикла событий. Вызывается при остановке сервера.
+    """
+    tracker = _trackers.pop(asyncio.get_event_loop(), None)
+    if tracker is not None:
+        await tracker.close()
@@ -33,6 +33,7 @@ urlpatterns = [
     path('order/address_select/', views.AddressSelectionView.as_view(), name='address_select',),
     path('order-dashboard/', views.OrderView.as_view(), name='order_dashboard'),
     path('api/', include(router.urls)),
+    path('api/chat/<int:order_id>/messages/', endpoints.ChatMessageList.as_view(), name='chat_messages',),
     path('admin/', admin.main_admin.urls),
     path('office-admin/', admin.central_office_admin.urls),
     path('dispatch-admin/', admin.dispatchers_admin.urls),
@@ -1,7 +1,9 @@
 from django import forms as django_forms
 from django.db import models as django_models
 from django.contrib import messages
+from django.conf import settings
 from django.contrib.auth import login, authenticate
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import (LoginRequiredMixin, UserPassesTestMixin)
 from django.http import HttpResponseRedirect
 from django.views.generic.list import ListView
@@ -132,12 +134,13 @@ def add_to_basket(request):
 def manage_basket(request):
     if not request.basket:
         return render(request, 'basket.html', {'formset': None})
+    lines = models.BasketLine.objects.select_related('product')
     if request.method == 'POST':
-        formset = forms.BasketLineFormSet(request.POST, instance=request.basket)
+        formset = forms.BasketLineFormSet(request.POST, instance=request.basket, queryset=lines)
         if formset.is_valid():
             formset.save()
     else:
-        formset = forms.BasketLineFormSet(instance=request.basket)
+        formset = forms.BasketLineFormSet(instance=request.basket, queryset=lines)
     if request.basket.is_empty():
         return render(request, 'basket.html', {'formset': None})
     return render(request, 'basket.html', {'formset': formset})
@@ -187,10 +190,24 @@ class OrderView(UserPassesTestMixin, FilterView):
     def test_func(self):
         return self.request.user.is_staff is True
 
+    def get_queryset(self):
+        return models.Order.objects.select_related('user', 'last_spoken_to')
+
 
+@login_required
 def room(request, order_id):
+    """
+    Страница чата заказа. Последние сообщения истории загружаются
+    одним запросом, более ранние доступны через API chat_messages.
+    """
+    orders = models.Order.objects.all()
+    if not request.user.is_employee:
+        orders = orders.filter(user=request.user)
+    order = get_object_or_404(orders, pk=order_id)
+    history = list(order.chat_messages.order_by('-id')[:settings.CHAT_HISTORY_SIZE])
+    history.reverse()
     return render(
         request,
         "chat_room.html",
-        {"room_name_json": str(order_id)},
+        {"room_name_json": str(order_id), "history": history},
     )